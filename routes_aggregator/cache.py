@@ -0,0 +1,228 @@
+import sys
+import threading
+import time
+import types
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+def estimate_size(value, seen=None):
+    if seen is None:
+        seen = set()
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(
+            estimate_size(key, seen) + estimate_size(item, seen)
+            for key, item in value.items()
+        )
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(estimate_size(item, seen) for item in value)
+    elif hasattr(value, '__dict__'):
+        size += estimate_size(vars(value), seen)
+    else:
+        for cls in type(value).__mro__:
+            for attribute in vars(cls).values():
+                if isinstance(attribute, types.MemberDescriptorType):
+                    size += estimate_size(attribute.__get__(value, cls), seen)
+    return size
+
+
+class LRUCache:
+    """Bounded LRU cache with optional TTL and per agent type invalidation"""
+
+    def __init__(self, max_entries=None, max_bytes=None, ttl=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self.__entries = OrderedDict()
+        self.__versions = {}
+        self.__generation = 0
+        self.__size = 0
+        self.__lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def get_version(self, agent_type):
+        return self.__versions.get(agent_type, 0)
+
+    def get_generation(self):
+        return self.__generation
+
+    def get(self, key, default=None):
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            agent_type, version, expires_at, size, value = entry
+            if version != self.get_version(agent_type) or \
+               (expires_at is not None and expires_at < time.monotonic()):
+                self.__remove(key)
+                self.misses += 1
+                return default
+
+            self.__entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, agent_type, key, value, generation=None):
+        # generation is captured when the read producing the value starts,
+        # values read before a later discard or invalidation are dropped
+        size = estimate_size(value) if self.max_bytes else 0
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+
+        with self.__lock:
+            if generation is not None and generation != self.__generation:
+                return
+            if key in self.__entries:
+                self.__remove(key)
+            self.__entries[key] = (agent_type, self.get_version(agent_type), expires_at, size, value)
+            self.__size += size
+            self.__evict()
+
+    def discard(self, key):
+        with self.__lock:
+            self.__generation += 1
+            if key in self.__entries:
+                self.__remove(key)
+
+    def invalidate(self, agent_type):
+        with self.__lock:
+            self.__versions[agent_type] = self.get_version(agent_type) + 1
+            self.__generation += 1
+            stale_keys = [
+                key for key, entry in self.__entries.items()
+                if entry[0] == agent_type
+            ]
+            for key in stale_keys:
+                self.__remove(key)
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.__size = 0
+
+    @property
+    def stats(self):
+        with self.__lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self.__entries),
+                'bytes': self.__size
+            }
+
+    def __remove(self, key):
+        entry = self.__entries.pop(key)
+        self.__size -= entry[3]
+
+    def __evict(self):
+        while self.__entries and (
+                (self.max_entries and len(self.__entries) > self.max_entries) or
+                (self.max_bytes and self.__size > self.max_bytes)):
+            key, entry = self.__entries.popitem(last=False)
+            self.__size -= entry[3]
+            self.evictions += 1
+
+
+class PathResultCache:
+    """Cache of path search results validated against per agent type model
+    versions, coalescing concurrent identical searches into a single one"""
+
+    DEFAULT_MAX_ENTRIES = 1000
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=None, ttl=None):
+        self.results = LRUCache(max_entries, max_bytes, ttl)
+        self.coalesced = 0
+
+        self.__versions = {}
+        self.__generation = 0
+        self.__flights = {}
+        self.__lock = threading.Lock()
+
+    def is_valid(self, versions):
+        with self.__lock:
+            return all(
+                self.__versions.get(agent_type, 0) == version
+                for agent_type, version in versions.items()
+            )
+
+    @staticmethod
+    def get_agent_types(paths):
+        return set(
+            path_item.route.agent_type
+            for path in paths for path_item in path.path_items
+        )
+
+    def lookup(self, key):
+        entry = self.results.get(key)
+        if entry is not None:
+            if self.is_valid(entry[0]):
+                return entry[1]
+            self.results.discard(key)
+        return None
+
+    def get_versions(self):
+        with self.__lock:
+            return dict(self.__versions)
+
+    def store(self, key, paths, versions):
+        # accessors report failures as empty results, which are not cached
+        if paths:
+            entry_versions = {
+                agent_type: versions.get(agent_type, 0)
+                for agent_type in self.get_agent_types(paths)
+            }
+            self.results.put(None, key, (entry_versions, paths))
+
+    def get(self, key, finder):
+        paths = self.lookup(key)
+        if paths is not None:
+            return paths
+
+        with self.__lock:
+            flight_key = (key, self.__generation)
+            future = self.__flights.get(flight_key)
+            leader = future is None
+            if leader:
+                future = self.__flights[flight_key] = Future()
+                versions = dict(self.__versions)
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            return future.result()
+
+        try:
+            paths = finder()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            self.store(key, paths, versions)
+            future.set_result(paths)
+            return paths
+        finally:
+            with self.__lock:
+                self.__flights.pop(flight_key, None)
+
+    def invalidate(self, agent_type):
+        with self.__lock:
+            self.__versions[agent_type] = self.__versions.get(agent_type, 0) + 1
+            self.__generation += 1
+
+    @property
+    def stats(self):
+        return dict(self.results.stats, coalesced=self.coalesced)
@@ -0,0 +1,95 @@
+import heapq
+import itertools
+
+from routes_aggregator.model import Station, Path, PathItem
+
+
+class DirectConnectionIndex:
+    """Station pair table of direct connections sorted by departure time,
+    answering SIMPLE path lookups between known departure and arrival stations"""
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.agent_connections = {}
+
+    @staticmethod
+    def build_connections(model):
+        connections = {}
+        route_positions = {}
+
+        for route in model.routes.values():
+            station_ids = [
+                Station.get_domain_id(route.agent_type, route_point.station_id)
+                for route_point in route.route_points
+            ]
+
+            positions = route_positions[route.domain_id] = {}
+            for i, station_id in enumerate(station_ids):
+                positions.setdefault(station_id, []).append(i)
+
+            for departure_idx in range(len(station_ids) - 1):
+                departure_time = route.route_points[departure_idx].raw_departure_time or 0
+                for arrival_idx in range(departure_idx + 1, len(station_ids)):
+                    connections.setdefault(
+                        (station_ids[departure_idx], station_ids[arrival_idx]), []
+                    ).append((departure_time, route.domain_id, departure_idx, arrival_idx, route))
+
+        for pair_connections in connections.values():
+            pair_connections.sort(key=lambda connection: connection[:4])
+        return connections, route_positions
+
+    def build_model(self, model):
+        self.logger.debug('DirectConnectionIndex: building \'{}\' model'.format(model.agent_type))
+        self.agent_connections[model.agent_type] = self.build_connections(model)
+        self.logger.debug('DirectConnectionIndex: built \'{}\' model'.format(model.agent_type))
+
+    def remove_model(self, agent_type):
+        self.agent_connections.pop(agent_type, None)
+
+    def supports(self, station_ids):
+        return bool(self.agent_connections) and len(station_ids) >= 2 and \
+            bool(station_ids[0]) and bool(station_ids[-1])
+
+    @staticmethod
+    def passes_through(route_positions, connection, station_ids):
+        previous_idx = connection[2]
+        for ids in station_ids:
+            if not ids:
+                # any station matches, which still has to be strictly intermediate
+                previous_idx += 1
+                if previous_idx >= connection[3]:
+                    return False
+                continue
+            previous_idx = min(
+                (i for station_id in ids
+                 for i in route_positions.get(station_id, ())
+                 if previous_idx < i < connection[3]),
+                default=None
+            )
+            if previous_idx is None:
+                return False
+        return True
+
+    def find_paths(self, station_ids, limit):
+        middle_station_ids = station_ids[1:-1]
+        connection_key = lambda connection: connection[:4]
+
+        def connections_getter(connections, route_positions):
+            pairs_connections = [
+                connections.get(pair, ())
+                for pair in itertools.product(set(station_ids[0]), set(station_ids[-1]))
+            ]
+            for connection in heapq.merge(*pairs_connections, key=connection_key):
+                if not middle_station_ids or self.passes_through(
+                        route_positions[connection[1]], connection, middle_station_ids):
+                    yield connection
+
+        def paths_getter():
+            for connection in heapq.merge(
+                    *itertools.starmap(connections_getter, list(self.agent_connections.values())),
+                    key=connection_key):
+                path = Path()
+                path.add_path_item(PathItem(connection[4], connection[2], connection[3]))
+                yield path
+
+        return list(itertools.islice(paths_getter(), limit))
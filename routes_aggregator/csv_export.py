@@ -0,0 +1,116 @@
+import csv
+import os
+import shlex
+
+from routes_aggregator.db_accessor import DbAccessor
+from routes_aggregator.model_format import get_model_fingerprint
+
+
+class CsvModelExporter:
+    """Streaming exporter of models into node and relationship files for the offline neo4j-admin importer"""
+
+    DEFAULT_DATABASE = 'graph.db'
+
+    def __init__(self, export_path, database=DEFAULT_DATABASE):
+        self.export_path = export_path
+        self.database = database
+        self.import_files = []
+
+        os.makedirs(export_path, exist_ok=True)
+
+    @staticmethod
+    def get_property_type(value, property_type):
+        if isinstance(value, int) and not isinstance(value, bool) and property_type in (None, 'long'):
+            return 'long'
+        return 'string'
+
+    def collect_property_types(self, items_factory):
+        property_types = {}
+        for _, properties in items_factory():
+            for name, value in properties.items():
+                if value is not None:
+                    property_types[name] = self.get_property_type(value, property_types.get(name))
+        return property_types
+
+    def write_file(self, file_name, import_option, id_columns, items_factory):
+        property_types = self.collect_property_types(items_factory)
+        file_path = os.path.join(self.export_path, file_name)
+
+        with open(file_path, 'w', newline='', encoding='utf-8') as fileobj:
+            writer = csv.writer(fileobj)
+            writer.writerow(id_columns + [
+                '{}:{}'.format(name, property_type) for name, property_type in property_types.items()
+            ])
+            for ids, properties in items_factory():
+                writer.writerow(ids + [
+                    self.prepare_value(properties.get(name)) for name in property_types
+                ])
+
+        self.import_files.append((import_option, file_path))
+
+    @staticmethod
+    def prepare_value(value):
+        return '' if value is None else value
+
+    def export_model(self, model, model_version=None):
+        agent_type = model.agent_type
+        model_version = model_version or DbAccessor.generate_model_version(agent_type)
+
+        def stations_getter():
+            for station in model.stations.values():
+                properties = DbAccessor.prepare_station_properties(station)
+                domain_id = properties.pop('domain_id')
+                properties['model_version'] = model_version
+                yield [domain_id], properties
+
+        def routes_getter():
+            for route in model.routes.values():
+                properties = DbAccessor.prepare_route_properties(route)
+                domain_id = properties.pop('domain_id')
+                properties['model_version'] = model_version
+                yield [domain_id], properties
+
+        def connections_getter():
+            for route in model.routes.values():
+                for connection in DbAccessor.prepare_route_connections(route):
+                    yield [connection['station_domain_id'], connection['route_domain_id']], \
+                        connection['properties']
+
+        def transitions_getter():
+            for route in model.routes.values():
+                for transition in DbAccessor.prepare_transitions(route):
+                    yield [transition['from_domain_id'], transition['to_domain_id']], \
+                        transition['properties']
+
+        def versions_getter():
+            yield [agent_type], {'active_version': model_version, 'fingerprint': get_model_fingerprint(model)}
+
+        self.write_file(
+            '{}-stations.csv'.format(agent_type), '--nodes:Station',
+            ['domain_id:ID(Station)'], stations_getter)
+        self.write_file(
+            '{}-routes.csv'.format(agent_type), '--nodes:Route',
+            ['domain_id:ID(Route)'], routes_getter)
+        self.write_file(
+            '{}-route-connections.csv'.format(agent_type), '--relationships:ROUTE_CONNECTION',
+            [':START_ID(Station)', ':END_ID(Route)'], connections_getter)
+        self.write_file(
+            '{}-transitions.csv'.format(agent_type), '--relationships:TRANSITION',
+            [':START_ID(Station)', ':END_ID(Station)'], transitions_getter)
+        self.write_file(
+            '{}-model-version.csv'.format(agent_type), '--nodes:ModelVersion',
+            ['agent_type:ID(ModelVersion)'], versions_getter)
+        return model_version
+
+    def build_import_command(self):
+        arguments = [
+            'neo4j-admin', 'import',
+            '--database={}'.format(self.database),
+            '--id-type=STRING',
+            '--ignore-empty-strings=true',
+            '--multiline-fields=true'
+        ]
+        arguments.extend(
+            '{}={}'.format(import_option, file_path) for import_option, file_path in self.import_files
+        )
+        return ' '.join(map(shlex.quote, arguments))
@@ -1,82 +1,153 @@
 import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from neo4j.v1 import GraphDatabase, basic_auth, CypherError, DatabaseError
+from neo4j.v1 import GraphDatabase, basic_auth, CypherError, DatabaseError, ServiceUnavailable, SessionExpired, \
+    READ_ACCESS, WRITE_ACCESS
 
-from routes_aggregator.model import Entity, Station, Route, RoutePoint, Path, PathItem
-from routes_aggregator.utils import time_to_minutes
+from routes_aggregator.cache import LRUCache
+from routes_aggregator.exceptions import ModelStoreException
+from routes_aggregator.model_diff import ModelDiff
+from routes_aggregator.model_format import get_model_fingerprint
+from routes_aggregator.model import Station, Route, RoutePoint, Path, PathItem
+from routes_aggregator.search_index import normalize_name
 
 
-class MatchByParametersQueryGenerator:
+class QueryGenerator:
+
+    def __init__(self):
+        self.queries = {}
+
+    def get_query(self, key, builder):
+        query = self.queries.get(key)
+        if query is None:
+            query = builder()
+            self.queries[key] = query
+        return query
 
-    MATCH_PART = "MATCH (n:{label}) WHERE "
-    RETURN_PART = "RETURN DISTINCT n LIMIT $limit"
+
+class MatchByParametersQueryGenerator(QueryGenerator):
+
+    MATCH_PART = "MATCH (n:{label}) WHERE n.model_version in $versions and ("
+    RETURN_PART = ") RETURN DISTINCT n LIMIT $limit"
 
     QUERY_PATTERN_MAP = {
-        "STARTS_WITH": "LOWER(n.{}) STARTS WITH LOWER({})",
-        "STRICT": "n.{} = {}",
-        "REGEX": "n.{} =~ {}"
+        "STARTS_WITH": "LOWER(n.{}) STARTS WITH LOWER(${})",
+        "STRICT": "n.{} = ${}",
+        "REGEX": "n.{} =~ ${}"
     }
 
+    VALUE_PARAMETER_PATTERN = "value_{}"
+
     def __init__(self):
-        pass
+        super().__init__()
 
-    def generate_query(self, label, search_mode, property_names, property_values):
+    def generate_query(self, label, search_mode, property_names, values_count):
+        search_mode = (search_mode or '').upper()
+        property_names = tuple(property_names)
 
-        pattern = self.QUERY_PATTERN_MAP.get(search_mode.upper())
-        if not pattern:
+        pattern = self.QUERY_PATTERN_MAP.get(search_mode)
+        if not pattern or not values_count:
             return ''
 
-        conditions = ' OR '.join(
-            map(
-                lambda item: pattern.format(item[0], repr(item[1])),
-                itertools.product(property_names, property_values)
+        def query_builder():
+            conditions = ' OR '.join(
+                map(
+                    lambda item: pattern.format(
+                        item[0], self.VALUE_PARAMETER_PATTERN.format(item[1])),
+                    itertools.product(property_names, range(values_count))
+                )
             )
-        )
+            return self.MATCH_PART.format(label=label) + conditions + self.RETURN_PART
 
-        return self.MATCH_PART.format(label=label) + conditions + self.RETURN_PART
+        return self.get_query((label, search_mode, property_names, values_count), query_builder)
 
+    def prepare_parameters(self, property_values, limit):
+        parameters = {'limit': limit}
+        for i, value in enumerate(property_values):
+            parameters[self.VALUE_PARAMETER_PATTERN.format(i)] = value
+        return parameters
 
-class MatchPathsWithSingleRouteQueryGenerator:
 
-    MATCH_PART_PATTERN = "(s{id}:Station)-[r{id}:ROUTE_CONNECTION]->(n:Route)"
-    WHERE_PART_PATTERN = "s{id}.domain_id in $station_ids_{id} "
-    CONDITION_PART_PATTERN = "toInteger(r{}.station_number) < toInteger(r{}.station_number) "
+class MatchBySearchKeysQueryGenerator(MatchByParametersQueryGenerator):
+
+    QUERY_PART_PATTERN = "MATCH (n:{label}) WHERE {condition} and n.model_version in $versions " \
+                         "RETURN n LIMIT $limit"
+
+    QUERY_PATTERN_MAP = {
+        "STARTS_WITH": "n.{} STARTS WITH ${}",
+        "STRICT": "n.{} = ${}"
+    }
 
     def __init__(self):
-        pass
+        super().__init__()
 
-    def generate_query(self, station_ids):
+    def supports(self, search_mode):
+        return (search_mode or '').upper() in self.QUERY_PATTERN_MAP
 
-        stations_count = len(station_ids)
+    def generate_query(self, label, search_mode, property_names, values_count):
+        search_mode = (search_mode or '').upper()
+        property_names = tuple(property_names)
 
-        match_part = "MATCH "
-        where_part = " WHERE "
-        condition_part = ""
-        return_part = "RETURN DISTINCT r1, n, r{} LIMIT $limit".format(stations_count)
+        pattern = self.QUERY_PATTERN_MAP.get(search_mode)
+        if not pattern or not values_count:
+            return ''
 
-        for i, ids in enumerate(station_ids):
-            match_part += self.MATCH_PART_PATTERN.format(id=i + 1)
+        def query_builder():
+            return ' UNION '.join(
+                map(
+                    lambda item: self.QUERY_PART_PATTERN.format(
+                        label=label,
+                        condition=pattern.format(item[0], self.VALUE_PARAMETER_PATTERN.format(item[1]))
+                    ),
+                    itertools.product(property_names, range(values_count))
+                )
+            )
 
-            if station_ids[i]:
-                where_part += self.WHERE_PART_PATTERN.format(id=i + 1)
-                if i + 1 < stations_count:
-                    where_part += "and "
+        return self.get_query((label, search_mode, property_names, values_count), query_builder)
 
-            if i + 1 < stations_count:
-                match_part += ", "
-            if i > 0:
-                condition_part += "and " + self.CONDITION_PART_PATTERN.format(i, i + 1)
+    def prepare_parameters(self, property_values, limit):
+        return super().prepare_parameters(map(normalize_name, property_values), limit)
 
-        return match_part + where_part + condition_part + return_part
 
+class MatchPathsWithSingleRouteQueryGenerator(QueryGenerator):
 
-class MatchPathsWithMultipleRoutesQueryGenerator:
+    MATCH_PART_PATTERN = "(s{id}:Station)-[r{id}:ROUTE_CONNECTION]->(n:Route)"
+    WHERE_PART_PATTERN = "s{id}.domain_id in $station_ids_{id}"
+    VERSION_PART = "n.model_version in $versions"
+    CONDITION_PART_PATTERN = "toInteger(r{}.station_number) < toInteger(r{}.station_number)"
+
+    def __init__(self):
+        super().__init__()
+
+    def generate_query(self, station_ids):
+        key = tuple(bool(ids) for ids in station_ids)
+        return self.get_query(key, lambda: self.build_query(key))
+
+    def build_query(self, key):
+        stations_count = len(key)
+
+        matches = []
+        conditions = [self.VERSION_PART]
+        for i, has_ids in enumerate(key):
+            matches.append(self.MATCH_PART_PATTERN.format(id=i + 1))
+            if has_ids:
+                conditions.append(self.WHERE_PART_PATTERN.format(id=i + 1))
+        for i in range(1, stations_count):
+            conditions.append(self.CONDITION_PART_PATTERN.format(i, i + 1))
+
+        query = "MATCH " + ", ".join(matches) + " WHERE " + " and ".join(conditions)
+        return query + " RETURN DISTINCT r1, n, r{} LIMIT $limit".format(stations_count)
+
+
+class MatchPathsWithMultipleRoutesQueryGenerator(QueryGenerator):
 
     MATCH_PART_BEGIN = "MATCH (s1:Station)-[r1:ROUTE_CONNECTION]->(n1:Route)"
     MATCH_PART_END = "<-[r{}:ROUTE_CONNECTION]-(s{}:Station) "
     MATCH_PART_PATTERN = "<-[r{}:ROUTE_CONNECTION]-(s{}:Station)-[r{}:ROUTE_CONNECTION]->(n{}:Route)"
 
-    WHERE_PART_BEGIN = "WHERE s1.domain_id in $station_ids_1 "
+    WHERE_PART_BEGIN = "WHERE s1.domain_id in $station_ids_1 and s1.model_version in $versions "
     WHERE_PART_PATTERN = "and s{id}.domain_id in $station_ids_{id} "
     CONDITION_PART = "and toInteger(r{}.station_number) < toInteger(r{}.station_number) "
 
@@ -85,10 +156,14 @@ class MatchPathsWithMultipleRoutesQueryGenerator:
     RETURN_PART_PATTERN = ", r{}, n{}, r{}"
 
     def __init__(self):
-        pass
+        super().__init__()
 
     def generate_query(self, station_ids):
-        transfers_count = len(station_ids) - 2
+        key = tuple(bool(ids) for ids in station_ids[1:-1])
+        return self.get_query(key, lambda: self.build_query(key))
+
+    def build_query(self, key):
+        transfers_count = len(key)
 
         match_part = self.MATCH_PART_BEGIN
         where_part = self.WHERE_PART_BEGIN + self.WHERE_PART_PATTERN.format(id=transfers_count + 2)
@@ -98,7 +173,7 @@ class MatchPathsWithMultipleRoutesQueryGenerator:
         for i in range(transfers_count):
             match_part += self.MATCH_PART_PATTERN.format(2 * i + 2, i + 2, 2 * i + 3, i + 2)
             condition_part += self.CONDITION_PART.format(2 * i + 3, 2 * i + 4)
-            if station_ids[i + 1]:
+            if key[i]:
                 where_part += self.WHERE_PART_PATTERN.format(id=i + 2)
             return_part += self.RETURN_PART_PATTERN.format(2 * i + 3, i + 2, 2 * i + 4)
 
@@ -108,86 +183,391 @@ class MatchPathsWithMultipleRoutesQueryGenerator:
         return match_part + where_part + condition_part + return_part
 
 
+class MatchShortestPathsQueryGenerator(QueryGenerator):
+
+    QUERY_PATTERN = "MATCH (s1:Station), (s2:Station), " \
+                    "n=allShortestPaths((s1)-[rs:TRANSITION*..{max_transitions}]->(s2)) " \
+                    "WHERE s1.domain_id in $departure_station_ids " \
+                    "AND s1.model_version in $versions " \
+                    "AND s2.domain_id in $arrival_station_ids " \
+                    "RETURN relationships(n) as transitions LIMIT $limit"
+
+    def __init__(self):
+        super().__init__()
+
+    def generate_query(self, max_transitions):
+        max_transitions = int(max_transitions)
+        return self.get_query(
+            max_transitions,
+            lambda: self.QUERY_PATTERN.format(max_transitions=max_transitions)
+        )
+
+
+class VersionedTransaction:
+    """Transaction binding the active model versions to the $versions query parameter
+    and the cache generations observed when the read started"""
+
+    def __init__(self, transaction, versions, station_generation=None, routes_generation=None):
+        self.transaction = transaction
+        self.versions = versions
+        self.station_generation = station_generation
+        self.routes_generation = routes_generation
+
+    def run(self, statement, parameters=None):
+        parameters = dict(parameters or {})
+        parameters.setdefault('versions', self.versions)
+        return self.transaction.run(statement, parameters)
+
+
 class DbAccessor:
 
-    CREATE_NODE = r"CREATE (n:{label}  {{ {properties} }} ) RETURN n"
-    CREATE_ROUTE_CONNECTION = \
-        "MATCH (a:Route {{ domain_id: '{route_domain_id}' }}), " \
-        "      (b:Station {{ domain_id: '{station_domain_id}' }}) " \
-        "CREATE (a)<-[:ROUTE_CONNECTION {{ {properties} }} ]-(b)"
-    CREATE_TRANSITION = \
-        "MATCH (a:Station {{ domain_id: '{from_domain_id}' }}), " \
-        "      (b:Station {{ domain_id: '{to_domain_id}' }}) " \
-        "CREATE (a)-[:TRANSITION {{ {properties} }} ]->(b)"
+    SEARCH_KEY_PROPERTIES = {
+        'station_name_ua': 'search_name_ua',
+        'station_name_en': 'search_name_en',
+        'station_name_ru': 'search_name_ru'
+    }
+
+    CREATE_STATIONS = \
+        "UNWIND $stations AS properties " \
+        "CREATE (n:Station) SET n = properties, n.model_version = $model_version"
+    CREATE_ROUTES = \
+        "UNWIND $routes AS properties " \
+        "CREATE (n:Route) SET n = properties, n.model_version = $model_version"
+    CREATE_ROUTE_CONNECTIONS = \
+        "UNWIND $connections AS connection " \
+        "MATCH (a:Route { domain_id: connection.route_domain_id, model_version: $model_version }), " \
+        "      (b:Station { domain_id: connection.station_domain_id, model_version: $model_version }) " \
+        "CREATE (a)<-[r:ROUTE_CONNECTION]-(b) SET r = connection.properties"
+    CREATE_TRANSITIONS = \
+        "UNWIND $transitions AS transition " \
+        "MATCH (a:Station { domain_id: transition.from_domain_id, model_version: $model_version }), " \
+        "      (b:Station { domain_id: transition.to_domain_id, model_version: $model_version }) " \
+        "CREATE (a)-[r:TRANSITION]->(b) SET r = transition.properties"
+
+    UPDATE_STATIONS = \
+        "UNWIND $stations AS properties " \
+        "MATCH (n:Station { domain_id: properties.domain_id, model_version: $model_version }) " \
+        "SET n = properties, n.model_version = $model_version"
+    UPDATE_ROUTES = \
+        "UNWIND $routes AS properties " \
+        "MATCH (n:Route { domain_id: properties.domain_id, model_version: $model_version }) " \
+        "SET n = properties, n.model_version = $model_version"
+    DELETE_STATIONS = \
+        "UNWIND $domain_ids AS domain_id " \
+        "MATCH (n:Station { domain_id: domain_id, model_version: $model_version }) DETACH DELETE n"
+    DELETE_ROUTES = \
+        "UNWIND $domain_ids AS domain_id " \
+        "MATCH (n:Route { domain_id: domain_id, model_version: $model_version }) DETACH DELETE n"
+    DELETE_TRANSITIONS = \
+        "UNWIND $transitions AS transition " \
+        "MATCH (a:Station { domain_id: transition.from_domain_id, model_version: $model_version })" \
+        "-[r:TRANSITION { route_id: transition.route_id }]->" \
+        "(b:Station { domain_id: transition.to_domain_id }) DELETE r"
+    COUNT_NODES = "MATCH (n:{label}) WHERE n.model_version = $model_version RETURN count(n) AS count"
+    COUNT_RELATIONSHIPS = \
+        "MATCH (n:Station)-[r:{type}]->() WHERE n.model_version = $model_version RETURN count(r) AS count"
+
+    MATCH_ACTIVE_MODEL_VERSIONS = \
+        "MATCH (v:ModelVersion) WHERE v.active_version IS NOT NULL " \
+        "RETURN v.agent_type AS agent_type, v.active_version AS model_version, v.fingerprint AS fingerprint"
+    MATCH_RETIRED_MODEL_VERSIONS = \
+        "MATCH (v:ModelVersion) UNWIND range(0, size(coalesce(v.retired_versions, [])) - 1) AS i " \
+        "WITH v, i WHERE coalesce(v.retired_times[i], 0) <= timestamp() - $grace_period " \
+        "RETURN v.agent_type AS agent_type, v.retired_versions[i] AS model_version"
+    LOCK_RETIRED_MODEL_VERSION = \
+        "MATCH (v:ModelVersion { agent_type: $agent_type }) " \
+        "SET v.lock = true REMOVE v.lock " \
+        "WITH v WHERE any(i IN range(0, size(coalesce(v.retired_versions, [])) - 1) " \
+        "WHERE v.retired_versions[i] = $value AND coalesce(v.retired_times[i], 0) <= timestamp() - $grace_period) "
+    COUNT_RETIRED_MODEL_VERSIONS = \
+        "MATCH (v:ModelVersion) RETURN sum(size(coalesce(v.retired_versions, []))) AS count"
+    MATCH_UNVERSIONED_AGENT_TYPES = \
+        "MATCH (n:Station) WHERE n.model_version IS NULL RETURN DISTINCT n.agent_type AS agent_type " \
+        "UNION MATCH (n:Route) WHERE n.model_version IS NULL RETURN DISTINCT n.agent_type AS agent_type"
+    ADOPT_UNVERSIONED_MODEL = \
+        "MERGE (v:ModelVersion { agent_type: $agent_type }) " \
+        "SET v.active_version = coalesce(v.active_version, $model_version) " \
+        "RETURN v.active_version AS model_version"
+    # stations of unversioned models predate the search keys, which are backfilled on adoption
+    MATCH_UNVERSIONED_STATIONS = \
+        "MATCH (n:Station) WHERE n.agent_type = $agent_type AND n.model_version IS NULL " \
+        "RETURN id(n) AS id, n LIMIT $limit"
+    ADOPT_UNVERSIONED_STATIONS = \
+        "UNWIND $stations AS station MATCH (n:Station) WHERE id(n) = station.id " \
+        "SET n += station.search_keys, n.model_version = $model_version"
+    ADOPT_UNVERSIONED_NODES = \
+        "MATCH (n:{label}) WHERE n.agent_type = $agent_type AND n.model_version IS NULL " \
+        "WITH n LIMIT $limit SET n.model_version = $model_version RETURN count(n) AS count"
+    # the staged version may belong to another process, it is only replaced once
+    # its owner stopped renewing the lease, the lock property serializes stagers
+    STAGE_MODEL_VERSION = \
+        "MERGE (v:ModelVersion { agent_type: $agent_type }) " \
+        "SET v.lock = true REMOVE v.lock " \
+        "WITH v WHERE v.staged_version IS NULL OR coalesce(v.staged_at, 0) < timestamp() - $stage_lease " \
+        "SET v.retired_versions = coalesce(v.retired_versions, []) + " \
+        "CASE WHEN v.staged_version IS NULL THEN [] ELSE [v.staged_version] END, " \
+        "v.retired_times = coalesce(v.retired_times, []) + " \
+        "CASE WHEN v.staged_version IS NULL THEN [] ELSE [timestamp()] END, " \
+        "v.staged_version = $model_version, v.staged_at = timestamp() " \
+        "RETURN v.staged_version AS model_version"
+    RENEW_STAGED_MODEL_VERSION = \
+        "MATCH (v:ModelVersion { agent_type: $agent_type }) " \
+        "WHERE v.staged_version = $model_version SET v.staged_at = timestamp() " \
+        "RETURN v.staged_version AS model_version"
+    ACTIVATE_MODEL_VERSION = \
+        "MATCH (v:ModelVersion { agent_type: $agent_type }) " \
+        "WHERE v.staged_version = $model_version " \
+        "SET v.retired_versions = coalesce(v.retired_versions, []) + " \
+        "CASE WHEN v.active_version IS NULL THEN [] ELSE [v.active_version] END, " \
+        "v.retired_times = coalesce(v.retired_times, []) + " \
+        "CASE WHEN v.active_version IS NULL THEN [] ELSE [timestamp()] END, " \
+        "v.active_version = $model_version, v.fingerprint = $fingerprint, " \
+        "v.staged_version = null, v.staged_at = null " \
+        "RETURN v.active_version AS model_version"
+    UPDATE_MODEL_FINGERPRINT = \
+        "MATCH (v:ModelVersion { agent_type: $agent_type }) " \
+        "WHERE v.active_version = $model_version AND v.fingerprint = $previous_fingerprint " \
+        "SET v.fingerprint = $fingerprint " \
+        "RETURN v.fingerprint AS fingerprint"
+    RETIRE_STAGED_MODEL_VERSION = \
+        "MATCH (v:ModelVersion { agent_type: $agent_type }) " \
+        "SET v.retired_versions = coalesce(v.retired_versions, []) + [$model_version], " \
+        "v.retired_times = coalesce(v.retired_times, []) + [timestamp()], " \
+        "v.staged_at = CASE WHEN v.staged_version = $model_version THEN null ELSE v.staged_at END, " \
+        "v.staged_version = CASE WHEN v.staged_version = $model_version THEN null ELSE v.staged_version END"
+    # collectors of several processes may run at once, the lease and the retirement
+    # are checked again once the version node is locked in the retiring transaction
+    RETIRE_STALE_STAGED_MODEL_VERSIONS = \
+        "MATCH (v:ModelVersion) WHERE v.staged_version IS NOT NULL " \
+        "SET v.lock = true REMOVE v.lock " \
+        "WITH v WHERE v.staged_version IS NOT NULL AND coalesce(v.staged_at, 0) < timestamp() - $stage_lease " \
+        "SET v.retired_versions = coalesce(v.retired_versions, []) + [v.staged_version], " \
+        "v.retired_times = coalesce(v.retired_times, []) + [timestamp()], " \
+        "v.staged_version = null, v.staged_at = null " \
+        "RETURN v.agent_type AS agent_type"
+    RELEASE_MODEL_VERSION = \
+        "MATCH (v:ModelVersion { agent_type: $agent_type }) " \
+        "WITH v, coalesce(v.retired_versions, []) AS versions " \
+        "SET v.retired_times = [i IN range(0, size(versions) - 1) WHERE versions[i] <> $model_version | " \
+        "coalesce(v.retired_times[i], 0)], " \
+        "v.retired_versions = [version IN versions WHERE version <> $model_version]"
+
+    DELETE_MODEL_VERSION = "MATCH (v:ModelVersion { agent_type: $agent_type }) DELETE v"
+    DELETE_BATCHES = [
+        ("MATCH (n:Route)<-[r:ROUTE_CONNECTION]-() WHERE n.{property} = $value "
+         "WITH r LIMIT $limit DELETE r RETURN count(r) AS count", 'route connections'),
+        ("MATCH (n:Station)-[r:TRANSITION]->() WHERE n.{property} = $value "
+         "WITH r LIMIT $limit DELETE r RETURN count(r) AS count", 'transitions'),
+        ("MATCH (n:Route) WHERE n.{property} = $value "
+         "WITH n LIMIT $limit DETACH DELETE n RETURN count(n) AS count", 'routes'),
+        ("MATCH (n:Station) WHERE n.{property} = $value "
+         "WITH n LIMIT $limit DETACH DELETE n RETURN count(n) AS count", 'stations')
+    ]
 
     CREATE_INDEX = "CREATE INDEX ON :{label}({property})"
-    DELETE_RELATIONSHIP = "MATCH ()-[r { agent_type: $agent_type }]->() DELETE r"
-    DELETE_NODE = "MATCH (n { agent_type: $agent_type }) DELETE n"
 
-    MATCH_STATION_BY_DOMAIN_ID = "MATCH (n:Station) WHERE n.domain_id = $domain_id RETURN n"
-    MATCH_ROUTE_BY_DOMAIN_ID = "MATCH (n:Route) WHERE n.domain_id = $domain_id RETURN n"
+    MATCH_STATION_BY_DOMAIN_ID = \
+        "MATCH (n:Station) WHERE n.domain_id = $domain_id and n.model_version in $versions RETURN n"
+    MATCH_STATIONS_BY_DOMAIN_IDS = \
+        "MATCH (n:Station) WHERE n.domain_id in $domain_ids and n.model_version in $versions RETURN n"
+    MATCH_ROUTES_BY_DOMAIN_IDS = \
+        "MATCH (n:Route) WHERE n.domain_id in $domain_ids and n.model_version in $versions RETURN n"
     MATCH_ROUTE_BY_STATION_IDS = "MATCH (s:Station)-[r:ROUTE_CONNECTION]->(n:Route) " \
-                                 "WHERE s.domain_id in $station_ids " \
+                                 "WHERE s.domain_id in $station_ids and s.model_version in $versions " \
                                  "RETURN DISTINCT n, r ORDER BY r.raw_route_start_time LIMIT $limit"
 
-    MATCH_TRANSITIONS_BY_ROUTE_ID = "MATCH (s1:Station)" \
-                                    "-[r:TRANSITION { route_id: $route_id }]->" \
-                                    "(s2: Station) RETURN DISTINCT " \
-                                    "s1.station_id as departure_station_id, " \
-                                    "r, s2.station_id as arrival_station_id " \
-                                    "ORDER BY toInteger(r.transition_number)"
-
-    MATCH_SHORTEST_PATHS = "MATCH (s1:Station), (s2:Station), " \
-                           "n=allShortestPaths((s1)-[rs:TRANSITION*..{max_transitions}]->(s2)) " \
-                           "WHERE s1.domain_id in $departure_station_ids " \
-                           "AND s2.domain_id in $arrival_station_ids " \
-                           "RETURN relationships(n) as transitions LIMIT $limit"
-
-    def __init__(self, credentials, logger):
-        self.driver = GraphDatabase.driver(
-            'bolt://localhost',
-            auth=basic_auth(credentials[0], credentials[1]))
+    MATCH_TRANSITIONS_BY_ROUTES = "UNWIND $routes AS route " \
+                                  "MATCH (n:Route { domain_id: route.domain_id })" \
+                                  "<-[:ROUTE_CONNECTION]-(s1:Station)" \
+                                  "-[r:TRANSITION { agent_type: route.agent_type, route_id: route.route_id }]->" \
+                                  "(s2: Station) WHERE n.model_version in $versions " \
+                                  "RETURN DISTINCT " \
+                                  "route.domain_id as route_domain_id, " \
+                                  "s1.station_id as departure_station_id, " \
+                                  "r, s2.station_id as arrival_station_id " \
+                                  "ORDER BY route_domain_id, toInteger(r.transition_number)"
+
+    DEFAULT_URI = 'bolt://localhost'
+    DEFAULT_BATCH_SIZE = 1000
+    DEFAULT_STAGE_LEASE = 300
+    DEFAULT_RETIRED_VERSIONS_GRACE_PERIOD = 300
+    DEFAULT_VERSIONS_TTL = 1
+    DEFAULT_CACHE_MAX_ENTRIES = 10000
+
+    def __init__(self, credentials, logger, uri=DEFAULT_URI, read_uris=None,
+                 max_connection_pool_size=None, connection_acquisition_timeout=None,
+                 batch_size=DEFAULT_BATCH_SIZE, cache_max_entries=DEFAULT_CACHE_MAX_ENTRIES,
+                 cache_max_bytes=None, cache_ttl=None, stage_lease=DEFAULT_STAGE_LEASE,
+                 retired_versions_grace_period=DEFAULT_RETIRED_VERSIONS_GRACE_PERIOD,
+                 versions_ttl=DEFAULT_VERSIONS_TTL):
+        driver_options = {'auth': basic_auth(credentials[0], credentials[1])}
+        if max_connection_pool_size is not None:
+            driver_options['max_connection_pool_size'] = max_connection_pool_size
+        if connection_acquisition_timeout is not None:
+            driver_options['connection_acquisition_timeout'] = connection_acquisition_timeout
+
+        self.driver = GraphDatabase.driver(uri, **driver_options)
+        self.read_drivers = [GraphDatabase.driver(read_uri, **driver_options) for read_uri in read_uris or []]
+        self.read_drivers_cycle = itertools.cycle(self.read_drivers or [self.driver])
+
+        self.sessions = threading.local()
+        self.sessions_generation = 0
+        self.bookmark = None
 
         self.logger = logger
-        self.create_indices()
+        self.batch_size = batch_size
+        self.stage_lease = stage_lease
+        self.retired_versions_grace_period = retired_versions_grace_period
+        self.versions_ttl = versions_ttl
+        self.versions_expire_at = 0
+        self.active_versions = {}
+        self.active_fingerprints = {}
+        self.version_listeners = []
+        self.collector = ThreadPoolExecutor(max_workers=1)
+        self.collector_timer = None
 
         self.paths_sr_query_generator = MatchPathsWithSingleRouteQueryGenerator()
         self.paths_mr_query_generator = MatchPathsWithMultipleRoutesQueryGenerator()
         self.params_query_generator = MatchByParametersQueryGenerator()
+        self.search_keys_query_generator = MatchBySearchKeysQueryGenerator()
+        self.shortest_paths_query_generator = MatchShortestPathsQueryGenerator()
+
+        self.station_cache = LRUCache(cache_max_entries, cache_max_bytes, cache_ttl)
+        self.routes_cache = LRUCache(cache_max_entries, cache_max_bytes, cache_ttl)
 
-        self.station_cache = {}
-        self.routes_cache = {}
+        self.create_indices()
+        self.load_model_versions()
 
     @staticmethod
     def prepare_property(value):
         return value if not value is None else ''
 
-    @staticmethod
-    def prepare_properties(properties):
-        prepared_properties = ('{key}: {value}'.format(
-            key=item[0], value=repr(DbAccessor.prepare_property(item[1])))
-            for item in properties.items())
-        return ', '.join(prepared_properties)
-
     @staticmethod
     def set_properties(entity, properties):
         for item in properties.items():
+            if item[0] in DbAccessor.SEARCH_KEY_PROPERTIES.values():
+                continue
             if not hasattr(entity, item[0]):
                 entity.ensure_properties()[item[0]] = item[1]
             elif not isinstance(getattr(type(entity), item[0], None), property):
                 setattr(entity, item[0], item[1])
 
-    def execute(self, executor, default_value=None):
-        result = default_value
-        try:
-            with self.driver.session() as session:
-                with session.begin_transaction() as transaction:
-                    result = executor(transaction)
-        except (CypherError, DatabaseError) as e:
-            self.logger.error(str(e))
-        except Exception as e:
-            self.logger.error(str(e))
-        return result
+    @staticmethod
+    def get_transition_route_id(transition):
+        return Route.get_domain_id(
+            transition.properties['agent_type'],
+            transition.properties['route_id']
+        )
+
+    def execute(self, executor, default_value=None, access_mode=READ_ACCESS):
+        # generations are captured before the versions are resolved, so entities read
+        # from a version that is swapped out meanwhile are never put into the caches
+        station_generation = self.station_cache.get_generation()
+        routes_generation = self.routes_cache.get_generation()
+
+        def transaction_function(transaction):
+            versions = self.get_active_versions(transaction)
+            return executor(VersionedTransaction(transaction, versions, station_generation, routes_generation))
+
+        def transaction_executor(session):
+            run_transaction = session.read_transaction \
+                if access_mode == READ_ACCESS else session.write_transaction
+            return run_transaction(transaction_function)
+
+        return self.execute_session(transaction_executor, default_value, access_mode)
+
+    def add_version_listener(self, listener):
+        """Registers a callable invoked with the agent type and the model version
+        whenever a model is swapped or updated in place by another process"""
+        self.version_listeners.append(listener)
+
+    def get_active_versions(self, transaction):
+        if time.monotonic() < self.versions_expire_at:
+            return list(self.active_versions.values())
+        return self.refresh_active_versions(transaction)
+
+    def refresh_active_versions(self, transaction):
+        # versions swapped by other processes are picked up once the cached ones expire,
+        # models updated in place by other processes are detected by their fingerprints
+        data = transaction.run(self.MATCH_ACTIVE_MODEL_VERSIONS).data()
+        active_versions = {data_item['agent_type']: data_item['model_version'] for data_item in data}
+        active_fingerprints = {data_item['agent_type']: data_item.get('fingerprint') for data_item in data}
+
+        changed_agent_types = [
+            agent_type for agent_type in set(active_versions) | set(self.active_versions)
+            if active_versions.get(agent_type) != self.active_versions.get(agent_type) or
+            active_fingerprints.get(agent_type) != self.active_fingerprints.get(agent_type)
+        ]
+        for agent_type in changed_agent_types:
+            self.logger.debug('DbAccessor: \'{}\' model version changed to \'{}\''.format(
+                agent_type, active_versions.get(agent_type)))
+            self.invalidate_caches(agent_type)
+
+        self.active_versions = active_versions
+        self.active_fingerprints = active_fingerprints
+        self.versions_expire_at = time.monotonic() + self.versions_ttl
+
+        for agent_type in changed_agent_types:
+            for listener in self.version_listeners:
+                listener(agent_type, active_versions.get(agent_type))
+        return list(active_versions.values())
+
+    def execute_session(self, executor, default_value=None, access_mode=WRITE_ACCESS):
+        # reads failing on an unavailable server are retried on the other
+        # read drivers, the last attempt goes to the write driver
+        retries_count = len(self.read_drivers) if access_mode == READ_ACCESS else 0
+        for attempt in range(retries_count + 1):
+            fallback = attempt > 0 and attempt == retries_count
+            if fallback:
+                session = self.driver.session(access_mode=READ_ACCESS, bookmark=self.bookmark)
+            else:
+                session = self.get_session(access_mode)
+            try:
+                result = executor(session)
+                if access_mode == WRITE_ACCESS:
+                    self.bookmark = session.last_bookmark() or self.bookmark
+                return result
+            except (ServiceUnavailable, SessionExpired) as e:
+                self.logger.error('DbAccessor: server unavailable: {}'.format(e))
+                if not fallback:
+                    self.close_session(access_mode)
+            except (CypherError, DatabaseError) as e:
+                self.logger.error(str(e))
+                self.close_session(access_mode)
+                break
+            except Exception as e:
+                self.logger.error(str(e))
+                self.close_session(access_mode)
+                break
+            finally:
+                if fallback:
+                    session.close()
+        return default_value
+
+    def get_session(self, access_mode):
+        generation, session = getattr(self.sessions, access_mode, (None, None))
+        if session is None or generation != self.sessions_generation:
+            if session is not None:
+                session.close()
+            if access_mode == READ_ACCESS:
+                session = next(self.read_drivers_cycle).session(access_mode=READ_ACCESS, bookmark=self.bookmark)
+            else:
+                session = self.driver.session(access_mode=WRITE_ACCESS)
+            setattr(self.sessions, access_mode, (self.sessions_generation, session))
+        return session
+
+    def close_session(self, access_mode):
+        _, session = getattr(self.sessions, access_mode, (None, None))
+        if session is not None:
+            setattr(self.sessions, access_mode, (None, None))
+            session.close()
+
+    def close_sessions(self):
+        for access_mode in (READ_ACCESS, WRITE_ACCESS):
+            self.close_session(access_mode)
+
+    def renew_sessions(self):
+        self.sessions_generation += 1
 
     def create_indices(self):
         def indices_creator(transaction):
@@ -195,15 +575,21 @@ class DbAccessor:
                 ('Route', 'domain_id'),
                 ('Route', 'route_number'),
                 ('Station', 'domain_id'),
+                ('Station', 'agent_type'),
+                ('Route', 'agent_type'),
+                ('Station', 'model_version'),
+                ('Route', 'model_version'),
+                ('ModelVersion', 'agent_type'),
                 ('Station', 'station_name_ua'),
                 ('Station', 'station_name_ru'),
                 ('Station', 'station_name_en'),
-            ]
+            ] + [('Station', search_key) for search_key in self.SEARCH_KEY_PROPERTIES.values()]
             for index in indices:
                 transaction.run(self.CREATE_INDEX.format(label=index[0], property=index[1]))
-        self.execute(indices_creator)
+        self.execute_session(lambda session: session.write_transaction(indices_creator))
 
-    def create_station(self, station, transaction):
+    @staticmethod
+    def prepare_station_properties(station):
         properties = {
             'domain_id': station.domain_id,
             'agent_type': station.agent_type,
@@ -213,72 +599,106 @@ class DbAccessor:
         if station.get_properties():
             properties.update(station.get_properties())
 
-        station_query = self.CREATE_NODE.format(
-            label='Station',
-            properties=self.prepare_properties(properties))
+        properties.update(DbAccessor.prepare_search_keys(properties))
+        return properties
 
-        transaction.run(station_query)
+    @staticmethod
+    def prepare_search_keys(properties):
+        return {
+            search_key: normalize_name(properties[property_name])
+            for property_name, search_key in DbAccessor.SEARCH_KEY_PROPERTIES.items()
+            if properties.get(property_name)
+        }
 
-    def create_route(self, route, transaction):
+    @staticmethod
+    def prepare_route_properties(route):
         properties = {
             'domain_id': route.domain_id,
             'agent_type': route.agent_type,
             'route_id': route.route_id,
-            'route_number': route.route_number,
-            'active_to_date': self.prepare_property(route.active_to_date),
-            'active_from_date': self.prepare_property(route.active_from_date)
+            'route_number': DbAccessor.prepare_property(route.route_number),
+            'active_to_date': DbAccessor.prepare_property(route.active_to_date),
+            'active_from_date': DbAccessor.prepare_property(route.active_from_date)
         }
 
-        properties.update(route.get_properties())
-        route_query = self.CREATE_NODE.format(
-            label='Route',
-            properties=self.prepare_properties(properties))
-        transaction.run(route_query)
-
-        departure_station_id = None
-        departure_time = None
-        transaction_number = 0
+        if route.get_properties():
+            properties.update(route.get_properties())
+        return properties
 
+    @staticmethod
+    def prepare_route_connections(route):
+        connections = []
         for i, route_point in enumerate(route.route_points):
-            raw_route_start_time = time_to_minutes(
-                route_point.arrival_time
-                if route_point.arrival_time
-                else route_point.departure_time
-            )
-
-            properties = {
-                'agent_type': route.agent_type,
-                'station_number': i,
-                'raw_route_start_time': raw_route_start_time
-            }
-
-            route_connection_query = self.CREATE_ROUTE_CONNECTION.format(
-                route_domain_id=route.domain_id,
-                station_domain_id=Station.get_domain_id(route.agent_type, route_point.station_id),
-                properties=self.prepare_properties(properties))
-            transaction.run(route_connection_query)
-
-            if departure_time and departure_station_id:
-                properties = {
+            raw_route_start_time = route_point.raw_arrival_time \
+                if route_point.raw_arrival_time is not None \
+                else route_point.raw_departure_time or 0
+
+            connections.append({
+                'route_domain_id': route.domain_id,
+                'station_domain_id': Station.get_domain_id(route.agent_type, route_point.station_id),
+                'properties': {
                     'agent_type': route.agent_type,
-                    'route_id': route.route_id,
-                    'departure_time': departure_time,
-                    'arrival_time': route_point.arrival_time,
-                    'transition_number': transaction_number
+                    'station_number': i,
+                    'raw_route_start_time': raw_route_start_time
                 }
+            })
+        return connections
 
-                transition_query = self.CREATE_TRANSITION.format(
-                    from_domain_id=Station.get_domain_id(route.agent_type, departure_station_id),
-                    to_domain_id=Station.get_domain_id(route.agent_type, route_point.station_id),
-                    properties=self.prepare_properties(properties))
-                transaction.run(transition_query)
+    @staticmethod
+    def prepare_transitions(route):
+        transitions = []
+
+        departure_station_id = None
+        departure_time = None
+        transaction_number = 0
 
+        for route_point in route.route_points:
+            if departure_time and departure_station_id:
+                transitions.append({
+                    'from_domain_id': Station.get_domain_id(route.agent_type, departure_station_id),
+                    'to_domain_id': Station.get_domain_id(route.agent_type, route_point.station_id),
+                    'properties': {
+                        'agent_type': route.agent_type,
+                        'route_id': route.route_id,
+                        'departure_time': departure_time,
+                        'arrival_time': DbAccessor.prepare_property(route_point.arrival_time),
+                        'transition_number': transaction_number
+                    }
+                })
                 transaction_number += 1
 
             departure_station_id = route_point.station_id
             departure_time = route_point.departure_time
-
-    def extract_station(self, data_item):
+        return transitions
+
+    def run_batches(self, transaction, query, parameter_name, items, parameters=None):
+        items = iter(items)
+        while True:
+            batch = list(itertools.islice(items, self.batch_size or None))
+            if not batch:
+                break
+            transaction.run(query, dict(parameters or {}, **{parameter_name: batch}))
+
+    def load_model(self, model, model_version, transaction):
+        self.run_batches(
+            transaction, self.CREATE_STATIONS, 'stations',
+            map(self.prepare_station_properties, model.stations.values()),
+            {'model_version': model_version})
+        self.load_routes(model.routes.values(), model_version, transaction)
+
+    def load_routes(self, routes, model_version, transaction):
+        parameters = {'model_version': model_version}
+        self.run_batches(
+            transaction, self.CREATE_ROUTES, 'routes',
+            map(self.prepare_route_properties, routes), parameters)
+        self.run_batches(
+            transaction, self.CREATE_ROUTE_CONNECTIONS, 'connections',
+            itertools.chain.from_iterable(map(self.prepare_route_connections, routes)), parameters)
+        self.run_batches(
+            transaction, self.CREATE_TRANSITIONS, 'transitions',
+            itertools.chain.from_iterable(map(self.prepare_transitions, routes)), parameters)
+
+    def extract_station(self, data_item, transaction):
         properties = data_item['n'].properties
 
         station = self.station_cache.get(properties.get('domain_id'))
@@ -288,25 +708,63 @@ class DbAccessor:
         station = Station(properties['agent_type'], properties['station_id'])
         self.set_properties(station, properties)
 
-        self.station_cache[station.domain_id] = station
+        self.station_cache.put(
+            station.agent_type, station.domain_id, station, transaction.station_generation)
         return station
 
-    def extract_route(self, data_item, transaction, node_name='n'):
-        properties = data_item[node_name].properties
+    def extract_routes(self, nodes, transaction):
+        routes = {}
+        missing_routes = []
 
-        route = self.routes_cache.get(properties.get('domain_id'))
-        if route:
-            return route
+        for node in nodes:
+            properties = node.properties
+            domain_id = properties.get('domain_id')
+            if domain_id in routes:
+                continue
 
-        route = Route(properties['agent_type'], properties['route_id'])
-        self.set_properties(route, properties)
+            route = self.routes_cache.get(domain_id)
+            if not route:
+                route = Route(properties['agent_type'], properties['route_id'])
+                self.set_properties(route, properties)
+                missing_routes.append(route)
+            routes[domain_id] = route
 
+        if missing_routes:
+            self.load_route_points(missing_routes, transaction)
+            for route in missing_routes:
+                self.routes_cache.put(
+                    route.agent_type, route.domain_id, route, transaction.routes_generation)
+
+        return routes
+
+    def extract_route_list(self, data, transaction, node_name='n'):
+        routes = self.extract_routes((data_item[node_name] for data_item in data), transaction)
+        return [routes[data_item[node_name].properties.get('domain_id')] for data_item in data]
+
+    def extract_route(self, data_item, transaction, node_name='n'):
+        node = data_item[node_name]
+        return self.extract_routes([node], transaction)[node.properties.get('domain_id')]
+
+    def load_route_points(self, routes, transaction):
         result = transaction.run(
-            self.MATCH_TRANSITIONS_BY_ROUTE_ID,
-            {'route_id': route.route_id}
+            self.MATCH_TRANSITIONS_BY_ROUTES,
+            {'routes': [
+                {'domain_id': route.domain_id,
+                 'agent_type': route.agent_type,
+                 'route_id': route.route_id}
+                for route in routes
+            ]}
         )
 
-        data = result.data()
+        transitions = {}
+        for data_item in result.data():
+            transitions.setdefault(data_item['route_domain_id'], []).append(data_item)
+
+        for route in routes:
+            self.build_route_points(route, transitions.get(route.domain_id))
+
+    @staticmethod
+    def build_route_points(route, data):
         if data:
             arrival_time = ''
             for i, data_item in enumerate(data):
@@ -315,10 +773,11 @@ class DbAccessor:
 
                 route_point = RoutePoint(route.agent_type, route.route_id, station_id)
                 route_point.arrival_time = arrival_time
-                route_point.departure_time = properties['departure_time']
+                route_point.departure_time = properties.get('departure_time', '')
                 route.add_route_point(route_point)
 
-                arrival_time = properties['arrival_time']
+                # empty times are not stored by the offline importer
+                arrival_time = properties.get('arrival_time', '')
 
                 if len(data) - 1 == i:
                     station_id = data_item['arrival_station_id']
@@ -328,16 +787,13 @@ class DbAccessor:
                     route_point.departure_time = ''
                     route.add_route_point(route_point)
 
-        self.routes_cache[route.domain_id] = route
-        return route
-
     def __get_station(self, domain_id, transaction):
         result = transaction.run(
             self.MATCH_STATION_BY_DOMAIN_ID,
             {'domain_id': domain_id})
         if result:
             data = result.data()
-            return self.extract_station(data[0]) if data else None
+            return self.extract_station(data[0], transaction) if data else None
         return None
 
     def get_station(self, domain_id):
@@ -346,14 +802,58 @@ class DbAccessor:
             return station
         return self.execute(lambda transaction: self.__get_station(domain_id, transaction))
 
+    def __get_stations(self, domain_ids, transaction):
+        stations = {}
+        missing_domain_ids = []
+
+        for domain_id in domain_ids:
+            station = self.station_cache.get(domain_id)
+            if station:
+                stations[domain_id] = station
+            else:
+                missing_domain_ids.append(domain_id)
+
+        if missing_domain_ids:
+            result = transaction.run(
+                self.MATCH_STATIONS_BY_DOMAIN_IDS,
+                {'domain_ids': missing_domain_ids})
+            for data_item in result.data() or []:
+                station = self.extract_station(data_item, transaction)
+                stations[station.domain_id] = station
+        return stations
+
+    def get_stations(self, domain_ids):
+        stations = self.execute(lambda transaction: self.__get_stations(set(domain_ids), transaction), {})
+        return [stations.get(domain_id) for domain_id in domain_ids]
+
+    def hydrate_routes(self, nodes, domain_ids, transaction):
+        nodes = list(nodes)
+        routes = {}
+        missing_domain_ids = []
+
+        known_domain_ids = {node.properties.get('domain_id') for node in nodes}
+        for domain_id in set(domain_ids) - known_domain_ids:
+            route = self.routes_cache.get(domain_id)
+            if route:
+                routes[domain_id] = route
+            else:
+                missing_domain_ids.append(domain_id)
+
+        if missing_domain_ids:
+            result = transaction.run(
+                self.MATCH_ROUTES_BY_DOMAIN_IDS,
+                {'domain_ids': missing_domain_ids})
+            nodes.extend(data_item['n'] for data_item in result.data() or [])
+
+        if nodes:
+            routes.update(self.extract_routes(nodes, transaction))
+        return routes
+
+    def __get_routes(self, domain_ids, transaction):
+        return self.hydrate_routes([], domain_ids, transaction)
+
     def __get_route(self, domain_id, transaction):
-        result = transaction.run(
-            self.MATCH_ROUTE_BY_DOMAIN_ID,
-            {'domain_id': domain_id})
-        if result:
-            data = result.data()
-            return self.extract_route(data[0], transaction) if data else None
-        return None
+        return self.__get_routes([domain_id], transaction).get(domain_id)
 
     def get_route(self, domain_id):
         route = self.routes_cache.get(domain_id)
@@ -361,26 +861,37 @@ class DbAccessor:
             return route
         return self.execute(lambda transaction: self.__get_route(domain_id, transaction))
 
+    def get_routes(self, domain_ids):
+        routes = self.execute(lambda transaction: self.__get_routes(domain_ids, transaction), {})
+        return [routes.get(domain_id) for domain_id in domain_ids]
+
     def find_stations(self, station_names, search_mode, limit):
+        if self.search_keys_query_generator.supports(search_mode):
+            query_generator = self.search_keys_query_generator
+            property_names = list(self.SEARCH_KEY_PROPERTIES.values())
+        else:
+            query_generator = self.params_query_generator
+            property_names = list(self.SEARCH_KEY_PROPERTIES.keys())
+
         def stations_getter(transaction):
             stations = []
 
-            stations_query = self.params_query_generator.generate_query(
+            stations_query = query_generator.generate_query(
                 label='Station', search_mode=search_mode,
-                property_names=['station_name_ua', 'station_name_en', 'station_name_ru'],
-                property_values=station_names
+                property_names=property_names,
+                values_count=len(station_names)
             )
 
             if stations_query:
-                result = transaction.run(stations_query, {'limit': limit})
+                result = transaction.run(
+                    stations_query,
+                    query_generator.prepare_parameters(station_names, limit)
+                )
                 data = result.data()
                 if data:
-                    stations.extend(map(lambda data_item: self.extract_station(data_item), data))
-
-                    for station in stations:
-                        self.station_cache[station.domain_id] = station
+                    stations.extend(map(lambda data_item: self.extract_station(data_item, transaction), data))
 
-            return stations
+            return stations[:limit] if limit is not None else stations
 
         return self.execute(stations_getter, [])
 
@@ -391,16 +902,17 @@ class DbAccessor:
             routes_query = self.params_query_generator.generate_query(
                 label='Route', search_mode=search_mode,
                 property_names=['route_number'],
-                property_values=route_numbers
+                values_count=len(route_numbers)
             )
 
             if routes_query:
-                result = transaction.run(routes_query, {'limit': limit})
+                result = transaction.run(
+                    routes_query,
+                    self.params_query_generator.prepare_parameters(route_numbers, limit)
+                )
                 data = result.data()
                 if data:
-                    routes.extend(
-                        map(lambda data_item: self.extract_route(data_item, transaction), data)
-                    )
+                    routes.extend(self.extract_route_list(data, transaction))
             return routes
 
         return self.execute(routes_getter, [])
@@ -415,126 +927,450 @@ class DbAccessor:
             )
             data = result.data()
             if data:
-                routes.extend(
-                    map(lambda data_item: self.extract_route(data_item, transaction), data)
-                )
+                routes.extend(self.extract_route_list(data, transaction))
             return routes
 
         return self.execute(routes_getter, [])
 
-    def find_paths_with_single_route(self, station_ids, limit):
-
-        def routes_getter(transaction):
-            paths = []
-
-            stations_count = len(station_ids)
-            paths_query = self.paths_sr_query_generator.generate_query(station_ids)
+    def run_paths_with_single_route(self, station_ids, limit, transaction):
+        paths_query = self.paths_sr_query_generator.generate_query(station_ids)
 
-            parameters = {'limit': limit}
-            for i, ids in enumerate(station_ids):
-                parameters['station_ids_{}'.format(i + 1)] = ids
+        parameters = {'limit': limit}
+        for i, ids in enumerate(station_ids):
+            parameters['station_ids_{}'.format(i + 1)] = ids
 
-            result = transaction.run(paths_query, parameters)
-            data = result.data()
-            if data:
-                for data_item in data:
-                    path = Path()
-                    node_name = 'n'
-                    first_connection = data_item['r1']
-                    second_connection = data_item['r{}'.format(stations_count)]
+        return transaction.run(paths_query, parameters)
 
-                    route = self.extract_route(data_item, transaction, node_name=node_name)
-                    departure_route_point = first_connection.properties['station_number']
-                    arrival_route_point = second_connection.properties['station_number']
-                    path.add_path_item(PathItem(route, departure_route_point, arrival_route_point))
-                    paths.append(path)
-            return paths
+    def query_paths_with_single_route(self, station_ids, limit, transaction):
+        result = self.run_paths_with_single_route(station_ids, limit, transaction)
+        return self.prepare_single_route_paths(result.data() or [], len(station_ids))
 
-        return self.execute(routes_getter, [])
+    def query_paths_with_single_route_by_pairs(self, queries, transaction):
+        # Cypher 3.x has no subqueries to limit the matches of each unwound pair,
+        # so a limited statement is run per pair, the driver pipelines the
+        # statements of a transaction until the first result is consumed
+        results = [
+            self.run_paths_with_single_route(station_ids, limit, transaction)
+            for station_ids, limit in queries
+        ]
+        return [self.prepare_single_route_paths(result.data() or [], 2) for result in results]
 
-    def find_paths_with_multiple_routes(self, station_ids, limit):
+    @staticmethod
+    def prepare_single_route_paths(data, stations_count):
+        rows = [
+            (data_item['r1'], data_item['n'], data_item['r{}'.format(stations_count)])
+            for data_item in data
+        ]
 
-        def routes_getter(transaction):
+        def paths_builder(routes):
             paths = []
+            for first_connection, node, second_connection in rows:
+                path = Path()
+                route = routes[node.properties.get('domain_id')]
+                departure_route_point = first_connection.properties['station_number']
+                arrival_route_point = second_connection.properties['station_number']
+                path.add_path_item(PathItem(route, departure_route_point, arrival_route_point))
+                paths.append(path)
+            return paths
 
-            transfers_count = len(station_ids) - 2
-            paths_query = self.paths_mr_query_generator.generate_query(station_ids)
+        return [row[1] for row in rows], [], paths_builder
 
-            parameters = {'limit': limit}
-            for i, ids in enumerate(station_ids):
-                parameters['station_ids_{}'.format(i + 1)] = ids
+    def query_paths_with_multiple_routes(self, station_ids, limit, transaction):
+        transfers_count = len(station_ids) - 2
+        paths_query = self.paths_mr_query_generator.generate_query(station_ids)
 
-            result = transaction.run(paths_query, parameters)
-            data = result.data()
-            if data:
-                for data_item in data:
-                    path = Path()
-                    for i in range(transfers_count + 1):
-                        node_name = 'n{}'.format(i + 1)
-                        first_connection = data_item['r{}'.format(2 * i + 1)]
-                        second_connection = data_item['r{}'.format(2 * i + 2)]
-
-                        route = self.extract_route(data_item, transaction, node_name=node_name)
-                        departure_route_point = first_connection.properties['station_number']
-                        arrival_route_point = second_connection.properties['station_number']
-                        path.add_path_item(PathItem(route, departure_route_point, arrival_route_point))
-                    paths.append(path)
-            return paths
+        parameters = {'limit': limit}
+        for i, ids in enumerate(station_ids):
+            parameters['station_ids_{}'.format(i + 1)] = ids
 
-        return self.execute(routes_getter, [])
+        result = transaction.run(paths_query, parameters)
+        data = result.data() or []
+        node_names = ['n{}'.format(i + 1) for i in range(transfers_count + 1)]
 
-    def find_shortest_paths(self, departure_station_ids, arrival_station_ids,
-                            max_transitions, limit):
-        def routes_getter(transaction):
+        def paths_builder(routes):
             paths = []
-            routes_cache = {}
+            for data_item in data:
+                path = Path()
+                for i, node_name in enumerate(node_names):
+                    first_connection = data_item['r{}'.format(2 * i + 1)]
+                    second_connection = data_item['r{}'.format(2 * i + 2)]
 
-            result = transaction.run(
-                self.MATCH_SHORTEST_PATHS.format(max_transitions=max_transitions),
-                {'departure_station_ids': departure_station_ids,
-                 'arrival_station_ids': arrival_station_ids,
-                 'limit': limit}
-            )
-            data = result.data()
-            if data:
-                for data_item in data:
-                    path = Path()
-                    transitions = data_item['transitions']
-                    for transition in transitions:
-                        agent_type = transition.properties['agent_type']
-                        route_id = Route.get_domain_id(agent_type, transition.properties['route_id'])
-                        transition_number = int(transition.properties['transition_number'])
-
-                        if route_id in routes_cache:
-                            route = routes_cache[route_id]
-                        else:
-                            route = self.__get_route(route_id, transaction)
-                            routes_cache[route_id] = route
-
-                        departure_route_point = transition_number
-                        arrival_route_point = transition_number + 1
-                        path.add_path_item(PathItem(route, departure_route_point, arrival_route_point))
-                    paths.append(path)
+                    route = routes[data_item[node_name].properties.get('domain_id')]
+                    departure_route_point = first_connection.properties['station_number']
+                    arrival_route_point = second_connection.properties['station_number']
+                    path.add_path_item(PathItem(route, departure_route_point, arrival_route_point))
+                paths.append(path)
             return paths
 
-        return self.execute(routes_getter, [])
+        nodes = [data_item[node_name] for data_item in data for node_name in node_names]
+        return nodes, [], paths_builder
 
-    def build_model(self, model):
-        def model_builder(transaction):
+    def query_shortest_paths(self, departure_station_ids, arrival_station_ids,
+                             max_transitions, limit, transaction):
+        result = transaction.run(
+            self.shortest_paths_query_generator.generate_query(max_transitions),
+            {'departure_station_ids': departure_station_ids,
+             'arrival_station_ids': arrival_station_ids,
+             'limit': limit}
+        )
+        data = result.data() or []
+
+        def paths_builder(routes):
+            paths = []
+            for data_item in data:
+                path = Path()
+                transitions = data_item['transitions']
+                for transition in transitions:
+                    route = routes[self.get_transition_route_id(transition)]
+                    transition_number = int(transition.properties['transition_number'])
+
+                    departure_route_point = transition_number
+                    arrival_route_point = transition_number + 1
+                    path.add_path_item(PathItem(route, departure_route_point, arrival_route_point))
+                paths.append(path)
+            return paths
 
-            self.logger.debug('DbAccessor: building \'{}\' model'.format(model.agent_type))
+        domain_ids = [
+            self.get_transition_route_id(transition)
+            for data_item in data for transition in data_item['transitions']
+        ]
+        return [], domain_ids, paths_builder
+
+    def build_paths(self, prepared_queries, transaction):
+        routes = self.hydrate_routes(
+            itertools.chain.from_iterable(prepared_query[0] for prepared_query in prepared_queries),
+            itertools.chain.from_iterable(prepared_query[1] for prepared_query in prepared_queries),
+            transaction
+        )
+        return [prepared_query[2](routes) for prepared_query in prepared_queries]
 
-            self.remove_model(model.agent_type, transaction)
-            self.station_cache.clear()
-            for station in model.stations.values():
-                self.create_station(station, transaction)
-            for route in model.routes.values():
-                self.create_route(route, transaction)
+    def find_paths_with_single_route(self, station_ids, limit):
+        return self.execute(lambda transaction: self.build_paths(
+            [self.query_paths_with_single_route(station_ids, limit, transaction)], transaction
+        )[0], [])
 
-            self.logger.debug('DbAccessor: built \'{}\' model'.format(model.agent_type))
+    def find_paths_with_multiple_routes(self, station_ids, limit):
+        return self.execute(lambda transaction: self.build_paths(
+            [self.query_paths_with_multiple_routes(station_ids, limit, transaction)], transaction
+        )[0], [])
 
-        self.execute(model_builder)
+    def find_shortest_paths(self, departure_station_ids, arrival_station_ids,
+                            max_transitions, limit):
+        return self.execute(lambda transaction: self.build_paths(
+            [self.query_shortest_paths(
+                departure_station_ids, arrival_station_ids, max_transitions, limit, transaction
+            )], transaction
+        )[0], [])
+
+    def find_paths_many(self, queries):
+        def paths_getter(transaction):
+            prepared_queries = [None] * len(queries)
+
+            pairs_indices = [
+                i for i, query in enumerate(queries)
+                if query[0] == 'SIMPLE' and len(query[1]) == 2 and all(query[1])
+            ]
+            for i, prepared_query in zip(pairs_indices, self.query_paths_with_single_route_by_pairs(
+                    [(queries[i][1], queries[i][3]) for i in pairs_indices], transaction)):
+                prepared_queries[i] = prepared_query
+
+            for i, (search_mode, station_ids, max_transitions, limit) in enumerate(queries):
+                if prepared_queries[i] is not None:
+                    continue
+                if search_mode == 'SIMPLE':
+                    prepared_queries[i] = self.query_paths_with_single_route(
+                        station_ids, limit, transaction)
+                elif search_mode == 'TRANSFERS':
+                    prepared_queries[i] = self.query_paths_with_multiple_routes(
+                        station_ids, limit, transaction)
+                elif search_mode == 'TRANSITIONS':
+                    prepared_queries[i] = self.query_shortest_paths(
+                        station_ids[0], station_ids[-1], max_transitions, limit, transaction)
+                else:
+                    prepared_queries[i] = ([], [], lambda routes: [])
+
+            return self.build_paths(prepared_queries, transaction)
+
+        if not queries:
+            return []
+        return self.execute(paths_getter, [[] for _ in queries])
+
+    def count_entities(self, model_version, transaction, relationship_types=('ROUTE_CONNECTION', 'TRANSITION')):
+        counts = {}
+        for label in ('Station', 'Route'):
+            data = transaction.run(
+                self.COUNT_NODES.format(label=label), {'model_version': model_version}).data()
+            counts[label] = data[0]['count'] if data else 0
+        for relationship_type in relationship_types:
+            data = transaction.run(
+                self.COUNT_RELATIONSHIPS.format(type=relationship_type), {'model_version': model_version}).data()
+            counts[relationship_type] = data[0]['count'] if data else 0
+        return counts
+
+    def update_model_fingerprint(self, agent_type, model_version, previous_fingerprint, fingerprint, transaction):
+        # succeeds only if the active version still holds the previous model,
+        # the version node stays locked until the transaction ends
+        return bool(transaction.run(self.UPDATE_MODEL_FINGERPRINT, {
+            'agent_type': agent_type,
+            'model_version': model_version,
+            'previous_fingerprint': previous_fingerprint,
+            'fingerprint': fingerprint
+        }).data())
+
+    def verify_model(self, model, model_version, transaction):
+        counts = self.count_entities(model_version, transaction)
+        expected_counts = {
+            'Station': len(model.stations),
+            'Route': len(model.routes),
+            'ROUTE_CONNECTION': sum(len(route.route_points) for route in model.routes.values()),
+            'TRANSITION': sum(len(self.prepare_transitions(route)) for route in model.routes.values())
+        }
+        if counts != expected_counts:
+            self.logger.error('DbAccessor: \'{}\' model version \'{}\' verification failed: '
+                              'stored {}, expected {}'.format(
+                                  model.agent_type, model_version, counts, expected_counts))
+            return False
+        return True
+
+    def apply_model_diff(self, diff, model_version, transaction):
+        parameters = {'model_version': model_version}
+        rebuilt_routes = diff.removed_routes + [old_route for old_route, _ in diff.stops_changed_routes]
+        created_routes = diff.added_routes + [route for _, route in diff.stops_changed_routes]
+
+        self.run_batches(
+            transaction, self.DELETE_TRANSITIONS, 'transitions',
+            ({'from_domain_id': transition['from_domain_id'],
+              'to_domain_id': transition['to_domain_id'],
+              'route_id': transition['properties']['route_id']}
+             for route in rebuilt_routes for transition in self.prepare_transitions(route)),
+            parameters)
+        self.run_batches(
+            transaction, self.DELETE_ROUTES, 'domain_ids',
+            (route.domain_id for route in rebuilt_routes), parameters)
+        self.run_batches(
+            transaction, self.DELETE_STATIONS, 'domain_ids',
+            (station.domain_id for station in diff.removed_stations), parameters)
+
+        self.run_batches(
+            transaction, self.UPDATE_STATIONS, 'stations',
+            (self.prepare_station_properties(station) for _, station in diff.changed_stations),
+            parameters)
+        self.run_batches(
+            transaction, self.CREATE_STATIONS, 'stations',
+            map(self.prepare_station_properties, diff.added_stations), parameters)
+
+        self.run_batches(
+            transaction, self.UPDATE_ROUTES, 'routes',
+            (self.prepare_route_properties(route) for _, route in diff.properties_changed_routes),
+            parameters)
+        self.load_routes(created_routes, model_version, transaction)
+
+    def discard_cached_entities(self, diff):
+        for station in itertools.chain(
+                diff.removed_stations, (station for _, station in diff.changed_stations)):
+            self.station_cache.discard(station.domain_id)
+        for route in itertools.chain(
+                diff.removed_routes, (route for _, route in diff.changed_routes)):
+            self.routes_cache.discard(route.domain_id)
+
+    def load_model_versions(self):
+        def versions_loader(session):
+            for data_item in session.run(self.MATCH_UNVERSIONED_AGENT_TYPES).data():
+                self.adopt_unversioned_model(data_item['agent_type'], session)
+            self.retire_stale_staged_versions(session)
+            return session.read_transaction(self.refresh_active_versions)
+
+        self.execute_session(versions_loader)
+        self.collect_garbage()
+
+    def retire_stale_staged_versions(self, session):
+        for data_item in session.run(
+                self.RETIRE_STALE_STAGED_MODEL_VERSIONS, {'stage_lease': int(self.stage_lease * 1000)}).data():
+            self.logger.debug('DbAccessor: retired stale staged \'{}\' model version'.format(
+                data_item['agent_type']))
+
+    def adopt_unversioned_model(self, agent_type, session):
+        data = session.run(
+            self.ADOPT_UNVERSIONED_MODEL,
+            {'agent_type': agent_type, 'model_version': self.generate_model_version(agent_type)}).data()
+        model_version = data[0]['model_version']
+        self.logger.debug('DbAccessor: adopting unversioned \'{}\' model as version \'{}\''.format(
+            agent_type, model_version))
+
+        while True:
+            data = session.run(self.MATCH_UNVERSIONED_STATIONS, {
+                'agent_type': agent_type, 'limit': self.batch_size or self.DEFAULT_BATCH_SIZE}).data()
+            if not data:
+                break
+            session.run(self.ADOPT_UNVERSIONED_STATIONS, {
+                'model_version': model_version,
+                'stations': [
+                    {'id': data_item['id'], 'search_keys': self.prepare_search_keys(data_item['n'].properties)}
+                    for data_item in data
+                ]
+            })
+
+        while self.run_bounded(
+                session, self.ADOPT_UNVERSIONED_NODES.format(label='Route'),
+                {'agent_type': agent_type, 'model_version': model_version}):
+            pass
+
+    def run_bounded(self, session, query, parameters):
+        data = session.run(query, dict(parameters, limit=self.batch_size or self.DEFAULT_BATCH_SIZE)).data()
+        return data[0]['count'] if data else 0
 
-    def remove_model(self, agent_type, transaction):
-        transaction.run(self.DELETE_RELATIONSHIP, {'agent_type': agent_type})
-        transaction.run(self.DELETE_NODE, {'agent_type': agent_type})
+    @staticmethod
+    def generate_model_version(agent_type):
+        return '{}:{}'.format(agent_type, int(time.time() * 1000))
+
+    def stage_model(self, model, fingerprint, session):
+        agent_type = model.agent_type
+        model_version = self.generate_model_version(agent_type)
+        parameters = {'agent_type': agent_type, 'model_version': model_version, 'fingerprint': fingerprint}
+
+        self.logger.debug('DbAccessor: staging \'{}\' model version \'{}\''.format(agent_type, model_version))
+        if not session.run(
+                self.STAGE_MODEL_VERSION, dict(parameters, stage_lease=int(self.stage_lease * 1000))).data():
+            self.logger.error('DbAccessor: \'{}\' model is being staged by another process'.format(agent_type))
+            return False
+
+        activated = False
+        stopped = threading.Event()
+        threading.Thread(target=self.renew_staged_version, args=(parameters, stopped), daemon=True).start()
+        try:
+            self.load_model(model, model_version, session)
+            if self.verify_model(model, model_version, session):
+                with session.begin_transaction() as transaction:
+                    activated = bool(transaction.run(self.ACTIVATE_MODEL_VERSION, parameters).data())
+        finally:
+            stopped.set()
+            if not activated:
+                session.run(self.RETIRE_STAGED_MODEL_VERSION, parameters)
+
+        if activated:
+            self.bookmark = session.last_bookmark() or self.bookmark
+            self.renew_sessions()
+            # the dictionaries are replaced, readers may iterate them meanwhile
+            self.active_versions = dict(self.active_versions, **{agent_type: model_version})
+            self.active_fingerprints = dict(self.active_fingerprints, **{agent_type: parameters['fingerprint']})
+            self.invalidate_caches(agent_type)
+            self.logger.debug('DbAccessor: activated \'{}\' model version \'{}\''.format(
+                agent_type, model_version))
+        return activated
+
+    def renew_staged_version(self, parameters, stopped):
+        try:
+            while not stopped.wait(self.stage_lease / 3):
+                data = self.execute_session(
+                    lambda session: session.run(self.RENEW_STAGED_MODEL_VERSION, parameters).data())
+                if data == []:
+                    # the lease expired and the version was retired by a collector
+                    self.logger.error('DbAccessor: \'{}\' model version \'{}\' lost its stage lease'.format(
+                        parameters['agent_type'], parameters['model_version']))
+                    return
+        finally:
+            self.close_sessions()
+
+    def build_model(self, model, previous_model=None):
+        model_version = self.active_versions.get(model.agent_type)
+        fingerprint = get_model_fingerprint(model)
+
+        if self.batch_size and model_version is not None and previous_model is not None:
+            previous_fingerprint = get_model_fingerprint(previous_model)
+
+            def model_updater(transaction):
+                if not self.update_model_fingerprint(
+                        model.agent_type, model_version, previous_fingerprint, fingerprint, transaction):
+                    return None
+                diff = ModelDiff.compare(previous_model, model)
+                self.logger.debug('DbAccessor: applying \'{}\' model changes: {}'.format(
+                    model.agent_type, diff))
+                self.apply_model_diff(diff, model_version, transaction)
+                self.logger.debug('DbAccessor: applied \'{}\' model changes'.format(model.agent_type))
+                return diff
+
+            diff = self.execute(model_updater, access_mode=WRITE_ACCESS)
+            if diff is not None:
+                self.active_fingerprints = dict(self.active_fingerprints, **{model.agent_type: fingerprint})
+                self.renew_sessions()
+                self.discard_cached_entities(diff)
+                return
+
+        activated = self.execute_session(lambda session: self.stage_model(model, fingerprint, session), False)
+        self.collect_garbage()
+        if not activated:
+            raise ModelStoreException(model.agent_type)
+
+    def collect_garbage(self):
+        self.collector.submit(self.run_collector)
+
+    def run_collector(self):
+        try:
+            self.execute_session(self.collect_retired_versions)
+        finally:
+            self.close_sessions()
+
+    def collect_retired_versions(self, session):
+        # retired versions are kept for a grace period, so that transactions
+        # of other processes started before the swap can still read them
+        self.retire_stale_staged_versions(session)
+        grace_period = int(self.retired_versions_grace_period * 1000)
+        for data_item in session.run(self.MATCH_RETIRED_MODEL_VERSIONS, {'grace_period': grace_period}).data():
+            agent_type, model_version = data_item['agent_type'], data_item['model_version']
+            self.delete_in_batches(
+                session, 'model_version', model_version,
+                '\'{}\' model version \'{}\''.format(agent_type, model_version),
+                guard=self.LOCK_RETIRED_MODEL_VERSION,
+                parameters={'agent_type': agent_type, 'grace_period': grace_period})
+            session.run(self.RELEASE_MODEL_VERSION, {'agent_type': agent_type, 'model_version': model_version})
+
+        data = session.run(self.COUNT_RETIRED_MODEL_VERSIONS).data()
+        if data and data[0]['count']:
+            self.schedule_garbage_collection()
+
+    def schedule_garbage_collection(self):
+        if self.collector_timer is None or not self.collector_timer.is_alive():
+            self.collector_timer = threading.Timer(self.retired_versions_grace_period, self.collect_garbage)
+            self.collector_timer.daemon = True
+            self.collector_timer.start()
+
+    def delete_in_batches(self, session, property_name, value, description, guard='', parameters=None):
+        deleted_counts = []
+        for query_pattern, entities_name in self.DELETE_BATCHES:
+            query = guard + query_pattern.format(property=property_name)
+            deleted_count = 0
+            while True:
+                count = self.run_bounded(session, query, dict(parameters or {}, value=value))
+                if not count:
+                    break
+                deleted_count += count
+                self.logger.debug('DbAccessor: removing {}: {} {} deleted'.format(
+                    description, deleted_count, entities_name))
+            deleted_counts.append('{} {}'.format(deleted_count, entities_name))
+
+        self.logger.debug('DbAccessor: removed {}: {}'.format(description, ', '.join(deleted_counts)))
+
+    def remove_model(self, agent_type):
+        def model_remover(session):
+            session.run(self.DELETE_MODEL_VERSION, {'agent_type': agent_type})
+            self.active_versions = {
+                key: value for key, value in self.active_versions.items() if key != agent_type}
+            self.active_fingerprints = {
+                key: value for key, value in self.active_fingerprints.items() if key != agent_type}
+            self.invalidate_caches(agent_type)
+            self.delete_in_batches(session, 'agent_type', agent_type, '\'{}\' model'.format(agent_type))
+
+        self.execute_session(model_remover)
+
+    def invalidate_caches(self, agent_type):
+        self.station_cache.invalidate(agent_type)
+        self.routes_cache.invalidate(agent_type)
+
+    def get_agent_types(self):
+        return list(self.active_versions)
+
+    def get_cache_stats(self):
+        return {
+            'stations': self.station_cache.stats,
+            'routes': self.routes_cache.stats
+        }
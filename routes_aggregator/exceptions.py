@@ -30,6 +30,40 @@ class AbsentPathItemException(DomainModelException):
         )
 
 
+class ModelFormatException(BaseException):
+    def __init__(self, reason):
+        self.reason = reason
+        super().__init__(
+            'malformed binary model: {}'.format(
+                self.reason
+            )
+        )
+
+
+class ModelChecksumException(BaseException):
+    def __init__(self, object_name, expected_checksum, actual_checksum):
+        self.object_name = object_name
+        self.expected_checksum = expected_checksum
+        self.actual_checksum = actual_checksum
+        super().__init__(
+            'checksum mismatch for {}: expected {}, got {}'.format(
+                self.object_name,
+                self.expected_checksum,
+                self.actual_checksum
+            )
+        )
+
+
+class ModelStoreException(BaseException):
+    def __init__(self, agent_type):
+        self.agent_type = agent_type
+        super().__init__(
+            'unable to store \'{}\' model'.format(
+                self.agent_type
+            )
+        )
+
+
 class ApplicationException(Exception):
     def __init__(self):
         super().__init__('application internal exception')
\ No newline at end of file
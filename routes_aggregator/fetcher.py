@@ -0,0 +1,114 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, as_completed, wait
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from routes_aggregator.http_cache import CachingAdapter
+
+
+class RateLimiter:
+    """Token bucket limiting the rate of requests sent to every host"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate or 0)
+
+        self.__buckets = {}
+        self.__lock = threading.Lock()
+
+    def acquire(self, host):
+        if not self.rate:
+            return
+
+        while True:
+            with self.__lock:
+                now = time.monotonic()
+                tokens, updated_at = self.__buckets.get(host, (self.capacity, now))
+                tokens = min(self.capacity, tokens + (now - updated_at) * self.rate)
+                if tokens >= 1:
+                    self.__buckets[host] = (tokens - 1, now)
+                    return
+                self.__buckets[host] = (tokens, now)
+                delay = (1 - tokens) / self.rate
+            time.sleep(delay)
+
+
+class Fetcher:
+
+    DEFAULT_WORKERS_COUNT = 8
+    DEFAULT_REQUEST_RATE = 10.0
+    DEFAULT_RETRIES_COUNT = 3
+    DEFAULT_BACKOFF_FACTOR = 0.5
+
+    def __init__(self, session, logger, workers_count=DEFAULT_WORKERS_COUNT,
+                 request_rate=DEFAULT_REQUEST_RATE, retries_count=DEFAULT_RETRIES_COUNT,
+                 backoff_factor=DEFAULT_BACKOFF_FACTOR, adapter_factory=HTTPAdapter):
+        self.session = session
+        self.logger = logger
+
+        self.retries_count = retries_count
+        self.backoff_factor = backoff_factor
+        self.rate_limiter = RateLimiter(request_rate)
+        self.executor = ThreadPoolExecutor(max_workers=workers_count)
+
+        self.adapter = adapter_factory(pool_connections=workers_count, pool_maxsize=workers_count)
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+
+    def is_cached(self, url):
+        return isinstance(self.adapter, CachingAdapter) and self.adapter.is_cached(url)
+
+    def fetch(self, url):
+        response = None
+        for attempt in range(self.retries_count + 1):
+            # responses served by the cache do not take a token of the host
+            if not self.is_cached(url):
+                self.rate_limiter.acquire(urlsplit(url).netloc)
+            try:
+                response = self.session.get(url)
+                if response.ok or getattr(response, 'from_cache', False):
+                    return response
+                self.logger.debug('Fetcher: Response state unacceptable: {} {} ({})'.format(
+                    response.status_code, response.reason, url)
+                )
+            except requests.RequestException as e:
+                if attempt == self.retries_count and response is None:
+                    raise
+                self.logger.debug('Fetcher: Request failed: {} ({})'.format(e, url))
+
+            if attempt < self.retries_count:
+                time.sleep(self.backoff_factor * 2 ** attempt)
+        return response
+
+    def submit(self, url):
+        return self.executor.submit(self.fetch, url)
+
+    def fetch_all(self, urls):
+        return list(self.executor.map(self.fetch, urls))
+
+    def fetch_each(self, tasks, url_getter):
+        futures = {self.submit(url_getter(task)): task for task in tasks}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+    def crawl(self, tasks, url_getter, handler):
+        pending = {}
+
+        def submit(task):
+            pending[self.submit(url_getter(task))] = task
+
+        for task in tasks:
+            submit(task)
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                task = pending.pop(future)
+                for new_task in handler(task, future.result()) or []:
+                    submit(new_task)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
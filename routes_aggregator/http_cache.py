@@ -0,0 +1,144 @@
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+from requests.adapters import HTTPAdapter
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+
+
+class ResponseCache:
+    """On-disk cache of compressed GET responses keyed by URL, entries younger
+    than max_age seconds are fresh and served without revalidation"""
+
+    CACHED_HEADERS = ['Content-Type', 'ETag', 'Last-Modified']
+
+    def __init__(self, base_path, offline=False, max_age=None):
+        self.base_path = base_path
+        self.offline = offline
+        self.max_age = max_age
+
+    def prepare_path(self, url):
+        key = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.base_path, key[:2], key + '.gz')
+
+    def load(self, url):
+        try:
+            with gzip.open(self.prepare_path(url), 'rb') as fileobj:
+                metadata = json.loads(fileobj.readline().decode('utf-8'))
+                return metadata, fileobj.read()
+        except (OSError, ValueError):
+            return None
+
+    def is_fresh(self, url):
+        if not self.max_age:
+            return False
+        try:
+            return time.time() - os.path.getmtime(self.prepare_path(url)) < self.max_age
+        except OSError:
+            return False
+
+    def touch(self, url):
+        try:
+            os.utime(self.prepare_path(url))
+        except OSError:
+            pass
+
+    def save(self, url, response):
+        metadata = {
+            'url': url,
+            'status_code': response.status_code,
+            'reason': response.reason,
+            'encoding': response.encoding,
+            'headers': {
+                name: response.headers[name]
+                for name in self.CACHED_HEADERS if name in response.headers
+            }
+        }
+
+        path = self.prepare_path(url)
+        folder_name = os.path.dirname(path)
+        os.makedirs(folder_name, exist_ok=True)
+
+        descriptor, temp_path = tempfile.mkstemp(dir=folder_name, suffix='.tmp')
+        try:
+            with os.fdopen(descriptor, 'wb') as fileobj:
+                with gzip.GzipFile(fileobj=fileobj, mode='wb') as gzip_fileobj:
+                    gzip_fileobj.write(json.dumps(metadata).encode('utf-8') + b'\n')
+                    gzip_fileobj.write(response.content)
+            os.replace(temp_path, path)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+
+class CachingAdapter(HTTPAdapter):
+    """Transport adapter serving GET requests from a ResponseCache, revalidating
+    stale cached entries with conditional requests unless the cache is offline"""
+
+    def __init__(self, cache, **kwargs):
+        super().__init__(**kwargs)
+        self.cache = cache
+
+    @staticmethod
+    def build_cached_response(request, metadata, content):
+        response = Response()
+        response.status_code = metadata['status_code']
+        response.reason = metadata['reason']
+        response.encoding = metadata['encoding']
+        response.headers = CaseInsensitiveDict(metadata['headers'])
+        response.url = request.url
+        response.request = request
+        response._content = content
+        response._content_consumed = True
+        response.from_cache = True
+        return response
+
+    @staticmethod
+    def build_missing_response(request):
+        response = Response()
+        response.status_code = 504
+        response.reason = 'Not Cached'
+        response.url = request.url
+        response.request = request
+        response._content = b''
+        response._content_consumed = True
+        response.from_cache = True
+        return response
+
+    def is_cached(self, url):
+        """Whether a GET of the url is answered without a network request"""
+        return self.cache.offline or self.cache.is_fresh(url)
+
+    def send(self, request, **kwargs):
+        if request.method != 'GET':
+            return super().send(request, **kwargs)
+
+        cached = self.cache.load(request.url)
+        if self.cache.offline:
+            if cached:
+                return self.build_cached_response(request, *cached)
+            return self.build_missing_response(request)
+
+        if cached:
+            if self.cache.is_fresh(request.url):
+                return self.build_cached_response(request, *cached)
+
+            headers = cached[0]['headers']
+            if 'ETag' in headers:
+                request.headers['If-None-Match'] = headers['ETag']
+            if 'Last-Modified' in headers:
+                request.headers['If-Modified-Since'] = headers['Last-Modified']
+
+        response = super().send(request, **kwargs)
+        if response.status_code == 304 and cached:
+            response.close()
+            self.cache.touch(request.url)
+            return self.build_cached_response(request, *cached)
+        if response.status_code == 200:
+            self.cache.save(request.url, response)
+        return response
@@ -0,0 +1,356 @@
+import heapq
+from bisect import bisect_left
+
+from routes_aggregator.model import Station, Path, PathItem
+from routes_aggregator.utils import time_to_minutes
+
+
+def build_route_schedule(route):
+    schedule = []
+    current_time = None
+
+    for route_point in route.route_points:
+        arrival_time = route_point.raw_arrival_time
+        departure_time = route_point.raw_departure_time
+
+        if current_time is None:
+            current_time = arrival_time if arrival_time is not None else (departure_time or 0)
+        if arrival_time is not None:
+            current_time += (arrival_time - current_time) % 1440
+        arrival = current_time
+
+        if departure_time is not None:
+            current_time += (departure_time - current_time) % 1440
+        schedule.append((arrival, current_time))
+
+    return schedule
+
+
+def get_day_offset(time, earliest_time):
+    return -((time - earliest_time) // 1440) * 1440
+
+
+class ConnectionScanPlanner:
+    """Earliest arrival journey planner based on the Connection Scan Algorithm,
+    scanning the daily timetable into following days until the target is settled"""
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.agent_connections = {}
+        self.timetable = ([], [], 0)
+
+    @staticmethod
+    def build_connections(model):
+        connections = []
+        max_duration = 0
+        for route in model.routes.values():
+            schedule = build_route_schedule(route)
+            station_ids = [
+                Station.get_domain_id(route.agent_type, route_point.station_id)
+                for route_point in route.route_points
+            ]
+            for i in range(len(schedule) - 1):
+                connections.append((
+                    schedule[i][1], schedule[i + 1][0],
+                    station_ids[i], station_ids[i + 1], route, i
+                ))
+            if schedule:
+                max_duration = max(max_duration, schedule[-1][0] - schedule[0][1])
+        connections.sort(key=lambda connection: connection[0])
+        return connections, max_duration
+
+    def build_model(self, model):
+        self.logger.debug('ConnectionScanPlanner: building \'{}\' model'.format(model.agent_type))
+        self.agent_connections[model.agent_type] = self.build_connections(model)
+        self.update_timetable()
+        self.logger.debug('ConnectionScanPlanner: built \'{}\' model'.format(model.agent_type))
+
+    def remove_model(self, agent_type):
+        self.agent_connections.pop(agent_type, None)
+        self.update_timetable()
+
+    def update_timetable(self):
+        agent_connections = list(self.agent_connections.values())
+        connections = list(heapq.merge(
+            *(connections for connections, _ in agent_connections),
+            key=lambda connection: connection[0]
+        ))
+        max_duration = max((max_duration for _, max_duration in agent_connections), default=0)
+        self.timetable = (connections, [connection[0] for connection in connections], max_duration)
+
+    @staticmethod
+    def iter_connections(connections, departure_times, start_time):
+        if not connections:
+            return
+
+        queue = []
+        next_day_offset = get_day_offset(departure_times[-1], start_time)
+
+        def push_connection(i, day_offset):
+            if i < len(connections):
+                heapq.heappush(queue, (departure_times[i] + day_offset, day_offset, i))
+
+        while True:
+            while not queue or queue[0][0] >= next_day_offset + departure_times[0]:
+                push_connection(bisect_left(departure_times, start_time - next_day_offset), next_day_offset)
+                next_day_offset += 1440
+
+            _, day_offset, i = heapq.heappop(queue)
+            push_connection(i + 1, day_offset)
+
+            connection = connections[i]
+            yield (connection[0] + day_offset, connection[1] + day_offset) + connection[2:] + (day_offset,)
+
+    def find_earliest_arrival_paths(self, departure_station_ids, arrival_station_ids, departure_time):
+        connections, departure_times, max_duration = self.timetable
+        start_time = time_to_minutes(departure_time) if departure_time else 0
+
+        departure_station_ids = set(departure_station_ids)
+        arrival_station_ids = set(arrival_station_ids) - departure_station_ids
+
+        earliest_arrivals = dict.fromkeys(departure_station_ids, start_time)
+        boarded_trips = {}
+        incoming_legs = {}
+        best_arrival = None
+        best_station_id = None
+        last_improvement = start_time
+
+        for connection in self.iter_connections(connections, departure_times, start_time):
+            departure, arrival, from_station_id, to_station_id, route, point_idx, day_offset = connection
+
+            if best_arrival is not None and departure >= best_arrival:
+                break
+            # later connections repeat trips already scanned a day earlier
+            if departure > last_improvement + 1440 + max_duration:
+                break
+
+            trip = (route.domain_id, day_offset)
+            boarding_connection = boarded_trips.get(trip)
+            if boarding_connection is None:
+                if earliest_arrivals.get(from_station_id, departure + 1) > departure:
+                    continue
+                boarding_connection = boarded_trips[trip] = connection
+
+            if arrival < earliest_arrivals.get(to_station_id, arrival + 1):
+                earliest_arrivals[to_station_id] = arrival
+                incoming_legs[to_station_id] = (boarding_connection, connection)
+                last_improvement = departure
+                if to_station_id in arrival_station_ids and \
+                   (best_arrival is None or arrival < best_arrival):
+                    best_arrival = arrival
+                    best_station_id = to_station_id
+
+        if best_station_id is None:
+            return []
+
+        legs = []
+        station_id = best_station_id
+        while station_id not in departure_station_ids:
+            boarding_connection, alighting_connection = incoming_legs[station_id]
+            legs.append((alighting_connection[4], boarding_connection[5], alighting_connection[5] + 1))
+            station_id = boarding_connection[2]
+
+        path = Path()
+        for route, departure_point_idx, arrival_point_idx in reversed(legs):
+            path.add_path_item(PathItem(route, departure_point_idx, arrival_point_idx))
+        return [path]
+
+
+class RaptorPlanner:
+    """Range RAPTOR planner returning journeys which are Pareto optimal
+    in departure time, arrival time and number of transfers"""
+
+    DEFAULT_MAX_TRANSFERS = 3
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.agent_station_patterns = {}
+
+    @staticmethod
+    def build_station_patterns(model):
+        station_patterns = {}
+        for route in model.routes.values():
+            station_ids = [
+                Station.get_domain_id(route.agent_type, route_point.station_id)
+                for route_point in route.route_points
+            ]
+            pattern = (route, station_ids, build_route_schedule(route))
+            for i, station_id in enumerate(station_ids):
+                station_patterns.setdefault(station_id, []).append((pattern, i))
+        return station_patterns
+
+    def build_model(self, model):
+        self.logger.debug('RaptorPlanner: building \'{}\' model'.format(model.agent_type))
+        self.agent_station_patterns[model.agent_type] = self.build_station_patterns(model)
+        self.logger.debug('RaptorPlanner: built \'{}\' model'.format(model.agent_type))
+
+    def remove_model(self, agent_type):
+        self.agent_station_patterns.pop(agent_type, None)
+
+    def get_station_patterns(self, station_id):
+        for station_patterns in list(self.agent_station_patterns.values()):
+            patterns = station_patterns.get(station_id)
+            if patterns:
+                return patterns
+        return []
+
+    def find_pareto_paths(self, departure_station_ids, arrival_station_ids,
+                          departure_time, latest_departure_time, max_transfers=None):
+        earliest_departure = time_to_minutes(departure_time) if departure_time else 0
+        latest_departure = time_to_minutes(latest_departure_time) \
+            if latest_departure_time else earliest_departure
+        if latest_departure < earliest_departure:
+            latest_departure += 1440
+        if max_transfers is None:
+            max_transfers = self.DEFAULT_MAX_TRANSFERS
+        rounds_count = int(max_transfers) + 1
+
+        departure_station_ids = set(departure_station_ids)
+        arrival_station_ids = set(arrival_station_ids) - departure_station_ids
+
+        departure_times = set()
+        for station_id in departure_station_ids:
+            for pattern, i in self.get_station_patterns(station_id):
+                if i + 1 < len(pattern[1]):
+                    time = pattern[2][i][1]
+                    time += get_day_offset(time, earliest_departure)
+                    while time <= latest_departure:
+                        departure_times.add(time)
+                        time += 1440
+
+        labels = [{} for _ in range(rounds_count + 1)]
+        parents = [{} for _ in range(rounds_count + 1)]
+        journeys = {}
+
+        for start_time in sorted(departure_times, reverse=True):
+            marked_station_ids = set()
+            for station_id in departure_station_ids:
+                if self.update_label(labels, 0, station_id, start_time):
+                    marked_station_ids.add(station_id)
+
+            for k in range(1, rounds_count + 1):
+                marked_station_ids = self.scan_patterns(
+                    labels, parents, k, marked_station_ids,
+                    departure_station_ids, arrival_station_ids, latest_departure
+                )
+                if not marked_station_ids:
+                    break
+
+            self.collect_journeys(journeys, labels, parents, arrival_station_ids)
+
+        return self.prepare_paths(journeys.values())
+
+    @staticmethod
+    def update_label(labels, k, station_id, time):
+        if labels[k].get(station_id, time + 1) <= time:
+            return False
+        for j in range(k, len(labels)):
+            if labels[j].get(station_id, time + 1) > time:
+                labels[j][station_id] = time
+        return True
+
+    def scan_patterns(self, labels, parents, k, marked_station_ids,
+                      departure_station_ids, arrival_station_ids, latest_departure):
+        queue = {}
+        for station_id in marked_station_ids:
+            for pattern, i in self.get_station_patterns(station_id):
+                pattern_id = id(pattern)
+                if pattern_id not in queue or queue[pattern_id][1] > i:
+                    queue[pattern_id] = (pattern, i)
+
+        improved_station_ids = set()
+        previous_labels = labels[k - 1]
+        current_labels = labels[k]
+        target_bound = min(
+            (current_labels[arrival_station_id]
+             for arrival_station_id in arrival_station_ids
+             if arrival_station_id in current_labels),
+            default=None
+        )
+
+        for pattern, start_idx in queue.values():
+            route, station_ids, schedule = pattern
+            trip_offset = None
+            boarding_idx = None
+
+            for i in range(start_idx, len(station_ids)):
+                station_id = station_ids[i]
+
+                if trip_offset is not None:
+                    arrival = schedule[i][0] + trip_offset
+                    if (target_bound is None or arrival < target_bound) and \
+                       self.update_label(labels, k, station_id, arrival):
+                        parents[k][station_id] = (
+                            route, boarding_idx, i, station_ids[boarding_idx],
+                            schedule[boarding_idx][1] + trip_offset
+                        )
+                        improved_station_ids.add(station_id)
+                        if station_id in arrival_station_ids:
+                            target_bound = arrival
+
+                previous_label = previous_labels.get(station_id)
+                if previous_label is not None and \
+                   (trip_offset is None or previous_label <= schedule[i][1] + trip_offset):
+                    day_offset = get_day_offset(schedule[i][1], previous_label)
+                    # journeys leave the origin within the departure window only
+                    if (station_id not in departure_station_ids or
+                            schedule[i][1] + day_offset <= latest_departure) and \
+                       (trip_offset is None or day_offset < trip_offset):
+                        trip_offset = day_offset
+                        boarding_idx = i
+
+        return improved_station_ids
+
+    @staticmethod
+    def reconstruct_legs(labels, parents, k, station_id):
+        legs = []
+        while True:
+            label = labels[k].get(station_id)
+            while k > 0 and labels[k - 1].get(station_id) == label:
+                k -= 1
+            if k == 0:
+                return legs
+
+            parent = parents[k].get(station_id)
+            if parent is None:
+                return []
+            legs.insert(0, parent)
+            station_id = parent[3]
+            k -= 1
+
+    def collect_journeys(self, journeys, labels, parents, arrival_station_ids):
+        for k in range(1, len(labels)):
+            arrivals = [
+                (labels[k][station_id], station_id)
+                for station_id in arrival_station_ids if station_id in labels[k]
+            ]
+            if not arrivals:
+                continue
+
+            arrival, station_id = min(arrivals)
+            legs = self.reconstruct_legs(labels, parents, k, station_id)
+            if legs:
+                key = tuple((leg[0].domain_id, leg[1], leg[2], leg[4]) for leg in legs)
+                journeys[key] = (legs[0][4], arrival, len(legs), legs)
+
+    @staticmethod
+    def prepare_paths(journeys):
+        journeys = list({journey[:3]: journey for journey in journeys}.values())
+        criteria = [journey[:3] for journey in journeys]
+        pareto_journeys = [
+            journey for journey in journeys
+            if not any(
+                other[0] >= journey[0] and other[1] <= journey[1] and
+                other[2] <= journey[2] and other != journey[:3]
+                for other in criteria
+            )
+        ]
+        pareto_journeys.sort(key=lambda journey: journey[:3])
+
+        paths = []
+        for journey in pareto_journeys:
+            path = Path()
+            for route, departure_point_idx, arrival_point_idx, _, _ in journey[3]:
+                path.add_path_item(PathItem(route, departure_point_idx, arrival_point_idx))
+            paths.append(path)
+        return paths
@@ -0,0 +1,287 @@
+import itertools
+import re
+
+from routes_aggregator.model import Station, Path, PathItem
+
+
+class ModelIndex:
+
+    def __init__(self, model):
+        self.agent_type = model.agent_type
+
+        self.stations = {}
+        self.routes = {}
+        self.station_routes = {}
+        self.route_numbers = {}
+
+        for station in model.stations.values():
+            self.stations[station.domain_id] = station
+
+        for route in model.routes.values():
+            self.routes[route.domain_id] = route
+
+            if route.route_number:
+                self.route_numbers.setdefault(route.route_number, []).append(route)
+
+            for i, route_point in enumerate(route.route_points):
+                station_domain_id = Station.get_domain_id(route.agent_type, route_point.station_id)
+                raw_route_start_time = route_point.raw_arrival_time \
+                    if route_point.raw_arrival_time is not None \
+                    else route_point.raw_departure_time or 0
+                self.station_routes.setdefault(station_domain_id, []).append(
+                    (raw_route_start_time, route, i)
+                )
+
+        for postings in self.station_routes.values():
+            postings.sort(key=lambda posting: posting[0])
+
+
+class MemoryAccessor:
+
+    STATION_NAME_PROPERTIES = ['station_name_ua', 'station_name_en', 'station_name_ru']
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.indices = {}
+
+    @staticmethod
+    def create_matcher(search_mode, patterns):
+        search_mode = (search_mode or '').upper()
+
+        if search_mode == 'STARTS_WITH':
+            patterns = [pattern.lower() for pattern in patterns]
+            return lambda value: any(value.lower().startswith(pattern) for pattern in patterns)
+        elif search_mode == 'STRICT':
+            patterns = set(patterns)
+            return lambda value: value in patterns
+        elif search_mode == 'REGEX':
+            patterns = [re.compile(pattern) for pattern in patterns]
+            return lambda value: any(pattern.fullmatch(value) for pattern in patterns)
+        return None
+
+    @staticmethod
+    def apply_limit(items, limit):
+        return list(itertools.islice(items, limit)) if limit is not None else list(items)
+
+    def get_postings(self, station_domain_id):
+        for index in list(self.indices.values()):
+            postings = index.station_routes.get(station_domain_id)
+            if postings:
+                return postings
+        return []
+
+    def get_station(self, domain_id):
+        for index in list(self.indices.values()):
+            station = index.stations.get(domain_id)
+            if station:
+                return station
+        return None
+
+    def get_route(self, domain_id):
+        for index in list(self.indices.values()):
+            route = index.routes.get(domain_id)
+            if route:
+                return route
+        return None
+
+    def get_stations(self, domain_ids):
+        return list(map(self.get_station, domain_ids))
+
+    def get_routes(self, domain_ids):
+        return list(map(self.get_route, domain_ids))
+
+    def find_stations(self, station_names, search_mode, limit):
+        matcher = self.create_matcher(search_mode, station_names)
+        if not matcher:
+            return []
+
+        def stations_getter():
+            for index in list(self.indices.values()):
+                for station in index.stations.values():
+                    properties = station.get_properties() or {}
+                    if any(matcher(properties[name])
+                           for name in self.STATION_NAME_PROPERTIES
+                           if properties.get(name)):
+                        yield station
+
+        return self.apply_limit(stations_getter(), limit)
+
+    def find_routes_by_route_numbers(self, route_numbers, search_mode, limit):
+        matcher = self.create_matcher(search_mode, route_numbers)
+        if not matcher:
+            return []
+
+        def routes_getter():
+            for index in list(self.indices.values()):
+                if search_mode.upper() == 'STRICT':
+                    for route_number in route_numbers:
+                        yield from index.route_numbers.get(route_number, [])
+                else:
+                    for route_number, routes in index.route_numbers.items():
+                        if matcher(route_number):
+                            yield from routes
+
+        return self.apply_limit(routes_getter(), limit)
+
+    def find_routes_by_station_ids(self, station_ids, limit):
+        postings = sorted(
+            itertools.chain.from_iterable(map(self.get_postings, set(station_ids))),
+            key=lambda posting: posting[0]
+        )
+        return self.apply_limit((posting[1] for posting in postings), limit)
+
+    @staticmethod
+    def find_route_point_indices(route, station_ids):
+        station_ids = set(station_ids)
+        return [
+            i for i, route_point in enumerate(route.route_points)
+            if Station.get_domain_id(route.agent_type, route_point.station_id) in station_ids
+        ]
+
+    def find_paths_with_single_route(self, station_ids, limit):
+
+        def paths_getter():
+            if station_ids[0]:
+                routes = {
+                    posting[1].domain_id: posting[1]
+                    for posting in itertools.chain.from_iterable(map(self.get_postings, station_ids[0]))
+                }.values()
+            else:
+                routes = itertools.chain.from_iterable(
+                    index.routes.values() for index in list(self.indices.values())
+                )
+
+            for route in routes:
+                points_count = len(route.route_points)
+                positions = [
+                    self.find_route_point_indices(route, ids) if ids else list(range(points_count))
+                    for ids in station_ids
+                ]
+
+                for departure_idx in positions[0]:
+                    middle_idx = departure_idx
+                    for indices in positions[1:-1]:
+                        middle_idx = next((i for i in indices if i > middle_idx), None)
+                        if middle_idx is None:
+                            break
+                    if middle_idx is None:
+                        continue
+
+                    for arrival_idx in positions[-1]:
+                        if arrival_idx > middle_idx:
+                            path = Path()
+                            path.add_path_item(PathItem(route, departure_idx, arrival_idx))
+                            yield path
+
+        return self.apply_limit(paths_getter(), limit)
+
+    def find_paths_with_multiple_routes(self, station_ids, limit):
+        legs_count = len(station_ids) - 1
+        station_sets = [set(ids) for ids in station_ids]
+
+        def legs_getter(station_domain_id, leg_idx, previous_route):
+            for posting in self.get_postings(station_domain_id):
+                route, departure_idx = posting[1], posting[2]
+                if previous_route is not None and route.domain_id == previous_route.domain_id:
+                    continue
+
+                for arrival_idx in range(departure_idx + 1, len(route.route_points)):
+                    arrival_station_id = Station.get_domain_id(
+                        route.agent_type, route.get_route_point(arrival_idx).station_id
+                    )
+                    if station_sets[leg_idx + 1] and arrival_station_id not in station_sets[leg_idx + 1]:
+                        continue
+
+                    leg = (route, departure_idx, arrival_idx)
+                    if leg_idx + 1 == legs_count:
+                        yield [leg]
+                    else:
+                        for legs in legs_getter(arrival_station_id, leg_idx + 1, route):
+                            yield [leg] + legs
+
+        def paths_getter():
+            for station_domain_id in station_ids[0]:
+                for legs in legs_getter(station_domain_id, 0, None):
+                    path = Path()
+                    for leg in legs:
+                        path.add_path_item(PathItem(*leg))
+                    yield path
+
+        return self.apply_limit(paths_getter(), limit)
+
+    def find_shortest_paths(self, departure_station_ids, arrival_station_ids,
+                            max_transitions, limit):
+        max_transitions = int(max_transitions)
+        arrival_station_ids = set(arrival_station_ids)
+
+        def transitions_getter(station_domain_id):
+            for posting in self.get_postings(station_domain_id):
+                route, i = posting[1], posting[2]
+                if i + 1 < len(route.route_points):
+                    yield Station.get_domain_id(
+                        route.agent_type, route.get_route_point(i + 1).station_id
+                    ), route, i
+
+        def transitions_chains(predecessors, station_domain_id):
+            if not predecessors[station_domain_id]:
+                yield []
+            for previous_station_id, route, i in predecessors[station_domain_id]:
+                for chain in transitions_chains(predecessors, previous_station_id):
+                    yield chain + [(route, i)]
+
+        def paths_getter():
+            for departure_station_id in departure_station_ids:
+                predecessors = {departure_station_id: []}
+                frontier = [departure_station_id]
+
+                for depth in range(max_transitions):
+                    next_frontier = {}
+                    for station_domain_id in frontier:
+                        for next_station_id, route, i in transitions_getter(station_domain_id):
+                            if next_station_id in predecessors:
+                                continue
+                            next_frontier.setdefault(next_station_id, []).append(
+                                (station_domain_id, route, i)
+                            )
+                    predecessors.update(next_frontier)
+                    frontier = list(next_frontier)
+
+                    for arrival_station_id in arrival_station_ids.intersection(next_frontier):
+                        for chain in transitions_chains(predecessors, arrival_station_id):
+                            path = Path()
+                            for route, i in chain:
+                                path.add_path_item(PathItem(route, i, i + 1))
+                            yield path
+
+                    if not frontier:
+                        break
+
+        return self.apply_limit(paths_getter(), limit)
+
+    def find_paths_many(self, queries):
+        paths = []
+        for search_mode, station_ids, max_transitions, limit in queries:
+            if search_mode == 'SIMPLE':
+                paths.append(self.find_paths_with_single_route(station_ids, limit))
+            elif search_mode == 'TRANSFERS':
+                paths.append(self.find_paths_with_multiple_routes(station_ids, limit))
+            elif search_mode == 'TRANSITIONS':
+                paths.append(self.find_shortest_paths(
+                    station_ids[0], station_ids[-1], max_transitions, limit))
+            else:
+                paths.append([])
+        return paths
+
+    def build_model(self, model, previous_model=None):
+        self.logger.debug('MemoryAccessor: building \'{}\' model'.format(model.agent_type))
+        self.indices[model.agent_type] = ModelIndex(model)
+        self.logger.debug('MemoryAccessor: built \'{}\' model'.format(model.agent_type))
+
+    def remove_model(self, agent_type):
+        self.indices.pop(agent_type, None)
+
+    def get_agent_types(self):
+        return list(self.indices)
+
+    def get_cache_stats(self):
+        return {}
@@ -1,4 +1,5 @@
 import pickle
+import sys
 
 from routes_aggregator.utils import *
 from routes_aggregator.exceptions import AbsentRoutePointException, AbsentPathItemException
@@ -34,14 +35,27 @@ class ModelAccessor:
         self.routes = pickle.load(fileobj)
 
 
+def intern_value(value):
+    return sys.intern(value) if type(value) is str else value
+
+
 class Entity:
     """Base class for entity representation with multilingual properties"""
 
+    __slots__ = ('__properties',)
+
     def __init__(self):
         self.__properties = None
 
+    def __setstate__(self, state):
+        if isinstance(state, tuple):
+            dict_state, slots_state = state
+            state = dict(dict_state or {}, **(slots_state or {}))
+        for name, value in state.items():
+            setattr(self, name, value)
+
     def set_property(self, name, language, value):
-        self.ensure_properties()[self.prepare_property(name, language)] = value
+        self.ensure_properties()[self.prepare_property(name, language)] = intern_value(value)
 
     def get_property(self, name, language):
         return self.__properties and self.__properties.get(
@@ -57,7 +71,7 @@ class Entity:
 
     @staticmethod
     def prepare_property(name, language):
-        return name + "_" + language
+        return sys.intern(name + "_" + language)
 
     @staticmethod
     def extract_property(getter, language):
@@ -71,11 +85,13 @@ class Entity:
 
 class Station(Entity):
 
+    __slots__ = ('agent_type', 'station_id')
+
     def __init__(self, agent_type, station_id):
         super().__init__()
 
-        self.agent_type = agent_type
-        self.station_id = station_id
+        self.agent_type = intern_value(agent_type)
+        self.station_id = intern_value(station_id)
 
     @staticmethod
     def get_domain_id(agent_type, station_id):
@@ -106,11 +122,16 @@ class Station(Entity):
 
 class Route(Entity):
 
+    __slots__ = (
+        'agent_type', 'route_id', 'route_number', 'route_points',
+        'active_from_date', 'active_to_date', '__travel_offsets'
+    )
+
     def __init__(self, agent_type, route_id):
         super().__init__()
 
-        self.agent_type = agent_type
-        self.route_id = route_id
+        self.agent_type = intern_value(agent_type)
+        self.route_id = intern_value(route_id)
 
         self.route_number = None
         self.route_points = []
@@ -118,6 +139,12 @@ class Route(Entity):
         self.active_from_date = None
         self.active_to_date = None
 
+        self.__travel_offsets = None
+
+    def __setstate__(self, state):
+        self.__travel_offsets = None
+        super().__setstate__(state)
+
     @staticmethod
     def get_domain_id(agent_type, route_id):
         return agent_type + route_id
@@ -156,6 +183,7 @@ class Route(Entity):
 
     def add_route_point(self, route_point):
         self.route_points.append(route_point)
+        self.__travel_offsets = None
 
     def get_route_point(self, index):
         try:
@@ -166,37 +194,51 @@ class Route(Entity):
                 point_index=index
             )
 
-    def calculate_travel_time(self, departure_point_idx, arrival_point_idx):
+    @property
+    def travel_offsets(self):
+        if self.__travel_offsets is None:
+            self.__travel_offsets = self.build_travel_offsets()
+        return self.__travel_offsets
+
+    def build_travel_offsets(self):
+        arrival_offsets = []
+        departure_offsets = []
         minutes = 0
         previous_departure_time = None
-        for index in range(departure_point_idx, arrival_point_idx):
-            point = self.get_route_point(index)
+        for point in self.route_points:
             if previous_departure_time is not None:
-                segment_time = calculate_raw_time_difference(
+                minutes += calculate_raw_minutes_difference(
                     previous_departure_time,
-                    point.arrival_time
+                    point.raw_arrival_time or 0
                 )
-                minutes += segment_time + point.raw_stop_time
-            previous_departure_time = point.departure_time
-        if previous_departure_time:
-            minutes += calculate_raw_time_difference(
-                previous_departure_time,
-                self.get_route_point(arrival_point_idx).arrival_time
-            )
-        return minutes
+            arrival_offsets.append(minutes)
+            minutes += point.raw_stop_time
+            departure_offsets.append(minutes)
+            previous_departure_time = point.raw_departure_time or 0
+        return arrival_offsets, departure_offsets
+
+    def calculate_travel_time(self, departure_point_idx, arrival_point_idx):
+        if arrival_point_idx <= departure_point_idx:
+            return 0
+        self.get_route_point(departure_point_idx)
+        self.get_route_point(arrival_point_idx)
+        arrival_offsets, departure_offsets = self.travel_offsets
+        return arrival_offsets[arrival_point_idx] - departure_offsets[departure_point_idx]
 
 
 class RoutePoint(Entity):
 
+    __slots__ = ('agent_type', 'route_id', 'station_id', 'raw_arrival_time', 'raw_departure_time')
+
     def __init__(self, agent_type, route_id, station_id):
         super().__init__()
 
-        self.agent_type = agent_type
-        self.route_id = route_id
-        self.station_id = station_id
+        self.agent_type = intern_value(agent_type)
+        self.route_id = intern_value(route_id)
+        self.station_id = intern_value(station_id)
 
-        self.arrival_time = None
-        self.departure_time = None
+        self.raw_arrival_time = None
+        self.raw_departure_time = None
 
     @staticmethod
     def get_domain_id(agent_type, route_id, station_id):
@@ -206,22 +248,35 @@ class RoutePoint(Entity):
     def domain_id(self):
         return self.get_domain_id(self.agent_type, self.route_id, self.station_id)
 
+    @property
+    def arrival_time(self):
+        return format_time(self.raw_arrival_time)
+
+    @arrival_time.setter
+    def arrival_time(self, arrival_time):
+        self.raw_arrival_time = parse_time(arrival_time)
+
+    @property
+    def departure_time(self):
+        return format_time(self.raw_departure_time)
+
+    @departure_time.setter
+    def departure_time(self, departure_time):
+        self.raw_departure_time = parse_time(departure_time)
+
     @property
     def stop_time(self):
-        if self.arrival_time and self.departure_time:
-            return calculate_time_difference(
-                self.arrival_time,
-                self.departure_time
-            )
+        if self.raw_arrival_time is not None and self.raw_departure_time is not None:
+            return minutes_to_time(self.raw_stop_time)
         else:
             return ''
 
     @property
     def raw_stop_time(self):
-        if self.arrival_time and self.departure_time:
-            return calculate_raw_time_difference(
-                self.arrival_time,
-                self.departure_time
+        if self.raw_arrival_time is not None and self.raw_departure_time is not None:
+            return calculate_raw_minutes_difference(
+                self.raw_arrival_time,
+                self.raw_departure_time
             )
         else:
             return 0
@@ -229,11 +284,14 @@ class RoutePoint(Entity):
 
 class Path(Entity):
 
+    __slots__ = ('path_items', '__raw_travel_time', '__raw_arrival_time')
+
     def __init__(self):
         super().__init__()
 
         self.path_items = []
         self.__raw_travel_time = 0
+        self.__raw_arrival_time = None
 
     @property
     def departure_point(self):
@@ -259,26 +317,22 @@ class Path(Entity):
     def raw_travel_time(self):
         return self.__raw_travel_time
 
-    def __calculate_travel_time(self):
-        minutes = 0
-        previous_path_item = None
-        for path_item in self.path_items:
-            if previous_path_item is not None:
-                minutes += calculate_raw_time_difference(
-                    previous_path_item.arrival_time,
-                    path_item.departure_time
-                )
-            minutes += path_item.raw_travel_time
-            previous_path_item = path_item
-        return minutes
-
     def add_path_item(self, path_item):
         if self.path_items and \
            self.path_items[-1].route.domain_id == path_item.route.domain_id:
-            self.path_items[-1].arrival_point_idx = path_item.arrival_point_idx
+            last_path_item = self.path_items[-1]
+            self.__raw_travel_time -= last_path_item.raw_travel_time
+            last_path_item.arrival_point_idx = path_item.arrival_point_idx
+            self.__raw_travel_time += last_path_item.raw_travel_time
         else:
+            if self.path_items:
+                self.__raw_travel_time += calculate_raw_minutes_difference(
+                    self.__raw_arrival_time or 0,
+                    path_item.raw_departure_time or 0
+                )
             self.path_items.append(path_item)
-        self.__raw_travel_time = self.__calculate_travel_time()
+            self.__raw_travel_time += path_item.raw_travel_time
+        self.__raw_arrival_time = self.path_items[-1].raw_arrival_time
 
     def get_path_item(self, index):
         try:
@@ -291,6 +345,8 @@ class Path(Entity):
 
 class PathItem(Entity):
 
+    __slots__ = ('route', 'departure_point_idx', '__arrival_point_idx', '__raw_travel_time')
+
     def __init__(self, route, departure_point_idx, arrival_point_idx):
         super().__init__()
 
@@ -298,9 +354,16 @@ class PathItem(Entity):
         self.departure_point_idx = departure_point_idx
         self.arrival_point_idx = arrival_point_idx
 
+    @property
+    def arrival_point_idx(self):
+        return self.__arrival_point_idx
+
+    @arrival_point_idx.setter
+    def arrival_point_idx(self, arrival_point_idx):
+        self.__arrival_point_idx = arrival_point_idx
         self.__raw_travel_time = self.route.calculate_travel_time(
             self.departure_point_idx,
-            self.arrival_point_idx
+            arrival_point_idx
         )
 
     @property
@@ -319,6 +382,14 @@ class PathItem(Entity):
     def arrival_time(self):
         return self.arrival_point.arrival_time
 
+    @property
+    def raw_departure_time(self):
+        return self.departure_point.raw_departure_time
+
+    @property
+    def raw_arrival_time(self):
+        return self.arrival_point.raw_arrival_time
+
     @property
     def travel_time(self):
         return minutes_to_time(self.raw_travel_time)
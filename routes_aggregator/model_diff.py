@@ -0,0 +1,85 @@
+class ModelDiff:
+    """Stations and routes inserted, deleted and modified between two models of an agent type"""
+
+    def __init__(self, agent_type):
+        self.agent_type = agent_type
+
+        self.added_stations = []
+        self.removed_stations = []
+        self.changed_stations = []
+
+        self.added_routes = []
+        self.removed_routes = []
+        self.changed_routes = []
+
+    @staticmethod
+    def get_station_signature(station):
+        return sorted((station.get_properties() or {}).items())
+
+    @staticmethod
+    def get_route_signature(route):
+        return (
+            route.route_number, route.active_from_date, route.active_to_date,
+            sorted((route.get_properties() or {}).items())
+        )
+
+    @staticmethod
+    def get_stops_signature(route):
+        return [
+            (route_point.station_id, route_point.raw_arrival_time, route_point.raw_departure_time)
+            for route_point in route.route_points
+        ]
+
+    @classmethod
+    def compare(cls, old_model, new_model):
+        diff = cls(new_model.agent_type)
+
+        for station_id, station in new_model.stations.items():
+            old_station = old_model.stations.get(station_id)
+            if old_station is None:
+                diff.added_stations.append(station)
+            elif cls.get_station_signature(old_station) != cls.get_station_signature(station):
+                diff.changed_stations.append((old_station, station))
+        diff.removed_stations.extend(
+            old_model.stations[station_id]
+            for station_id in old_model.stations if station_id not in new_model.stations
+        )
+
+        for route_id, route in new_model.routes.items():
+            old_route = old_model.routes.get(route_id)
+            if old_route is None:
+                diff.added_routes.append(route)
+            elif cls.get_route_signature(old_route) != cls.get_route_signature(route) or \
+                    cls.get_stops_signature(old_route) != cls.get_stops_signature(route):
+                diff.changed_routes.append((old_route, route))
+        diff.removed_routes.extend(
+            old_model.routes[route_id]
+            for route_id in old_model.routes if route_id not in new_model.routes
+        )
+
+        return diff
+
+    @property
+    def stops_changed_routes(self):
+        return [
+            (old_route, route) for old_route, route in self.changed_routes
+            if self.get_stops_signature(old_route) != self.get_stops_signature(route)
+        ]
+
+    @property
+    def properties_changed_routes(self):
+        return [
+            (old_route, route) for old_route, route in self.changed_routes
+            if self.get_stops_signature(old_route) == self.get_stops_signature(route)
+        ]
+
+    @property
+    def changes_count(self):
+        return len(self.added_stations) + len(self.removed_stations) + len(self.changed_stations) + \
+            len(self.added_routes) + len(self.removed_routes) + len(self.changed_routes)
+
+    def __str__(self):
+        return 'stations +{} -{} ~{}, routes +{} -{} ~{}'.format(
+            len(self.added_stations), len(self.removed_stations), len(self.changed_stations),
+            len(self.added_routes), len(self.removed_routes), len(self.changed_routes)
+        )
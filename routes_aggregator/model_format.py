@@ -0,0 +1,372 @@
+import hashlib
+import io
+import mmap
+import struct
+from collections.abc import MutableMapping
+
+from routes_aggregator.exceptions import ModelFormatException
+from routes_aggregator.model import ModelAccessor, Station, Route, RoutePoint, intern_value
+
+
+FORMAT_MAGIC = b'RAGM'
+FORMAT_VERSION = 1
+
+STATION_CHUNK = 1
+ROUTE_CHUNK = 2
+
+NO_STRING = 0xFFFFFFFF
+NO_TIME = -1
+
+# magic, version, reserved
+HEADER = struct.Struct('<4sHH')
+# kind, records count, stops count, properties count
+CHUNK_HEADER = struct.Struct('<BxxxIII')
+# station id, first property, properties count
+STATION_RECORD = struct.Struct('<III')
+# route id, route number, active from date, active to date,
+# first property, properties count, first stop, stops count
+ROUTE_RECORD = struct.Struct('<IIIIIIII')
+# station id, arrival minutes, departure minutes
+STOP_RECORD = struct.Struct('<Ihh')
+# name, value
+PROPERTY_RECORD = struct.Struct('<II')
+# strings count
+STRINGS_HEADER = struct.Struct('<I')
+STRING_OFFSET = struct.Struct('<I')
+# kind, chunk offset, records count
+INDEX_RECORD = struct.Struct('<BxxxQI')
+# agent type, strings offset, index offset, chunks count, magic
+TRAILER = struct.Struct('<IQQI4s')
+
+
+class ModelWriter:
+    """Streaming writer of the chunked binary model format, records are
+    flushed in chunks while the string table and the index are written on close"""
+
+    DEFAULT_CHUNK_SIZE = 1024
+
+    def __init__(self, fileobj, agent_type, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.fileobj = fileobj
+        self.agent_type = agent_type
+        self.chunk_size = chunk_size
+
+        self.strings = {}
+        self.chunks = []
+        self.pending = {STATION_CHUNK: [], ROUTE_CHUNK: []}
+        self.position = 0
+        self.closed = False
+
+        self.write(HEADER.pack(FORMAT_MAGIC, FORMAT_VERSION, 0))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+    def write(self, data):
+        self.fileobj.write(data)
+        self.position += len(data)
+
+    def add_string(self, value):
+        if value is None:
+            return NO_STRING
+        idx = self.strings.get(value)
+        if idx is None:
+            idx = self.strings[value] = len(self.strings)
+        return idx
+
+    @staticmethod
+    def prepare_time(raw_time):
+        return raw_time if raw_time is not None else NO_TIME
+
+    def add_station(self, station):
+        self.add_record(STATION_CHUNK, station)
+
+    def add_route(self, route):
+        self.add_record(ROUTE_CHUNK, route)
+
+    def add_record(self, kind, entity):
+        pending = self.pending[kind]
+        pending.append(entity)
+        if len(pending) >= self.chunk_size:
+            self.flush_chunk(kind)
+
+    def encode_properties(self, entity, properties):
+        first_property = len(properties) // PROPERTY_RECORD.size
+        entity_properties = entity.get_properties() or {}
+        for name, value in entity_properties.items():
+            properties += PROPERTY_RECORD.pack(self.add_string(name), self.add_string(value))
+        return first_property, len(entity_properties)
+
+    def flush_chunk(self, kind):
+        entities = self.pending[kind]
+        if not entities:
+            return
+
+        records = bytearray()
+        stops = bytearray()
+        properties = bytearray()
+
+        for entity in entities:
+            first_property, properties_count = self.encode_properties(entity, properties)
+            if kind == STATION_CHUNK:
+                records += STATION_RECORD.pack(
+                    self.add_string(entity.station_id), first_property, properties_count
+                )
+            else:
+                first_stop = len(stops) // STOP_RECORD.size
+                for route_point in entity.route_points:
+                    stops += STOP_RECORD.pack(
+                        self.add_string(route_point.station_id),
+                        self.prepare_time(route_point.raw_arrival_time),
+                        self.prepare_time(route_point.raw_departure_time)
+                    )
+                records += ROUTE_RECORD.pack(
+                    self.add_string(entity.route_id), self.add_string(entity.route_number),
+                    self.add_string(entity.active_from_date), self.add_string(entity.active_to_date),
+                    first_property, properties_count, first_stop, len(entity.route_points)
+                )
+
+        self.chunks.append((kind, self.position, len(entities)))
+        self.write(CHUNK_HEADER.pack(
+            kind, len(entities),
+            len(stops) // STOP_RECORD.size,
+            len(properties) // PROPERTY_RECORD.size
+        ))
+        self.write(records)
+        self.write(stops)
+        self.write(properties)
+        self.pending[kind] = []
+
+    def write_model(self, model):
+        for station in model.stations.values():
+            self.add_station(station)
+        for route in model.routes.values():
+            self.add_route(route)
+        self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+
+        self.flush_chunk(STATION_CHUNK)
+        self.flush_chunk(ROUTE_CHUNK)
+        agent_type_idx = self.add_string(self.agent_type)
+
+        strings_offset = self.position
+        encoded_strings = [value.encode('utf-8') for value in self.strings]
+        self.write(STRINGS_HEADER.pack(len(encoded_strings)))
+        offset = 0
+        offsets = bytearray(STRING_OFFSET.pack(offset))
+        for encoded_string in encoded_strings:
+            offset += len(encoded_string)
+            offsets += STRING_OFFSET.pack(offset)
+        self.write(offsets)
+        self.write(b''.join(encoded_strings))
+
+        index_offset = self.position
+        self.write(b''.join(INDEX_RECORD.pack(*chunk) for chunk in self.chunks))
+        self.write(TRAILER.pack(
+            agent_type_idx, strings_offset, index_offset, len(self.chunks), FORMAT_MAGIC
+        ))
+
+
+class RecordMapping(MutableMapping):
+    """Mapping materializing entities on first access, the record locations
+    are copied on the first write so that the reader index stays intact"""
+
+    def __init__(self, locations, materializer):
+        self.locations = locations
+        self.materializer = materializer
+        self.materialized = {}
+        self.copied = False
+
+    def __setitem__(self, key, entity):
+        self.copy_locations()
+        self.locations[key] = None
+        self.materialized[key] = entity
+
+    def __delitem__(self, key):
+        self.copy_locations()
+        del self.locations[key]
+        self.materialized.pop(key, None)
+
+    def copy_locations(self):
+        if not self.copied:
+            self.locations = dict(self.locations)
+            self.copied = True
+
+    def __getitem__(self, key):
+        entity = self.materialized.get(key)
+        if entity is None:
+            entity = self.materialized[key] = self.materializer(self.locations[key])
+        return entity
+
+    def __iter__(self):
+        return iter(self.locations)
+
+    def __len__(self):
+        return len(self.locations)
+
+    def __contains__(self, key):
+        return key in self.locations
+
+
+class ModelReader:
+    """Lazy reader of the chunked binary model format over a memory map or a buffer"""
+
+    def __init__(self, buffer):
+        self.buffer = memoryview(buffer)
+
+        if len(self.buffer) < HEADER.size + TRAILER.size:
+            raise ModelFormatException('truncated file')
+        magic, version, _ = HEADER.unpack_from(self.buffer, 0)
+        if magic != FORMAT_MAGIC:
+            raise ModelFormatException('unknown magic {!r}'.format(magic))
+        if version != FORMAT_VERSION:
+            raise ModelFormatException('unsupported version {}'.format(version))
+
+        agent_type_idx, strings_offset, index_offset, chunks_count, magic = \
+            TRAILER.unpack_from(self.buffer, len(self.buffer) - TRAILER.size)
+        if magic != FORMAT_MAGIC:
+            raise ModelFormatException('missing trailer')
+
+        strings_count, = STRINGS_HEADER.unpack_from(self.buffer, strings_offset)
+        self.strings_offsets_offset = strings_offset + STRINGS_HEADER.size
+        self.strings_data_offset = self.strings_offsets_offset + (strings_count + 1) * STRING_OFFSET.size
+        self.strings = [None] * strings_count
+
+        self.agent_type = self.get_string(agent_type_idx)
+        self.station_locations = {}
+        self.route_locations = {}
+
+        for i in range(chunks_count):
+            kind, offset, records_count = INDEX_RECORD.unpack_from(
+                self.buffer, index_offset + i * INDEX_RECORD.size
+            )
+            self.index_chunk(kind, offset, records_count)
+
+    @classmethod
+    def open(cls, fileobj):
+        try:
+            buffer = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+            buffer = fileobj.read()
+        return cls(buffer)
+
+    def get_string(self, idx):
+        if idx == NO_STRING:
+            return None
+        value = self.strings[idx]
+        if value is None:
+            start, = STRING_OFFSET.unpack_from(self.buffer, self.strings_offsets_offset + idx * STRING_OFFSET.size)
+            end, = STRING_OFFSET.unpack_from(self.buffer, self.strings_offsets_offset + (idx + 1) * STRING_OFFSET.size)
+            value = self.strings[idx] = intern_value(
+                str(self.buffer[self.strings_data_offset + start:self.strings_data_offset + end], 'utf-8')
+            )
+        return value
+
+    def index_chunk(self, kind, offset, records_count):
+        _, _, stops_count, _ = CHUNK_HEADER.unpack_from(self.buffer, offset)
+        records_offset = offset + CHUNK_HEADER.size
+
+        if kind == STATION_CHUNK:
+            record_struct, locations = STATION_RECORD, self.station_locations
+        elif kind == ROUTE_CHUNK:
+            record_struct, locations = ROUTE_RECORD, self.route_locations
+        else:
+            raise ModelFormatException('unknown chunk kind {}'.format(kind))
+
+        stops_offset = records_offset + records_count * record_struct.size
+        properties_offset = stops_offset + stops_count * STOP_RECORD.size
+
+        for i in range(records_count):
+            record_offset = records_offset + i * record_struct.size
+            key_idx, = struct.unpack_from('<I', self.buffer, record_offset)
+            locations[self.get_string(key_idx)] = (record_offset, stops_offset, properties_offset)
+
+    def read_properties(self, entity, properties_offset, first_property, properties_count):
+        if not properties_count:
+            return
+        properties = entity.ensure_properties()
+        for i in range(first_property, first_property + properties_count):
+            name_idx, value_idx = PROPERTY_RECORD.unpack_from(
+                self.buffer, properties_offset + i * PROPERTY_RECORD.size
+            )
+            properties[self.get_string(name_idx)] = self.get_string(value_idx)
+
+    def read_station(self, location):
+        record_offset, _, properties_offset = location
+        station_idx, first_property, properties_count = STATION_RECORD.unpack_from(self.buffer, record_offset)
+
+        station = Station(self.agent_type, self.get_string(station_idx))
+        self.read_properties(station, properties_offset, first_property, properties_count)
+        return station
+
+    def read_route(self, location):
+        record_offset, stops_offset, properties_offset = location
+        route_idx, route_number_idx, active_from_idx, active_to_idx, \
+            first_property, properties_count, first_stop, stops_count = \
+            ROUTE_RECORD.unpack_from(self.buffer, record_offset)
+
+        route = Route(self.agent_type, self.get_string(route_idx))
+        route.route_number = self.get_string(route_number_idx)
+        route.active_from_date = self.get_string(active_from_idx)
+        route.active_to_date = self.get_string(active_to_idx)
+        self.read_properties(route, properties_offset, first_property, properties_count)
+
+        for station_idx, arrival_time, departure_time in STOP_RECORD.iter_unpack(
+                self.buffer[stops_offset + first_stop * STOP_RECORD.size:
+                            stops_offset + (first_stop + stops_count) * STOP_RECORD.size]):
+            route_point = RoutePoint(self.agent_type, route.route_id, self.get_string(station_idx))
+            route_point.raw_arrival_time = arrival_time if arrival_time != NO_TIME else None
+            route_point.raw_departure_time = departure_time if departure_time != NO_TIME else None
+            route.add_route_point(route_point)
+        return route
+
+    def build_model(self):
+        model = ModelAccessor()
+        model.agent_type = self.agent_type
+        model.stations = RecordMapping(self.station_locations, self.read_station)
+        model.routes = RecordMapping(self.route_locations, self.read_route)
+        return model
+
+
+def save_model_binary(model, fileobj):
+    ModelWriter(fileobj, model.agent_type).write_model(model)
+
+
+class FingerprintWriter:
+    """Writable file object hashing the written data"""
+
+    def __init__(self):
+        self.checksum = hashlib.sha256()
+
+    def write(self, data):
+        self.checksum.update(data)
+        return len(data)
+
+
+def get_model_fingerprint(model):
+    ordered_model = ModelAccessor()
+    ordered_model.agent_type = model.agent_type
+    ordered_model.stations = dict(sorted(model.stations.items()))
+    ordered_model.routes = dict(sorted(model.routes.items()))
+
+    fileobj = FingerprintWriter()
+    save_model_binary(ordered_model, fileobj)
+    return fileobj.checksum.hexdigest()
+
+
+def load_model_binary(fileobj):
+    magic = fileobj.read(len(FORMAT_MAGIC))
+    fileobj.seek(0)
+    if magic == FORMAT_MAGIC:
+        return ModelReader.open(fileobj).build_model()
+
+    model = ModelAccessor()
+    model.restore_binary(fileobj)
+    return model
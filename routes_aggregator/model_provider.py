@@ -1,18 +1,30 @@
+import functools
 import time
 import requests
 from lxml import html
 
+from routes_aggregator.fetcher import Fetcher
+from routes_aggregator.http_cache import CachingAdapter
 from routes_aggregator.model import ModelAccessor, Station, Route, RoutePoint
 
 
 class BaseAgent:
 
-    def __init__(self, agent_type, logger):
+    def __init__(self, agent_type, logger, response_cache=None, **fetcher_options):
+        if response_cache is not None:
+            fetcher_options['adapter_factory'] = functools.partial(CachingAdapter, response_cache)
+            if response_cache.offline:
+                fetcher_options['request_rate'] = None
+
         self.session = requests.session()
+        self.fetcher = Fetcher(self.session, logger, **fetcher_options)
 
         self.agent_type = agent_type
         self.logger = logger
 
+    def close(self):
+        self.fetcher.close()
+
     @staticmethod
     def prepare_time(time):
         if not time or len(time) == 1:
@@ -23,8 +35,8 @@ class BaseAgent:
 
 class UZSubwayAgent(BaseAgent):
 
-    def __init__(self, agent_type, logger):
-        super().__init__(agent_type, logger)
+    def __init__(self, agent_type, logger, **options):
+        super().__init__(agent_type, logger, **options)
 
         self.language_map = {"ua": "", "ru": "_ru", "en": "_en"}
 
@@ -32,12 +44,15 @@ class UZSubwayAgent(BaseAgent):
     def prepare_date(date):
         return date
 
-    def build_model(self, model):
+    def build_model(self, model, model_writer=None):
         self.logger.debug('ModelProvider: Building model \'{}\''.format(self.agent_type))
 
         model.agent_type = self.agent_type
         self.build_stations(model)
-        self.build_routes(model)
+        if model_writer is not None:
+            for station in model.stations.values():
+                model_writer.add_station(station)
+        self.build_routes(model, model_writer)
 
         self.logger.debug('ModelProvider: Built model \'{}\', {} station(s), {} route(s)'.format(
             self.agent_type, len(model.stations), len(model.routes))
@@ -53,10 +68,11 @@ class UZSubwayAgent(BaseAgent):
         station_schedule_url = 'http://swrailway.gov.ua/timetable/eltrain/?geo2_list=1&lng={language}'
         station_table_url = "http://swrailway.gov.ua/timetable/eltrain/?sid={station_id}&lng={language}"
 
-        for item in self.language_map.items():
+        schedule_responses = self.fetcher.fetch_all(
+            station_schedule_url.format(language=suffix) for suffix in self.language_map.values()
+        )
 
-            language = item[0]
-            response = self.session.get(station_schedule_url.format(language=item[1]))
+        for language, response in zip(self.language_map.keys(), schedule_responses):
 
             if response.ok:
                 tree = html.fromstring(response.text)
@@ -80,50 +96,49 @@ class UZSubwayAgent(BaseAgent):
             len(model.stations.values()))
         )
 
-        for i, station in enumerate(model.stations.values()):
-
-            station_id = station.station_id
-            time.sleep(0.1)
-
-            for item in self.language_map.items():
-
-                language = item[0]
-                response = self.session.get(station_table_url.format(
-                    station_id=station_id, language=item[1]))
-
-                if response.ok:
-                    tree = html.fromstring(response.text)
-                    for index, element in enumerate(tree.xpath(station_table_row_xpath)):
-                        links = element.xpath('./td/a[@class=\'et\']')
+        station_pages = self.fetcher.fetch_each(
+            [(station_id, language)
+             for station_id in list(model.stations.keys())
+             for language in self.language_map.keys()],
+            lambda page: station_table_url.format(
+                station_id=page[0], language=self.language_map[page[1]])
+        )
 
-                        href = links[0].get('href') if len(links) else ''
-                        if href and href.startswith('.?tid'):
-                            route_id = href[6:href.find('&')]
+        for (station_id, language), response in station_pages:
 
-                            children = element.getchildren()
-                            route = model.find_route(route_id)
-                            if not route:
-                                route = Route(self.agent_type, route_id)
-                                model.add_route(route)
-                                if len(children) >= 6:
-                                    route.route_number = links[0].text.strip(' /\\')
-                                    route.active_from_date = self.prepare_date(children[5].text)
-                                    route.active_to_date = self.prepare_date(children[6].text)
+            if response.ok:
+                tree = html.fromstring(response.text)
+                for index, element in enumerate(tree.xpath(station_table_row_xpath)):
+                    links = element.xpath('./td/a[@class=\'et\']')
+
+                    href = links[0].get('href') if len(links) else ''
+                    if href and href.startswith('.?tid'):
+                        route_id = href[6:href.find('&')]
+
+                        children = element.getchildren()
+                        route = model.find_route(route_id)
+                        if not route:
+                            route = Route(self.agent_type, route_id)
+                            model.add_route(route)
                             if len(children) >= 6:
-                                route.set_periodicity(children[1].text.strip(' /\\'), language)
-                        elif index == 0:
-                            station = model.find_station(station_id)
-                            if station is not None:
-                                location_parameters = links[0].text.strip('()').split('/')
-                                if len(location_parameters) > 1:
-                                    station.set_state_name(location_parameters[0].strip(), language)
-                                    station.set_country_name(location_parameters[1].strip(), language)
-                else:
-                    self.logger.debug('ModelProvider: Response state unacceptable: {} {}'.format(
-                        response.status_code, response.reason)
-                    )
+                                route.route_number = links[0].text.strip(' /\\')
+                                route.active_from_date = self.prepare_date(children[5].text)
+                                route.active_to_date = self.prepare_date(children[6].text)
+                        if len(children) >= 6:
+                            route.set_periodicity(children[1].text.strip(' /\\'), language)
+                    elif index == 0:
+                        station = model.find_station(station_id)
+                        if station is not None:
+                            location_parameters = links[0].text.strip('()').split('/')
+                            if len(location_parameters) > 1:
+                                station.set_state_name(location_parameters[0].strip(), language)
+                                station.set_country_name(location_parameters[1].strip(), language)
+            else:
+                self.logger.debug('ModelProvider: Response state unacceptable: {} {}'.format(
+                    response.status_code, response.reason)
+                )
 
-    def build_routes(self, model):
+    def build_routes(self, model, model_writer=None):
         route_table_row_xpath = "/html/body/table/tr[2]/td/table/tr[3]/td[4]/table/tr/td/" \
                                   "table/tr[2]/td/center/table/tr/td/table/tr[@class=\'on\' or @class=\'onx\']"
         route_table_url = "http://swrailway.gov.ua/timetable/eltrain/?tid={route_id}"
@@ -132,9 +147,12 @@ class UZSubwayAgent(BaseAgent):
             len(model.routes.values()))
         )
 
-        for i, route in enumerate(model.routes.values()):
-            response = self.session.get(route_table_url.format(route_id=route.route_id))
-            time.sleep(0.1)
+        route_pages = self.fetcher.fetch_each(
+            list(model.routes.values()),
+            lambda route: route_table_url.format(route_id=route.route_id)
+        )
+
+        for route, response in route_pages:
 
             if response.ok:
                 tree = html.fromstring(response.text)
@@ -158,25 +176,28 @@ class UZSubwayAgent(BaseAgent):
                     response.status_code, response.reason)
                 )
 
+            if model_writer is not None:
+                model_writer.add_route(route)
+
 
 class UZAgent(BaseAgent):
 
-    def __init__(self, agent_type, logger):
-        super().__init__(agent_type, logger)
+    def __init__(self, agent_type, logger, **options):
+        super().__init__(agent_type, logger, **options)
 
         self.language_map = {"ua": "", "en": "en"}
 
-    def build_model(self, model):
+    def build_model(self, model, model_writer=None):
         self.logger.debug('ModelProvider: Building model \'{}\''.format(self.agent_type))
 
         model.agent_type = self.agent_type
-        self.build_stations(model)
+        self.build_stations(model, model_writer)
 
         self.logger.debug('ModelProvider: Built model \'{}\', {} station(s), {} route(s)'.format(
             self.agent_type, len(model.stations), len(model.routes))
         )
 
-    def build_stations(self, model):
+    def build_stations(self, model, model_writer=None):
 
         station_schedule_url = 'http://www.uz.gov.ua/{language}/passengers/timetable/' \
                                '?station={station_id}&by_station=1'
@@ -189,131 +210,153 @@ class UZAgent(BaseAgent):
         route_point_xpath = '//*[@id="cpn-timetable"]/table[2]/tbody/tr'
 
         station_name_offset_map = {"ua": 19, "en": 25}
-        stations_to_build = set()
-        routes_to_build = set()
-
-        stations_to_build.add('22000')
-
-        while stations_to_build or routes_to_build:
-
-            self.logger.debug('ModelProvider: Station building session - {} station(s) to build'.format(
-                len(stations_to_build))
-            )
-
-            for i, station_id in enumerate(stations_to_build):
-
-                time.sleep(0.1)
-                for item in self.language_map.items():
-
-                    language = item[0]
-                    response = self.session.get(
-                        station_schedule_url.format(language=item[1], station_id=station_id)
+        scheduled_station_ids = {'22000'}
+        pending_pages = {}
+
+        def prepare_pages(page_type, item_id):
+            pending_pages[(page_type, item_id)] = len(self.language_map)
+            return [(page_type, item_id, language) for language in self.language_map.keys()]
+
+        def complete_page(page_type, item_id):
+            # an item is written out once the pages of all its languages are built
+            pending_pages[(page_type, item_id)] -= 1
+            if pending_pages[(page_type, item_id)] or model_writer is None:
+                return
+            del pending_pages[(page_type, item_id)]
+            if page_type == 'station':
+                station = model.find_station(item_id)
+                if station is not None:
+                    model_writer.add_station(station)
+            else:
+                route = model.find_route(item_id)
+                if route is not None:
+                    model_writer.add_route(route)
+
+        def prepare_url(page):
+            page_type, item_id, language = page
+            if page_type == 'station':
+                return station_schedule_url.format(
+                    language=self.language_map[language], station_id=item_id)
+            return route_page_url.format(
+                language=self.language_map[language], route_id=item_id)
+
+        def build_station(station_id, language, tree):
+            pages = []
+            station_name_elements = tree.xpath(station_name_xpath)
+
+            if len(station_name_elements) == 1:
+                station = model.find_station(station_id)
+                if not station:
+                    station = Station(self.agent_type, station_id)
+                    model.add_station(station)
+
+                station_name_text = station_name_elements[0].text[station_name_offset_map[language]:]
+                last_bracket_idx = station_name_text.rfind('(')
+                if last_bracket_idx != -1:
+                    station.set_station_name(station_name_text[:last_bracket_idx - 1], language)
+                    station.set_country_name(station_name_text[last_bracket_idx:].strip('()'), language)
+
+                for route_element in tree.xpath(route_row_xpath):
+                    href = route_element.get('href')
+                    if href and href.startswith('?ntrain='):
+                        route_id = href[8:href.find('&')]
+
+                        route = model.find_route(route_id)
+                        if not route:
+                            route = Route(self.agent_type, route_id)
+                            model.add_route(route)
+                            pages.extend(prepare_pages('route', route_id))
+            return pages
+
+        def build_route(route_id, language, tree):
+            pages = []
+            route = model.find_route(route_id)
+            if route is None:
+                return pages
+
+            route_info_elements = tree.xpath(route_information_xpath)
+            if len(route_info_elements):
+                children = route_info_elements[0].getchildren()
+                if children:
+                    if not route.route_number:
+                        route_number_components = children[1].text.split()
+                        if route_number_components:
+                            route.route_number = route_number_components[0].strip()
+                    route.set_periodicity(children[2].text.strip(), language)
+
+            if len(route.route_points):
+                return pages
+
+            for route_point_row in tree.xpath(route_point_xpath):
+                children = route_point_row.getchildren()
+                if len(children) > 2:
+                    links = route_point_row.xpath('./td/a')
+                    href = links[0].get('href') if len(links) else ''
+                    if href and href.startswith('?station'):
+                        station_id = href[9:href.find('&')]
+
+                        route_point = RoutePoint(self.agent_type, route.route_id, station_id)
+                        route_point.arrival_time = self.prepare_time(children[1].text)
+                        route_point.departure_time = self.prepare_time(children[2].text)
+                        route.add_route_point(route_point)
+
+                        if station_id not in scheduled_station_ids and \
+                           model.find_station(station_id) is None:
+                            scheduled_station_ids.add(station_id)
+                            pages.extend(prepare_pages('station', station_id))
+            return pages
+
+        def build_page(page, response):
+            page_type, item_id, language = page
+
+            try:
+                if not response.ok:
+                    self.logger.debug('ModelProvider: Response state unacceptable: {} {}'.format(
+                        response.status_code, response.reason)
                     )
+                    return []
 
-                    if response.ok:
-                        tree = html.fromstring(response.text)
-                        station_name_elements = tree.xpath(station_name_xpath)
-
-                        if len(station_name_elements) == 1:
-                            station = model.find_station(station_id)
-                            if not station:
-                                station = Station(self.agent_type, station_id)
-                                model.add_station(station)
-
-                            station_name_text = station_name_elements[0].text[station_name_offset_map[language]:]
-                            last_bracket_idx = station_name_text.rfind('(')
-                            if last_bracket_idx != -1:
-                                station.set_station_name(station_name_text[:last_bracket_idx - 1], language)
-                                station.set_country_name(station_name_text[last_bracket_idx:].strip('()'), language)
-
-                            for route_element in tree.xpath(route_row_xpath):
-                                href = route_element.get('href')
-                                if href and href.startswith('?ntrain='):
-                                    route_id = href[8:href.find('&')]
-
-                                    route = model.find_route(route_id)
-                                    if not route:
-                                        route = Route(self.agent_type, route_id)
-                                        model.add_route(route)
-                                        routes_to_build.add(route_id)
-                    else:
-                        self.logger.debug('ModelProvider: Response state unacceptable: {} {}'.format(
-                            response.status_code, response.reason)
-                        )
-            stations_to_build.clear()
-
-            self.logger.debug('ModelProvider: Routes building session - {} route(s) to build'.format(
-                len(routes_to_build))
-            )
-
-            for i, route_id in enumerate(routes_to_build):
-
-                route = model.find_route(route_id)
-                if route is None:
-                    continue
-
-                time.sleep(0.1)
-                for item in self.language_map.items():
-                    language = item[0]
-                    response = self.session.get(
-                        route_page_url.format(language=item[1], route_id=route.route_id)
-                    )
+                tree = html.fromstring(response.text)
+                if page_type == 'station':
+                    return build_station(item_id, language, tree)
+                return build_route(item_id, language, tree)
+            finally:
+                complete_page(page_type, item_id)
 
-                    if response.ok:
-                        tree = html.fromstring(response.text)
-                        route_info_elements = tree.xpath(route_information_xpath)
-                        if len(route_info_elements):
-                            children = route_info_elements[0].getchildren()
-                            if children:
-                                if not route.route_number:
-                                    route_number_components = children[1].text.split()
-                                    if route_number_components:
-                                        route.route_number = route_number_components[0].strip()
-                                route.set_periodicity(children[2].text.strip(), language)
-
-                        if len(route.route_points):
-                            continue
-
-                        for route_point_row in tree.xpath(route_point_xpath):
-                            children = route_point_row.getchildren()
-                            if len(children) > 2:
-                                links = route_point_row.xpath('./td/a')
-                                href = links[0].get('href') if len(links) else ''
-                                if href and href.startswith('?station'):
-                                    station_id = href[9:href.find('&')]
-
-                                    route_point = RoutePoint(self.agent_type, route.route_id, station_id)
-                                    route_point.arrival_time = self.prepare_time(children[1].text)
-                                    route_point.departure_time = self.prepare_time(children[2].text)
-                                    route.add_route_point(route_point)
-
-                                    station = model.find_station(station_id)
-                                    if station is None:
-                                        stations_to_build.add(station_id)
-                    else:
-                        self.logger.debug('Response state unacceptable: {} {}'.format(
-                            response.status_code, response.reason)
-                        )
-
-            routes_to_build.clear()
+        self.fetcher.crawl(prepare_pages('station', '22000'), prepare_url, build_page)
 
 
 class ModelProvider:
 
-    def __init__(self, storage_adapter, logger):
+    def __init__(self, storage_adapter, logger, **agent_options):
         self.agent_types = {'uz': UZAgent, 'uzs': UZSubwayAgent}
         self.storage_adapter = storage_adapter
         self.logger = logger
+        self.agent_options = agent_options
 
     def build_model(self, agent_type):
         model = ModelAccessor()
 
-        model_builder = self.agent_types.get(agent_type)
-        if model_builder:
-            model_builder(agent_type, self.logger).build_model(model)
-
+        # the current model is streamed to the storage while it is crawled
+        model_writer = self.storage_adapter.open_model_writer(agent_type, "current")
+        try:
+            model_builder = self.agent_types.get(agent_type)
+            if model_builder:
+                agent = model_builder(agent_type, self.logger, **self.agent_options)
+                try:
+                    agent.build_model(model, model_writer)
+                finally:
+                    agent.close()
+        except Exception:
+            if model_writer is not None:
+                model_writer.abort()
+            raise
+
+        if model_writer is not None:
+            model_writer.close()
+        else:
+            self.save_model(model, "current")
         self.save_model(model, time.strftime("archive/%d.%m.%Y"))
-        self.save_model(model, "current")
         return model
 
     def save_model(self, model, object_name):
@@ -0,0 +1,120 @@
+import heapq
+import re
+import unicodedata
+from bisect import bisect_left
+
+
+APOSTROPHES_PATTERN = re.compile('[’ʼ`´]')
+SPACES_PATTERN = re.compile(r'\s+')
+
+
+def normalize_name(name):
+    name = unicodedata.normalize('NFKC', name or '').casefold()
+    name = APOSTROPHES_PATTERN.sub("'", name).replace('ё', 'е')
+    return SPACES_PATTERN.sub(' ', name).strip()
+
+
+def build_trigrams(name):
+    padded_name = '  ' + name + ' '
+    return set(padded_name[i:i + 3] for i in range(len(padded_name) - 2))
+
+
+class StationNameIndex:
+    """Sorted array of normalized station names answering STARTS_WITH and STRICT
+    lookups, with a trigram inverted index over the same names for FUZZY lookups"""
+
+    STATION_NAME_PROPERTIES = ['station_name_ua', 'station_name_en', 'station_name_ru']
+    SEARCH_MODES = ('STARTS_WITH', 'STRICT', 'FUZZY')
+    FUZZY_THRESHOLD = 0.3
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.agent_names = {}
+
+    @classmethod
+    def build_names(cls, model):
+        names = []
+        for station in model.stations.values():
+            properties = station.get_properties() or {}
+            for name in set(
+                    normalize_name(properties.get(property_name))
+                    for property_name in cls.STATION_NAME_PROPERTIES):
+                if name:
+                    names.append((name, station))
+        names.sort(key=lambda item: item[0])
+        return [item[0] for item in names], [item[1] for item in names]
+
+    @staticmethod
+    def build_trigram_postings(names):
+        postings = {}
+        trigram_counts = []
+        for i, name in enumerate(names):
+            trigrams = build_trigrams(name)
+            for trigram in trigrams:
+                postings.setdefault(trigram, []).append(i)
+            trigram_counts.append(len(trigrams))
+        return postings, trigram_counts
+
+    def build_model(self, model):
+        self.logger.debug('StationNameIndex: building \'{}\' model'.format(model.agent_type))
+        names, stations = self.build_names(model)
+        self.agent_names[model.agent_type] = (names, stations) + self.build_trigram_postings(names)
+        self.logger.debug('StationNameIndex: built \'{}\' model'.format(model.agent_type))
+
+    def remove_model(self, agent_type):
+        self.agent_names.pop(agent_type, None)
+
+    def supports(self, search_mode, agent_types=None):
+        # the index is cold while the model of any of the agent types is not loaded
+        if not self.agent_names or (search_mode or '').upper() not in self.SEARCH_MODES:
+            return False
+        return all(agent_type in self.agent_names for agent_type in agent_types or [])
+
+    def find_stations(self, station_names, search_mode, limit):
+        search_mode = search_mode.upper()
+        patterns = set(filter(None, map(normalize_name, station_names)))
+        if search_mode == 'FUZZY':
+            return self.find_similar_stations(patterns, limit)
+
+        strict = search_mode == 'STRICT'
+        matches = {}
+        for names, stations, _, _ in list(self.agent_names.values()):
+            for pattern in patterns:
+                for i in range(bisect_left(names, pattern), len(names)):
+                    name = names[i]
+                    if name != pattern and (strict or not name.startswith(pattern)):
+                        break
+                    station = stations[i]
+                    rank = (name != pattern, len(name), name)
+                    domain_id = station.domain_id
+                    if domain_id not in matches or matches[domain_id][0] > rank:
+                        matches[domain_id] = (rank, station)
+
+        ranked_stations = [match[1] for match in sorted(matches.values(), key=lambda match: match[0])]
+        return ranked_stations[:limit] if limit is not None else ranked_stations
+
+    def find_similar_stations(self, patterns, limit):
+        matches = {}
+        for names, stations, postings, trigram_counts in list(self.agent_names.values()):
+            for pattern in patterns:
+                pattern_trigrams = build_trigrams(pattern)
+                common_counts = {}
+                for trigram in pattern_trigrams:
+                    for i in postings.get(trigram, ()):
+                        common_counts[i] = common_counts.get(i, 0) + 1
+
+                for i, common_count in common_counts.items():
+                    similarity = common_count / (len(pattern_trigrams) + trigram_counts[i] - common_count)
+                    if similarity < self.FUZZY_THRESHOLD:
+                        continue
+                    station = stations[i]
+                    rank = (-similarity, len(names[i]), names[i])
+                    domain_id = station.domain_id
+                    if domain_id not in matches or matches[domain_id][0] > rank:
+                        matches[domain_id] = (rank, station)
+
+        if limit is not None:
+            ranked_matches = heapq.nsmallest(limit, matches.values(), key=lambda match: match[0])
+        else:
+            ranked_matches = sorted(matches.values(), key=lambda match: match[0])
+        return [match[1] for match in ranked_matches]
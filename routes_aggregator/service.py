@@ -1,11 +1,20 @@
 import logging
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
+from routes_aggregator.cache import PathResultCache
+from routes_aggregator.connection_index import DirectConnectionIndex
+from routes_aggregator.csv_export import CsvModelExporter
 from routes_aggregator.db_accessor import DbAccessor
 from routes_aggregator.exceptions import ApplicationException
+from routes_aggregator.fetcher import Fetcher
+from routes_aggregator.http_cache import ResponseCache
+from routes_aggregator.journey_planner import ConnectionScanPlanner, RaptorPlanner
+from routes_aggregator.memory_accessor import MemoryAccessor
 from routes_aggregator.model_provider import ModelProvider
+from routes_aggregator.search_index import StationNameIndex
 from routes_aggregator.utils import singleton, read_config_file
-from routes_aggregator.storage_adapter import FilesystemStorageAdapter
+from routes_aggregator.storage_adapter import FilesystemStorageAdapter, S3StorageAdapter, CachingStorageAdapter
 
 
 def shielded_execute(executor):
@@ -31,15 +40,126 @@ class Service:
 
         self.init_logger(self.logger, config)
 
-        self.db_accessor = DbAccessor(
-            (config['db_user'], config['db_password']),
-            self.logger
-        )
+        response_cache = None
+        if config.get('http_cache_path'):
+            response_cache = ResponseCache(
+                config['http_cache_path'],
+                offline=config.get('http_cache_mode', 'online').lower() == 'offline',
+                max_age=self.get_optional_value(config, 'http_cache_max_age', float)
+            )
+
         self.model_provider = ModelProvider(
-            FilesystemStorageAdapter(config['storage_path']),
-            self.logger
+            self.create_storage_adapter(config),
+            self.logger,
+            response_cache=response_cache,
+            workers_count=int(config.get('crawler_workers_count', Fetcher.DEFAULT_WORKERS_COUNT)),
+            request_rate=float(config.get('crawler_request_rate', Fetcher.DEFAULT_REQUEST_RATE)),
+            retries_count=int(config.get('crawler_retries_count', Fetcher.DEFAULT_RETRIES_COUNT))
+        )
+
+        self.connection_scan_planner = ConnectionScanPlanner(self.logger)
+        self.raptor_planner = RaptorPlanner(self.logger)
+        self.station_name_index = StationNameIndex(self.logger)
+        self.direct_connection_index = DirectConnectionIndex(self.logger)
+        self.model_indices = [
+            self.connection_scan_planner, self.raptor_planner,
+            self.station_name_index, self.direct_connection_index
+        ]
+        model_indices = list(self.model_indices)
+
+        backend = config.get('backend', 'neo4j').lower()
+        if backend == 'memory':
+            self.accessor = MemoryAccessor(self.logger)
+            model_indices.append(self.accessor)
+        else:
+            self.accessor = DbAccessor(
+                (config['db_user'], config['db_password']),
+                self.logger,
+                uri=config.get('db_uri', DbAccessor.DEFAULT_URI),
+                read_uris=[uri.strip() for uri in config.get('db_read_uris', '').split(',') if uri.strip()],
+                max_connection_pool_size=self.get_optional_value(config, 'db_max_connection_pool_size', int),
+                connection_acquisition_timeout=self.get_optional_value(
+                    config, 'db_connection_acquisition_timeout', float),
+                batch_size=int(config.get('db_batch_size', DbAccessor.DEFAULT_BATCH_SIZE)),
+                cache_max_entries=int(config.get('cache_max_entries', DbAccessor.DEFAULT_CACHE_MAX_ENTRIES)),
+                cache_max_bytes=self.get_optional_value(config, 'cache_max_bytes', int),
+                cache_ttl=self.get_optional_value(config, 'cache_ttl', float),
+                stage_lease=float(config.get('db_stage_lease', DbAccessor.DEFAULT_STAGE_LEASE)),
+                retired_versions_grace_period=float(config.get(
+                    'db_retired_versions_grace_period', DbAccessor.DEFAULT_RETIRED_VERSIONS_GRACE_PERIOD)),
+                versions_ttl=float(config.get('db_versions_ttl', DbAccessor.DEFAULT_VERSIONS_TTL))
+            )
+
+        self.path_cache = PathResultCache(
+            max_entries=int(config.get('path_cache_max_entries', PathResultCache.DEFAULT_MAX_ENTRIES)),
+            max_bytes=self.get_optional_value(config, 'path_cache_max_bytes', int),
+            ttl=self.get_optional_value(config, 'path_cache_ttl', float)
         )
 
+        self.models = {}
+        self.load_models(model_indices)
+
+        # models updated by other processes are reloaded from the storage in the background
+        self.model_loader = ThreadPoolExecutor(max_workers=1)
+        if backend != 'memory':
+            self.accessor.add_version_listener(self.on_model_version_changed)
+
+    def load_models(self, model_indices):
+        for agent_type in self.model_provider.agent_types:
+            try:
+                model = self.model_provider.load_model(agent_type, 'current')
+            except Exception as e:
+                self.logger.error('Service: unable to load \'{}\' model: {}'.format(agent_type, e))
+            else:
+                self.models[agent_type] = model
+                for model_index in model_indices:
+                    model_index.build_model(model)
+
+    def on_model_version_changed(self, agent_type, model_version):
+        self.path_cache.invalidate(agent_type)
+        if model_version is not None:
+            self.model_loader.submit(self.reload_model, agent_type)
+
+    def reload_model(self, agent_type):
+        try:
+            model = self.model_provider.load_model(agent_type, 'current')
+        except Exception as e:
+            self.logger.error('Service: unable to reload \'{}\' model: {}'.format(agent_type, e))
+        else:
+            self.update_model_indices(model)
+
+    def update_model_indices(self, model):
+        self.models[model.agent_type] = model
+        for model_index in self.model_indices:
+            model_index.build_model(model)
+        self.path_cache.invalidate(model.agent_type)
+
+    def create_storage_adapter(self, config):
+        storage_type = config.get('storage_type', 'filesystem').lower()
+        if storage_type == 's3':
+            storage_adapter = S3StorageAdapter(
+                (config['s3_access_key'], config['s3_secret_key']),
+                bucket_name=config.get('s3_bucket_name', S3StorageAdapter.DEFAULT_BUCKET_NAME),
+                endpoint_url=config.get('s3_endpoint_url') or None,
+                compression=config.get('s3_compression', S3StorageAdapter.DEFAULT_COMPRESSION)
+            )
+        else:
+            storage_adapter = FilesystemStorageAdapter(config['storage_path'])
+
+        if config.get('storage_cache_path'):
+            storage_adapter = CachingStorageAdapter(
+                storage_adapter,
+                config['storage_cache_path'],
+                max_bytes=self.get_optional_value(config, 'storage_cache_max_bytes', int),
+                logger=self.logger
+            )
+        return storage_adapter
+
+    @staticmethod
+    def get_optional_value(config, key, value_type):
+        value = config.get(key)
+        return value_type(value) if value not in (None, '') else None
+
     @staticmethod
     def init_logger(logger, config):
 
@@ -69,15 +189,25 @@ class Service:
 
     @shielded_execute
     def get_station(self, station_id):
-        return self.db_accessor.get_station(station_id)
+        return self.accessor.get_station(station_id)
+
+    @shielded_execute
+    def get_stations(self, station_ids):
+        return self.accessor.get_stations(station_ids)
 
     @shielded_execute
     def find_stations(self, station_names, search_mode=None, limit=None):
-        return self.db_accessor.find_stations(station_names, search_mode, limit)
+        if self.station_name_index.supports(search_mode, self.accessor.get_agent_types()):
+            return self.station_name_index.find_stations(station_names, search_mode, limit)
+        return self.accessor.find_stations(station_names, search_mode, limit)
 
     @shielded_execute
     def get_route(self, route_id):
-        return self.db_accessor.get_route(route_id)
+        return self.accessor.get_route(route_id)
+
+    @shielded_execute
+    def get_routes(self, route_ids):
+        return self.accessor.get_routes(route_ids)
 
     @shielded_execute
     def find_routes(self, route_numbers=None, station_ids=None,
@@ -86,14 +216,14 @@ class Service:
 
         if route_numbers:
             routes.extend(
-                self.db_accessor.find_routes_by_route_numbers(
+                self.accessor.find_routes_by_route_numbers(
                     route_numbers, search_mode, limit
                 )
             )
 
         if station_ids:
             routes.extend(
-                self.db_accessor.find_routes_by_station_ids(
+                self.accessor.find_routes_by_station_ids(
                     station_ids, limit
                 )
             )
@@ -102,26 +232,114 @@ class Service:
 
     @shielded_execute
     def find_paths(self, station_ids, search_mode=None,
-                   max_transitions_count=None, limit=None):
+                   max_transitions_count=None, limit=None, departure_time=None,
+                   latest_departure_time=None):
         search_mode = search_mode.upper() if search_mode else "SIMPLE"
 
+        key = self.prepare_paths_key(
+            station_ids, search_mode, max_transitions_count, limit,
+            departure_time, latest_departure_time
+        )
+        return list(self.path_cache.get(key, lambda: self.search_paths(
+            station_ids, search_mode, max_transitions_count, limit,
+            departure_time, latest_departure_time
+        )))
+
+    @shielded_execute
+    def find_paths_many(self, queries):
+        queries = list(map(self.prepare_search_arguments, queries))
+        versions = self.path_cache.get_versions()
+        results = [None] * len(queries)
+        accessor_queries = []
+
+        for i, query in enumerate(queries):
+            key = self.prepare_paths_key(**query)
+            results[i] = self.path_cache.lookup(key)
+            if results[i] is not None:
+                continue
+
+            search_mode, station_ids = query['search_mode'], query['station_ids']
+            if search_mode in ('TRANSFERS', 'TRANSITIONS') or \
+               (search_mode == 'SIMPLE' and not self.direct_connection_index.supports(station_ids)):
+                accessor_queries.append((i, key))
+            else:
+                results[i] = self.search_paths(**query)
+                self.path_cache.store(key, results[i], versions)
+
+        if accessor_queries:
+            accessor_results = self.accessor.find_paths_many([
+                (queries[i]['search_mode'], queries[i]['station_ids'],
+                 queries[i]['max_transitions_count'], queries[i]['limit'])
+                for i, _ in accessor_queries
+            ])
+            for (i, key), paths in zip(accessor_queries, accessor_results):
+                results[i] = paths
+                self.path_cache.store(key, paths, versions)
+
+        return [list(paths) for paths in results]
+
+    @staticmethod
+    def prepare_search_arguments(query):
+        return {
+            'station_ids': query['station_ids'],
+            'search_mode': (query.get('search_mode') or 'SIMPLE').upper(),
+            'max_transitions_count': query.get('max_transitions_count'),
+            'limit': query.get('limit'),
+            'departure_time': query.get('departure_time'),
+            'latest_departure_time': query.get('latest_departure_time')
+        }
+
+    @staticmethod
+    def prepare_paths_key(station_ids, search_mode, max_transitions_count, limit,
+                          departure_time, latest_departure_time):
+        return (
+            tuple(tuple(sorted(set(ids))) for ids in station_ids), search_mode,
+            max_transitions_count, limit, departure_time, latest_departure_time
+        )
+
+    def search_paths(self, station_ids, search_mode, max_transitions_count,
+                     limit, departure_time, latest_departure_time):
         if search_mode == "SIMPLE":
-            return self.db_accessor.find_paths_with_single_route(station_ids, limit)
+            if self.direct_connection_index.supports(station_ids):
+                return self.direct_connection_index.find_paths(station_ids, limit)
+            return self.accessor.find_paths_with_single_route(station_ids, limit)
         elif search_mode == "TRANSFERS":
-            return self.db_accessor.find_paths_with_multiple_routes(station_ids, limit)
+            return self.accessor.find_paths_with_multiple_routes(station_ids, limit)
         elif search_mode == "TRANSITIONS":
-            return self.db_accessor.find_shortest_paths(
+            return self.accessor.find_shortest_paths(
                 station_ids[0], station_ids[-1],
                 max_transitions_count, limit
             )
+        elif search_mode == "EARLIEST_ARRIVAL":
+            return self.connection_scan_planner.find_earliest_arrival_paths(
+                station_ids[0], station_ids[-1], departure_time
+            )
+        elif search_mode == "PARETO":
+            return self.raptor_planner.find_pareto_paths(
+                station_ids[0], station_ids[-1], departure_time,
+                latest_departure_time, max_transitions_count
+            )[:limit]
         else:
             return []
 
+    @shielded_execute
+    def get_cache_stats(self):
+        return dict(self.accessor.get_cache_stats(), paths=self.path_cache.stats)
+
     @shielded_execute
     def request_model_update(self, agent_type, build_model):
         if build_model:
             model = self.model_provider.build_model(agent_type)
         else:
             model = self.model_provider.load_model(agent_type, 'current')
-        self.db_accessor.build_model(model)
+        self.accessor.build_model(model, self.models.get(agent_type))
+        self.update_model_indices(model)
         return "ok"
+
+    @shielded_execute
+    def request_model_export(self, export_path, agent_types=None):
+        exporter = CsvModelExporter(export_path)
+        for agent_type in agent_types or list(self.models):
+            model = self.models.get(agent_type) or self.model_provider.load_model(agent_type, 'current')
+            exporter.export_model(model)
+        return exporter.build_import_command()
@@ -1,9 +1,28 @@
+import gzip
+import hashlib
+import json
 import os
 import os.path
+import tempfile
+import threading
+import time
+import uuid
+import zlib
 import boto3
 from botocore.client import Config
 
-from routes_aggregator.model import ModelAccessor
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from routes_aggregator.exceptions import ModelChecksumException
+from routes_aggregator.model_format import ModelWriter, save_model_binary, load_model_binary
 
 
 class StorageAdapter:
@@ -14,6 +33,12 @@ class StorageAdapter:
     def prepare_file_name(self, agent_type):
         return agent_type + '.data'
 
+    def get_model_version(self, agent_type, object_name):
+        return None
+
+    def open_model_writer(self, agent_type, object_name):
+        return None
+
 
 class FilesystemStorageAdapter(StorageAdapter):
 
@@ -28,24 +53,193 @@ class FilesystemStorageAdapter(StorageAdapter):
             os.mkdir(folder_name)
         return os.path.join(folder_name, self.prepare_file_name(agent_type))
 
+    def open_model_writer(self, agent_type, object_name):
+        return FilesystemModelWriter(self.prepare_path(agent_type, object_name), agent_type)
+
     def save_model(self, model, object_name):
-        with open(self.prepare_path(model.agent_type, object_name), 'wb') as fileobj:
-            model.save_binary(fileobj)
+        self.open_model_writer(model.agent_type, object_name).write_model(model)
 
     def load_model(self, agent_type, object_name):
-        model = ModelAccessor()
         with open(self.prepare_path(agent_type, object_name), 'rb') as fileobj:
-            model.restore_binary(fileobj)
-        return model
+            return load_model_binary(fileobj)
+
+
+class FilesystemModelWriter(ModelWriter):
+    """Model writer streaming into a temporary file which replaces the target
+    on close, so that memory mapped readers of the previous model stay valid"""
+
+    def __init__(self, path, agent_type, **kwargs):
+        self.path = path
+        descriptor, self.temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        super().__init__(os.fdopen(descriptor, 'wb'), agent_type, **kwargs)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            super().close()
+            self.fileobj.close()
+            os.replace(self.temp_path, self.path)
+        except Exception:
+            self.abort()
+            raise
+
+    def abort(self):
+        self.closed = True
+        self.fileobj.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+
+class S3MultipartWriter:
+    """Writable file object uploading written data as parts of a multipart upload"""
+
+    MIN_PART_SIZE = 5 * 1024 * 1024
+
+    def __init__(self, client, bucket_name, key, part_size=MIN_PART_SIZE):
+        self.client = client
+        self.bucket_name = bucket_name
+        self.key = key
+        self.part_size = max(part_size, self.MIN_PART_SIZE)
+
+        self.buffer = bytearray()
+        self.parts = []
+        self.upload_id = self.client.create_multipart_upload(
+            Bucket=self.bucket_name, Key=self.key
+        )['UploadId']
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.part_size:
+            self.upload_part()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def upload_part(self):
+        part_number = len(self.parts) + 1
+        response = self.client.upload_part(
+            Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id,
+            PartNumber=part_number, Body=bytes(self.buffer)
+        )
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+        self.buffer = bytearray()
+
+    def close(self):
+        if self.buffer or not self.parts:
+            self.upload_part()
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id,
+            MultipartUpload={'Parts': self.parts}
+        )
+
+    def abort(self):
+        self.client.abort_multipart_upload(
+            Bucket=self.bucket_name, Key=self.key, UploadId=self.upload_id
+        )
+
+
+class ChecksumWriter:
+    """Writable file object computing sha256 of the data passed to the wrapped one"""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.checksum = hashlib.sha256()
+
+    def write(self, data):
+        self.checksum.update(data)
+        return self.fileobj.write(data)
+
+    def hexdigest(self):
+        return self.checksum.hexdigest()
+
+
+class S3ModelWriter(ModelWriter):
+    """Model writer streaming compressed records into a multipart upload of a temporary
+    object, which replaces the target on close together with the checksum metadata"""
+
+    def __init__(self, storage_adapter, key, agent_type, **kwargs):
+        self.storage_adapter = storage_adapter
+        self.key = key
+        self.temp_key = '{}.{}.tmp'.format(key, uuid.uuid4().hex)
+
+        self.upload = S3MultipartWriter(
+            storage_adapter.client, storage_adapter.bucket_name, self.temp_key, storage_adapter.part_size)
+        self.compressor = storage_adapter.open_compressor(self.upload)
+        self.checksum_writer = ChecksumWriter(self.compressor or self.upload)
+        super().__init__(self.checksum_writer, agent_type, **kwargs)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            super().close()
+            if self.compressor:
+                self.compressor.close()
+            self.upload.close()
+        except Exception:
+            self.abort()
+            raise
+
+        client = self.storage_adapter.client
+        try:
+            client.copy_object(
+                Bucket=self.storage_adapter.bucket_name, Key=self.key,
+                CopySource={'Bucket': self.storage_adapter.bucket_name, 'Key': self.temp_key},
+                Metadata={
+                    self.storage_adapter.CHECKSUM_KEY: self.checksum_writer.hexdigest(),
+                    self.storage_adapter.COMPRESSION_KEY: self.storage_adapter.compression or ''
+                },
+                MetadataDirective='REPLACE'
+            )
+        finally:
+            client.delete_object(Bucket=self.storage_adapter.bucket_name, Key=self.temp_key)
+
+    def abort(self):
+        self.closed = True
+        self.upload.abort()
 
 
 class S3StorageAdapter(StorageAdapter):
 
-    def __init__(self, credentials):
+    DEFAULT_BUCKET_NAME = 'routes-aggregator'
+    DEFAULT_PART_SIZE = 8 * 1024 * 1024
+    DEFAULT_COMPRESSION = 'zstd' if zstandard else 'gzip'
+    DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+    CHECKSUM_KEY = 'sha256'
+    COMPRESSION_KEY = 'compression'
+
+    def __init__(self, credentials, bucket_name=DEFAULT_BUCKET_NAME, endpoint_url=None,
+                 compression=DEFAULT_COMPRESSION, part_size=DEFAULT_PART_SIZE, client=None):
         super().__init__()
 
+        if compression == 'zstd' and not zstandard:
+            raise ValueError('zstd compression requires the zstandard package')
+
+        self.bucket_name = bucket_name
+        self.endpoint_url = endpoint_url
+        self.compression = compression
+        self.part_size = part_size
+
         self.__credentials = credentials
-        self.__client = None
+        self.__client = client
 
     @property
     def client(self):
@@ -54,6 +248,7 @@ class S3StorageAdapter(StorageAdapter):
                 's3',
                 aws_access_key_id=self.__credentials[0],
                 aws_secret_access_key=self.__credentials[1],
+                endpoint_url=self.endpoint_url,
                 config=Config(signature_version='s3v4'))
         return self.__client
 
@@ -63,26 +258,245 @@ class S3StorageAdapter(StorageAdapter):
         object_name += self.prepare_file_name(agent_type)
         return object_name
 
+    def open_compressor(self, fileobj):
+        if self.compression == 'zstd':
+            return zstandard.ZstdCompressor().stream_writer(fileobj, closefd=False)
+        elif self.compression == 'gzip':
+            return gzip.GzipFile(fileobj=fileobj, mode='wb')
+        return None
+
+    @staticmethod
+    def open_decompressor(compression):
+        if compression == 'zstd':
+            if not zstandard:
+                raise ValueError('zstd compression requires the zstandard package')
+            return zstandard.ZstdDecompressor().decompressobj()
+        elif compression == 'gzip':
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        return None
+
+    def open_model_writer(self, agent_type, object_name):
+        return S3ModelWriter(self, self.prepare_path(agent_type, object_name), agent_type)
+
     def save_model(self, model, object_name):
-        with open('temp.data', 'wb') as fileobj:
-            model.save_binary(fileobj)
-        with open('temp.data', 'rb') as fileobj:
-            self.client.upload_fileobj(
-                fileobj,
-                'routes-aggregator',
-                self.prepare_path(model.agent_type, object_name)
-            )
-        os.remove('temp.data')
+        with self.open_model_writer(model.agent_type, object_name) as model_writer:
+            model_writer.write_model(model)
+
+    @classmethod
+    def prepare_version(cls, response):
+        return response.get('Metadata', {}).get(cls.CHECKSUM_KEY) or response['ETag'].strip('"')
+
+    def get_model_version(self, agent_type, object_name):
+        response = self.client.head_object(
+            Bucket=self.bucket_name,
+            Key=self.prepare_path(agent_type, object_name)
+        )
+        return self.prepare_version(response)
 
     def load_model(self, agent_type, object_name):
-        model = ModelAccessor()
-        with open('temp.data', 'wb') as fileobj:
-            self.client.download_fileobj(
-                'routes-aggregator',
-                self.prepare_path(agent_type, object_name),
-                fileobj
-            )
-        with open('temp.data', 'rb') as fileobj:
-            model.restore_binary(fileobj)
-        os.remove('temp.data')
-        return model
\ No newline at end of file
+        # the temporary file stays mapped by the model reader after it is closed
+        with tempfile.TemporaryFile() as fileobj:
+            self.load_model_data(agent_type, object_name, fileobj)
+            fileobj.seek(0)
+            return load_model_binary(fileobj)
+
+    def load_model_data(self, agent_type, object_name, fileobj):
+        """Streams the decompressed model into the file object, returns its version"""
+        key = self.prepare_path(agent_type, object_name)
+        response = self.client.get_object(Bucket=self.bucket_name, Key=key)
+        metadata = response.get('Metadata', {})
+
+        decompressor = self.open_decompressor(metadata.get(self.COMPRESSION_KEY))
+        checksum_writer = ChecksumWriter(fileobj)
+        body = response['Body']
+        try:
+            for chunk in body.iter_chunks(self.DOWNLOAD_CHUNK_SIZE):
+                checksum_writer.write(decompressor.decompress(chunk) if decompressor else chunk)
+            if decompressor:
+                checksum_writer.write(decompressor.flush())
+        finally:
+            body.close()
+
+        expected_checksum = metadata.get(self.CHECKSUM_KEY)
+        if expected_checksum:
+            actual_checksum = checksum_writer.hexdigest()
+            if actual_checksum != expected_checksum:
+                raise ModelChecksumException(key, expected_checksum, actual_checksum)
+
+        return self.prepare_version(response)
+
+
+class CachingStorageAdapter(StorageAdapter):
+    """Read through cache of a remote storage adapter keeping model files in a
+    local content addressed folder, revalidated by model versions and bounded by size.
+    The index may be shared by several processes, it is updated under a file lock
+    and merged with the latest written one"""
+
+    INDEX_FILE_NAME = 'index.json'
+    LOCK_FILE_NAME = 'index.lock'
+
+    def __init__(self, storage_adapter, base_path, max_bytes=None, logger=None):
+        super().__init__()
+
+        self.storage_adapter = storage_adapter
+        self.base_path = base_path
+        self.max_bytes = max_bytes
+        self.logger = logger
+
+        self.__lock = threading.RLock()
+        os.makedirs(self.base_path, exist_ok=True)
+        self.index = self.read_index()
+
+    @property
+    def index_path(self):
+        return os.path.join(self.base_path, self.INDEX_FILE_NAME)
+
+    @property
+    def lock_path(self):
+        return os.path.join(self.base_path, self.LOCK_FILE_NAME)
+
+    def read_index(self):
+        try:
+            with open(self.index_path, 'r') as fileobj:
+                index = json.load(fileobj)
+        except (OSError, ValueError):
+            index = {}
+        index.setdefault('objects', {})
+        index.setdefault('entries', {})
+        return index
+
+    def write_index(self, index):
+        descriptor, temp_path = tempfile.mkstemp(dir=self.base_path, suffix='.tmp')
+        try:
+            with os.fdopen(descriptor, 'w') as fileobj:
+                json.dump(index, fileobj)
+            os.replace(temp_path, self.index_path)
+        except OSError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def update_index(self, updater):
+        with self.__lock, open(self.lock_path, 'a') as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                index = self.read_index()
+                if updater(index) is not False:
+                    self.write_index(index)
+                self.index = index
+            finally:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def prepare_key(self, agent_type, object_name):
+        return object_name.rstrip('/') + '/' + self.prepare_file_name(agent_type)
+
+    def prepare_path(self, version):
+        file_name = ''.join(c for c in version if c.isalnum() or c == '-')
+        return os.path.join(self.base_path, file_name[:2], file_name + '.data')
+
+    def log(self, message):
+        if self.logger:
+            self.logger.debug('CachingStorageAdapter: ' + message)
+
+    def get_model_version(self, agent_type, object_name):
+        return self.storage_adapter.get_model_version(agent_type, object_name)
+
+    def open_model_writer(self, agent_type, object_name):
+        self.discard_object(agent_type, object_name)
+        return self.storage_adapter.open_model_writer(agent_type, object_name)
+
+    def save_model(self, model, object_name):
+        self.storage_adapter.save_model(model, object_name)
+        self.discard_object(model.agent_type, object_name)
+
+    def discard_object(self, agent_type, object_name):
+        key = self.prepare_key(agent_type, object_name)
+        self.update_index(lambda index: index['objects'].pop(key, None) is not None)
+
+    def load_model(self, agent_type, object_name):
+        key = self.prepare_key(agent_type, object_name)
+        try:
+            version = self.get_model_version(agent_type, object_name)
+        except Exception as e:
+            version = self.read_index()['objects'].get(key)
+            if version is None:
+                raise
+            self.log('unable to revalidate \'{}\', using cached version: {}'.format(key, e))
+
+        if version is None:
+            return self.storage_adapter.load_model(agent_type, object_name)
+
+        model = self.load_cached_model(key, version)
+        if model is not None:
+            self.log('\'{}\' loaded from cache'.format(key))
+            return model
+
+        version, size = self.store_model_data(key, agent_type, object_name)
+        self.log('\'{}\' downloaded, {} byte(s)'.format(key, size))
+        return self.load_cached_model(key, version) or self.storage_adapter.load_model(agent_type, object_name)
+
+    def load_cached_model(self, key, version):
+        path = self.prepare_path(version)
+        try:
+            with open(path, 'rb') as fileobj:
+                model = load_model_binary(fileobj)
+        except OSError:
+            return None
+
+        size = os.path.getsize(path)
+
+        def index_updater(index):
+            index['objects'][key] = version
+            index['entries'][version] = {'size': size, 'used_at': time.time()}
+
+        self.update_index(index_updater)
+        return model
+
+    def store_model_data(self, key, agent_type, object_name):
+        descriptor, temp_path = tempfile.mkstemp(dir=self.base_path, suffix='.tmp')
+        try:
+            with os.fdopen(descriptor, 'wb') as fileobj:
+                version = self.storage_adapter.load_model_data(agent_type, object_name, fileobj)
+            path = self.prepare_path(version)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(temp_path, path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        size = os.path.getsize(path)
+
+        def index_updater(index):
+            index['objects'][key] = version
+            index['entries'][version] = {'size': size, 'used_at': time.time()}
+            self.evict(index, keep_version=version)
+
+        self.update_index(index_updater)
+        return version, size
+
+    def evict(self, index, keep_version):
+        if not self.max_bytes:
+            return
+
+        entries = index['entries']
+        total_size = sum(entry['size'] for entry in entries.values())
+        for version, entry in sorted(entries.items(), key=lambda item: item[1]['used_at']):
+            if total_size <= self.max_bytes:
+                break
+            if version == keep_version:
+                continue
+
+            try:
+                os.remove(self.prepare_path(version))
+            except OSError:
+                pass
+            del entries[version]
+            total_size -= entry['size']
+            index['objects'] = {
+                key: object_version for key, object_version in index['objects'].items()
+                if object_version != version
+            }
+            self.log('evicted {}, {} byte(s)'.format(version, entry['size']))
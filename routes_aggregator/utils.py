@@ -38,15 +38,24 @@ def read_config_file(file_path):
     return config
 
 
-def calculate_raw_time_difference(first, second):
-    first_minutes = time_to_minutes(first)
-    second_minutes = time_to_minutes(second)
+def parse_time(time):
+    return time_to_minutes(time) if time else None
+
+
+def format_time(minutes):
+    return minutes_to_time(minutes) if minutes is not None else ''
+
 
+def calculate_raw_minutes_difference(first_minutes, second_minutes):
     if first_minutes <= second_minutes:
         return second_minutes - first_minutes
     else:
         return 1440 - first_minutes + second_minutes
 
 
+def calculate_raw_time_difference(first, second):
+    return calculate_raw_minutes_difference(time_to_minutes(first), time_to_minutes(second))
+
+
 def calculate_time_difference(first, second):
     return minutes_to_time(calculate_raw_time_difference(first, second))
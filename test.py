@@ -1,30 +1,1317 @@
 import argparse
+import csv
+import functools
+import hashlib
+import io
 import itertools
+import logging
+import os
+import re
+import tempfile
+import threading
 
-from routes_aggregator.service import Service
+from routes_aggregator.cache import LRUCache, PathResultCache
+from routes_aggregator.connection_index import DirectConnectionIndex
+from routes_aggregator.journey_planner import ConnectionScanPlanner, RaptorPlanner
+from routes_aggregator.memory_accessor import MemoryAccessor
 from routes_aggregator.model import *
+from routes_aggregator.model_diff import ModelDiff
+from routes_aggregator.model_format import save_model_binary, load_model_binary, get_model_fingerprint
 from routes_aggregator.utils import *
 
 
+class RecordingTransaction:
+
+    def __init__(self):
+        self.statements = []
+
+    def run(self, statement, parameters=None):
+        self.statements.append((statement, parameters or {}))
+
+    def get_parameters(self, statement, parameter_name):
+        return [
+            item
+            for run_statement, parameters in self.statements if run_statement == statement
+            for item in parameters[parameter_name]
+        ]
+
+
 def travel_time_test():
-    print(calculate_raw_time_difference('11:10', '11:11'))
-    print(calculate_time_difference('00:04', '23:54'))
+    assert calculate_raw_time_difference('11:10', '11:11') == 1
+    assert calculate_time_difference('00:04', '23:54') == '23:50'
+
+
+def route_time_test():
+    route_point = RoutePoint('test', '10', '1')
+    route_point.arrival_time = '08:05'
+    route_point.departure_time = '23:59'
+    assert (route_point.raw_arrival_time, route_point.raw_departure_time) == (485, 1439)
+    assert (route_point.arrival_time, route_point.departure_time) == ('08:05', '23:59')
+    route_point.departure_time = ''
+    assert route_point.raw_departure_time is None and route_point.departure_time == ''
+
+    model = build_test_model()
+    route = model.routes['10']
+    assert route.calculate_travel_time(0, 2) == 360
+    assert route.calculate_travel_time(1, 2) == 315
+    assert route.calculate_travel_time(1, 1) == 0
+
+    overnight_route = add_test_route(model, '30', '12', [('1', '', '23:30'), ('2', '00:10', '00:20'), ('3', '01:00', '')])
+    assert overnight_route.calculate_travel_time(0, 2) == 90
+    assert Route('test', '40').calculate_travel_time(0, 0) == 0
 
 
 def language_property_test():
     station = Station('test', '123')
     station.set_station_name('Test_UA', 'ua')
     station.set_station_name('Test_EN', 'en')
-    print(Entity.extract_property(station.get_station_name, 'ru'))
+    assert Entity.extract_property(station.get_station_name, 'ru') == 'Test_EN'
 
+    other_station = Station('test', '124')
+    other_station.set_station_name(''.join(['Test', '_EN']), 'en')
+    assert other_station.get_station_name('en') is station.get_station_name('en')
 
-def service_test():
 
-    parser = argparse.ArgumentParser(description='Routes Aggregator API')
-    parser.add_argument('config_path', help='Path to configuration file')
-    args = parser.parse_args()
+def build_test_model():
+    model = ModelAccessor()
+    model.agent_type = 'test'
+
+    for station_id, station_name in [('1', 'Kyiv'), ('2', 'Fastiv'), ('3', 'Odesa'), ('4', 'Lviv')]:
+        station = Station('test', station_id)
+        station.set_station_name(station_name, 'en')
+        model.add_station(station)
+
+    timetable = [
+        ('10', '68', [('1', '', '08:00'), ('2', '08:40', '08:45'), ('3', '14:00', '')]),
+        ('20', '91', [('3', '', '15:30'), ('4', '23:10', '')]),
+    ]
+    for route_id, route_number, route_points in timetable:
+        add_test_route(model, route_id, route_number, route_points)
+
+    return model
+
+
+def add_test_route(model, route_id, route_number, route_points):
+    route = Route(model.agent_type, route_id)
+    route.route_number = route_number
+    for station_id, arrival_time, departure_time in route_points:
+        route_point = RoutePoint(model.agent_type, route_id, station_id)
+        route_point.arrival_time = arrival_time
+        route_point.departure_time = departure_time
+        route.add_route_point(route_point)
+    model.add_route(route)
+    return route
+
+
+def get_domain_ids(entities):
+    return [entity.domain_id for entity in entities]
+
+
+def memory_accessor_test():
+    accessor = MemoryAccessor(logging.getLogger('routes-aggregator'))
+    accessor.build_model(build_test_model())
+
+    assert sorted(get_domain_ids(accessor.find_stations(['ky', 'od'], 'starts_with', 10))) == ['test1', 'test3']
+    assert get_domain_ids(accessor.find_routes_by_route_numbers(['68'], 'strict', 10)) == ['test10']
+    assert sorted(get_domain_ids(accessor.find_routes_by_station_ids(['test3'], 10))) == ['test10', 'test20']
+    assert accessor.find_paths_with_single_route([['test1'], ['test3']], 10)[0].travel_time == '06:00'
+    assert accessor.find_paths_with_multiple_routes(
+        [['test1'], ['test3'], ['test4']], 10)[0].travel_time == '15:10'
+    assert accessor.find_shortest_paths(['test1'], ['test4'], 4, 10)[0].travel_time == '15:10'
+
+
+def journey_planner_test():
+    planner = ConnectionScanPlanner(logging.getLogger('routes-aggregator'))
+    planner.build_model(build_test_model())
+
+    paths = planner.find_earliest_arrival_paths(['test1'], ['test4'], '07:30')
+    assert [(path.departure_time, path.arrival_time, len(path.path_items)) for path in paths] == \
+        [('08:00', '23:10', 2)]
+
+    planner = RaptorPlanner(logging.getLogger('routes-aggregator'))
+    planner.build_model(build_test_model())
+
+    paths = planner.find_pareto_paths(['test1'], ['test4'], '07:00', '10:00', 2)
+    assert [(path.departure_time, path.arrival_time, len(path.path_items)) for path in paths] == \
+        [('08:00', '23:10', 2)]
+
+
+def build_station_names_model(station_names):
+    model = ModelAccessor()
+    model.agent_type = 'test'
+    for station_id, names in station_names:
+        station = Station('test', station_id)
+        for language, station_name in names.items():
+            station.set_station_name(station_name, language)
+        model.add_station(station)
+    return model
+
+
+def station_name_index_test():
+    from routes_aggregator.search_index import StationNameIndex
+
+    index = StationNameIndex(logging.getLogger('routes-aggregator'))
+    assert not index.supports('STARTS_WITH')
+    index.build_model(build_station_names_model([
+        ('1', {'ua': 'Київ', 'en': 'Kyiv'}),
+        ('2', {'ua': 'Київ-Волинський', 'en': 'Kyiv-Volynskyi'}),
+        ('3', {'ua': 'Кам\'янець-Подільський', 'en': 'Kamianets-Podilskyi'}),
+        ('4', {'en': 'Lviv'}),
+    ]))
+    assert index.supports('starts_with') and index.supports('STRICT') and not index.supports('REGEX')
+
+    # exact names rank before longer prefixed ones, names are compared normalized
+    assert get_domain_ids(index.find_stations(['КИЇВ'], 'starts_with', 10)) == ['test1', 'test2']
+    assert get_domain_ids(index.find_stations(['  kyiv-VOLYNSKYI '], 'strict', 10)) == ['test2']
+    assert get_domain_ids(index.find_stations(['Кам’янець'], 'starts_with', 10)) == ['test3']
+    assert get_domain_ids(index.find_stations(['ky', 'lv'], 'starts_with', 2)) == ['test1', 'test4']
+    assert index.find_stations(['kyi'], 'strict', 10) == []
+    assert index.find_stations([''], 'starts_with', 10) == []
+
+    index.remove_model('test')
+    assert not index.supports('STRICT')
+
+
+def fuzzy_station_search_test():
+    from routes_aggregator.search_index import StationNameIndex
+
+    index = StationNameIndex(logging.getLogger('routes-aggregator'))
+    index.build_model(build_station_names_model([
+        ('1', {'ua': 'Київ', 'en': 'Kyiv'}),
+        ('2', {'ua': 'Одеса', 'en': 'Odesa'}),
+        ('3', {'ua': 'Одеса-Застава', 'en': 'Odesa-Zastava'}),
+        ('4', {'ua': 'Львів', 'en': 'Lviv'}),
+    ]))
+
+    def find_stations(station_name, limit=10):
+        return get_domain_ids(index.find_stations([station_name], 'fuzzy', limit))
+
+    # misspelled and transliterated names match, the longer name is below the similarity threshold
+    assert find_stations('Odessa') == ['test2']
+    assert find_stations('Одесса') == ['test2']
+    assert find_stations('Kyyiv') == ['test1']
+    assert find_stations('Lvov') == []
+
+    # short queries still match through the padded trigrams
+    assert find_stations('ky') == ['test1']
+    assert find_stations('l') == []
+
+    # the most similar stations rank first and the limit keeps the best ones
+    assert find_stations('Zastava') == ['test3']
+    assert find_stations('odesa') == ['test2', 'test3']
+    assert find_stations('odesa', 1) == ['test2']
+    assert find_stations('Odesa-Zastava', 1) == ['test3']
+
+
+def station_search_keys_test():
+    from routes_aggregator.db_accessor import DbAccessor, MatchBySearchKeysQueryGenerator
+
+    station = Station('test', '1')
+    station.set_station_name('Кам\'янець-Подільський', 'ua')
+    station.set_station_name('  KAMIANETS-Podilskyi ', 'en')
+    properties = DbAccessor.prepare_station_properties(station)
+    assert (properties['search_name_ua'], properties['search_name_en']) == \
+        ('кам\'янець-подільський', 'kamianets-podilskyi')
+    assert 'search_name_ru' not in properties
+
+    # names are normalized like the search keys they are compared to
+    generator = MatchBySearchKeysQueryGenerator()
+    query = generator.generate_query('Station', 'starts_with', ['search_name_en'], 1)
+    assert query.startswith('MATCH (n:Station) WHERE n.search_name_en STARTS WITH $value_0 ')
+    assert generator.prepare_parameters([' KAM'], 5) == {'value_0': 'kam', 'limit': 5}
+    assert not generator.supports('REGEX')
+
+
+def direct_connection_index_test():
+    model = build_test_model()
+    add_test_route(model, '30', '12', [('1', '', '06:00'), ('2', '06:40', '06:45'), ('4', '12:00', '')])
+
+    accessor = MemoryAccessor(logging.getLogger('routes-aggregator'))
+    accessor.build_model(model)
+    index = DirectConnectionIndex(logging.getLogger('routes-aggregator'))
+    index.build_model(model)
+
+    def get_connections(paths):
+        return sorted(
+            (path_item.route.domain_id, path_item.departure_point_idx, path_item.arrival_point_idx)
+            for path in paths for path_item in path.path_items
+        )
+
+    station_sets = [[], ['test1'], ['test2'], ['test3'], ['test4'], ['test2', 'test3']]
+    for middle_count in range(3):
+        for station_ids in itertools.product(station_sets, repeat=middle_count + 2):
+            station_ids = list(station_ids)
+            if not index.supports(station_ids):
+                continue
+            assert get_connections(index.find_paths(station_ids, 100)) == \
+                get_connections(accessor.find_paths_with_single_route(station_ids, 100)), station_ids
+
+    assert get_connections(index.find_paths([['test1'], [], ['test2']], 10)) == []
+    assert get_connections(index.find_paths([['test1'], [], ['test3']], 10)) == [('test10', 0, 2)]
+
+
+def build_timetable_model(timetable):
+    model = ModelAccessor()
+    model.agent_type = 'test'
+    for station_id in sorted(set(point[0] for _, route_points in timetable for point in route_points)):
+        model.add_station(Station('test', station_id))
+    for route_id, route_points in timetable:
+        add_test_route(model, route_id, route_id, route_points)
+    return model
+
+
+def raptor_departure_window_test():
+    planner = RaptorPlanner(logging.getLogger('routes-aggregator'))
+    planner.build_model(build_timetable_model([
+        ('X', [('A', '', '08:00'), ('B', '20:00', '')]),
+        ('Y', [('A', '', '11:00'), ('B', '12:00', '')]),
+    ]))
+
+    paths = planner.find_pareto_paths(['testA'], ['testB'], '07:00', '10:00', 2)
+    assert [(path.path_items[0].route.route_id, path.departure_time, path.arrival_time) for path in paths] == \
+        [('X', '08:00', '20:00')]
+
+
+def multiple_day_wait_test():
+    model = build_timetable_model([
+        ('X', [('A', '', '22:00'), ('B', '21:00', '')]),
+        ('Y', [('B', '', '20:00'), ('C', '21:00', '')]),
+    ])
+
+    planner = ConnectionScanPlanner(logging.getLogger('routes-aggregator'))
+    planner.build_model(model)
+    for departure_time in ('21:00', '23:00'):
+        paths = planner.find_earliest_arrival_paths(['testA'], ['testC'], departure_time)
+        assert [[path_item.route.route_id for path_item in path.path_items] for path in paths] == [['X', 'Y']]
+
+    planner = RaptorPlanner(logging.getLogger('routes-aggregator'))
+    planner.build_model(model)
+    paths = planner.find_pareto_paths(['testA'], ['testC'], '21:00', '23:00', 2)
+    assert [[path_item.route.route_id for path_item in path.path_items] for path in paths] == [['X', 'Y']]
+
+
+def model_format_test():
+    model = build_test_model()
+
+    with tempfile.TemporaryFile() as fileobj:
+        save_model_binary(model, fileobj)
+        fileobj.seek(0)
+        restored_model = load_model_binary(fileobj)
+
+        assert restored_model.agent_type == model.agent_type
+        assert sorted(restored_model.stations) == sorted(model.stations)
+        assert sorted(restored_model.routes) == sorted(model.routes)
+        for station_id, station in model.stations.items():
+            assert restored_model.stations[station_id].get_properties() == station.get_properties()
+        for route_id, route in model.routes.items():
+            restored_route = restored_model.routes[route_id]
+            assert restored_route.route_number == route.route_number
+            assert ModelDiff.get_stops_signature(restored_route) == ModelDiff.get_stops_signature(route)
+
+    fileobj = io.BytesIO()
+    model.save_binary(fileobj)
+    fileobj.seek(0)
+    assert sorted(load_model_binary(fileobj).routes) == sorted(model.routes)
+
+
+def loaded_model_update_test():
+    fileobj = io.BytesIO()
+    save_model_binary(build_test_model(), fileobj)
+    fileobj.seek(0)
+    model = load_model_binary(fileobj)
+
+    station = Station('test', '5')
+    station.set_station_name('Uzhhorod', 'en')
+    model.add_station(station)
+    add_test_route(model, '30', '12', [('4', '', '06:00'), ('5', '12:00', '')])
+
+    assert sorted(model.stations) == ['1', '2', '3', '4', '5']
+    assert model.find_route('30').route_number == '12'
+    assert model.find_route('10').get_route_point(2).station_id == '3'
+    del model.routes['20']
+    assert sorted(model.routes) == ['10', '30']
+
+
+class PageResponse:
+
+    def __init__(self, text):
+        self.ok = text is not None
+        self.text = text
+        self.status_code = 200 if self.ok else 404
+        self.reason = 'OK' if self.ok else 'Not Found'
+
+
+class PageFetcher:
+
+    def __init__(self, pages):
+        self.pages = pages
+
+    def crawl(self, tasks, url_getter, handler):
+        tasks = list(tasks)
+        while tasks:
+            task = tasks.pop(0)
+            url_getter(task)
+            tasks.extend(handler(task, PageResponse(self.pages.get(task))) or [])
+
+    def close(self):
+        pass
+
+
+def model_provider_test():
+    from routes_aggregator.model_provider import ModelProvider, UZAgent
+    from routes_aggregator.storage_adapter import FilesystemStorageAdapter
+
+    station_page = '<html><body><div id="cpn-timetable"><div><h3>{}{} (Ukraine)</h3></div>' \
+                   '<table><tbody>{}</tbody></table></div></body></html>'
+    route_page = '<html><body><div id="cpn-timetable">' \
+                 '<table><tbody><tr><td></td><td>{} {}</td><td>daily</td></tr></tbody></table>' \
+                 '<table><tbody>{}</tbody></table></div></body></html>'
+    route_link = '<tr><td><a href="?ntrain={}&by_id=1">{}</a></td></tr>'
+    route_point = '<tr><td><a href="?station={}&by_station=1"></a></td><td>{}</td><td>{}</td></tr>'
+    offsets = {'ua': 19, 'en': 25}
+
+    pages = {}
+    for language in offsets:
+        pages[('station', '22000', language)] = station_page.format(
+            'x' * offsets[language], 'Kyiv', route_link.format('10', '68'))
+        pages[('station', '22001', language)] = station_page.format(
+            'x' * offsets[language], 'Fastiv', route_link.format('10', '68') + route_link.format('20', '91'))
+        pages[('route', '10', language)] = route_page.format('68', 'Kyiv', ''.join([
+            route_point.format('22000', '', '08:00'), route_point.format('22001', '08:40', '')]))
+        pages[('route', '20', language)] = route_page.format('91', 'Fastiv', ''.join([
+            route_point.format('22001', '', '09:00'), route_point.format('22002', '10:00', '')]))
+
+    class RecordingStorageAdapter(FilesystemStorageAdapter):
+        def open_model_writer(self, agent_type, object_name):
+            self.model_writer = super().open_model_writer(agent_type, object_name)
+            return self.model_writer
+
+        def save_model(self, model, object_name):
+            assert object_name != 'current'
+            super().save_model(model, object_name)
+
+    def build_agent(agent_type, logger, **options):
+        agent = UZAgent(agent_type, logger, **options)
+        agent.fetcher.close()
+        agent.fetcher = PageFetcher(pages)
+        return agent
+
+    with tempfile.TemporaryDirectory() as base_path:
+        os.mkdir(os.path.join(base_path, 'archive'))
+        storage_adapter = RecordingStorageAdapter(base_path)
+        provider = ModelProvider(storage_adapter, logging.getLogger('routes-aggregator'))
+        provider.agent_types['uz'] = build_agent
+        model = provider.build_model('uz')
+
+        # the crawled entities were streamed into the current model once each
+        model_writer = storage_adapter.model_writer
+        assert model_writer.closed
+        assert sum(count for _, _, count in model_writer.chunks) == len(model.stations) + len(model.routes)
+
+        # the station without a page is not part of the model
+        assert sorted(model.stations) == ['22000', '22001']
+        assert sorted(model.routes) == ['10', '20']
+        restored_model = provider.load_model('uz', 'current')
+        assert restored_model.find_station('22001').get_station_name('en') == 'Fastiv'
+        assert restored_model.find_route('20').route_number == '91'
+        assert ModelDiff.get_stops_signature(restored_model.find_route('10')) == \
+            ModelDiff.get_stops_signature(model.find_route('10'))
+
+
+def path_cache_test():
+    model = build_test_model()
+    path = Path()
+    path.add_path_item(PathItem(model.routes['10'], 0, 2))
+
+    cache = PathResultCache()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def finder():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return [path]
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(cache.get('key', finder)))
+    leader.start()
+    started.wait(5)
+    followers = [
+        threading.Thread(target=lambda: results.append(cache.get('key', finder)))
+        for _ in range(4)
+    ]
+    for follower in followers:
+        follower.start()
+    while cache.coalesced < len(followers):
+        threading.Event().wait(0.01)
+    release.set()
+    for thread in [leader] + followers:
+        thread.join()
+
+    assert len(calls) == 1 and cache.coalesced == len(followers)
+    assert all(result == [path] for result in results)
+    assert cache.get('key', finder) == [path] and len(calls) == 1
+
+    cache.invalidate('test')
+    assert cache.get('key', finder) == [path] and len(calls) == 2
+
+
+class VersionedStorageAdapter:
+
+    def __init__(self):
+        self.models = {}
+
+    def save_model(self, model, object_name):
+        fileobj = io.BytesIO()
+        save_model_binary(model, fileobj)
+        self.models[(model.agent_type, object_name)] = fileobj.getvalue()
+
+    def get_model_version(self, agent_type, object_name):
+        return hashlib.sha256(self.models[(agent_type, object_name)]).hexdigest()
+
+    def load_model_data(self, agent_type, object_name, fileobj):
+        fileobj.write(self.models[(agent_type, object_name)])
+        return self.get_model_version(agent_type, object_name)
+
+
+def caching_storage_adapter_test():
+    from routes_aggregator.storage_adapter import CachingStorageAdapter
+
+    storage_adapter = VersionedStorageAdapter()
+    first_model = build_test_model()
+    second_model = build_changed_test_model()
+    second_model.agent_type = 'other'
+    storage_adapter.save_model(first_model, 'models')
+    storage_adapter.save_model(second_model, 'models')
+
+    with tempfile.TemporaryDirectory() as base_path:
+        first_adapter = CachingStorageAdapter(storage_adapter, base_path)
+        second_adapter = CachingStorageAdapter(storage_adapter, base_path)
+        first_adapter.load_model('test', 'models')
+        second_adapter.load_model('other', 'models')
+
+        # adapters sharing the folder merge their index updates
+        index = CachingStorageAdapter(storage_adapter, base_path).index
+        assert sorted(index['objects']) == ['models/other.data', 'models/test.data']
+        assert sorted(index['entries']) == sorted(index['objects'].values())
+
+        first_adapter.save_model(first_model, 'models')
+        index = CachingStorageAdapter(storage_adapter, base_path).index
+        assert sorted(index['objects']) == ['models/other.data']
+        assert sorted(first_adapter.load_model('other', 'models').routes) == sorted(second_model.routes)
+
+
+def s3_storage_adapter_test():
+    os.environ.setdefault('S3_UPLOAD_PART_MIN_SIZE', '256')
+    import boto3
+    from moto import mock_aws
+    from routes_aggregator.exceptions import ModelChecksumException
+    from routes_aggregator.storage_adapter import S3MultipartWriter, S3StorageAdapter
+
+    model = build_test_model()
+    for i in range(5000):
+        station = Station('test', str(100 + i))
+        station.set_station_name(os.urandom(16).hex(), 'en')
+        model.add_station(station)
+
+    class PartsCountingClient:
+        def __init__(self, client):
+            self.client = client
+            self.parts_count = 0
+
+        def __getattr__(self, name):
+            return getattr(self.client, name)
+
+        def upload_part(self, **kwargs):
+            self.parts_count += 1
+            return self.client.upload_part(**kwargs)
+
+    min_part_size = S3MultipartWriter.MIN_PART_SIZE
+    S3MultipartWriter.MIN_PART_SIZE = 256
+    try:
+        with mock_aws():
+            client = PartsCountingClient(boto3.client('s3', region_name='us-east-1'))
+            client.create_bucket(Bucket=S3StorageAdapter.DEFAULT_BUCKET_NAME)
+
+            for compression in ('zstd', 'gzip', None):
+                adapter = S3StorageAdapter(None, compression=compression, part_size=16 * 1024, client=client)
+                adapter.DOWNLOAD_CHUNK_SIZE = 4096
+                client.parts_count = 0
+                adapter.save_model(model, 'models')
+                assert client.parts_count > 1
+
+                key = adapter.prepare_path('test', 'models')
+                response = client.head_object(Bucket=adapter.DEFAULT_BUCKET_NAME, Key=key)
+                assert response['Metadata'][adapter.COMPRESSION_KEY] == (compression or '')
+
+                fileobj = io.BytesIO()
+                save_model_binary(model, fileobj)
+                version = hashlib.sha256(fileobj.getvalue()).hexdigest()
+                assert adapter.get_model_version('test', 'models') == version
+                data = io.BytesIO()
+                assert adapter.load_model_data('test', 'models', data) == version
+                assert data.getvalue() == fileobj.getvalue()
+
+                restored_model = adapter.load_model('test', 'models')
+                assert sorted(restored_model.stations) == sorted(model.stations)
+                assert sorted(restored_model.routes) == sorted(model.routes)
+                assert [item['Key'] for item in client.list_objects_v2(
+                    Bucket=adapter.DEFAULT_BUCKET_NAME)['Contents']] == [key]
+
+            # a corrupted object is rejected by the sha256 metadata check
+            fileobj = io.BytesIO()
+            save_model_binary(build_changed_test_model(), fileobj)
+            client.put_object(
+                Bucket=adapter.DEFAULT_BUCKET_NAME, Key=key, Body=fileobj.getvalue(),
+                Metadata=response['Metadata'])
+            try:
+                adapter.load_model('test', 'models')
+                assert False, 'corrupted model loaded'
+            except ModelChecksumException:
+                pass
+    finally:
+        S3MultipartWriter.MIN_PART_SIZE = min_part_size
+
+
+def http_cache_test():
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    import requests
+    from routes_aggregator.fetcher import Fetcher
+    from routes_aggregator.http_cache import CachingAdapter, ResponseCache
+
+    pages = {'/0': ['/1', '/2'], '/1': ['/3'], '/2': ['/3'], '/3': []}
+    requests_log = []
+    acquired_hosts = []
+
+    class PageHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            etag = '"{}"'.format(self.path)
+            requests_log.append((self.path, self.headers.get('If-None-Match')))
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+            content = ' '.join(pages[self.path]).encode('utf-8')
+            self.send_response(200)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), PageHandler)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.start()
+    base_url = 'http://127.0.0.1:{}'.format(server.server_port)
+
+    def crawl(response_cache):
+        fetcher = Fetcher(
+            requests.session(), logging.getLogger('routes-aggregator'), request_rate=None,
+            retries_count=0, adapter_factory=functools.partial(CachingAdapter, response_cache))
+        fetcher.rate_limiter.acquire = acquired_hosts.append
+        crawled = {}
+
+        def handler(path, response):
+            if path not in crawled:
+                crawled[path] = response.text.split()
+                return crawled[path]
+
+        try:
+            fetcher.crawl(['/0'], lambda path: base_url + path, handler)
+        finally:
+            fetcher.close()
+        return crawled
+
+    with tempfile.TemporaryDirectory() as base_path:
+        try:
+            assert crawl(ResponseCache(base_path)) == pages
+            assert sorted(path for path, _ in requests_log) == ['/0', '/1', '/2', '/3', '/3']
+            assert len(acquired_hosts) == len(requests_log)
+
+            # fresh entries are served without requests and without rate limiting
+            del requests_log[:]
+            del acquired_hosts[:]
+            assert crawl(ResponseCache(base_path, max_age=3600)) == pages
+            assert requests_log == [] and acquired_hosts == []
+
+            # stale entries are revalidated with conditional requests
+            assert crawl(ResponseCache(base_path)) == pages
+            assert all(etag == '"{}"'.format(path) for path, etag in requests_log) and requests_log
+        finally:
+            server.shutdown()
+            server.server_close()
+            server_thread.join()
+
+        # the recorded crawl replays without the server
+        response_cache = ResponseCache(base_path, offline=True)
+        assert crawl(response_cache) == pages
+        session = requests.session()
+        session.mount('http://', CachingAdapter(response_cache))
+        assert session.get(base_url + '/4').status_code == 504
+
+
+def cache_race_test():
+    from routes_aggregator.db_accessor import DbAccessor, VersionedTransaction
 
-    Service(config_path=args.config_path)
+    station = Station('test', '1')
+    cache = LRUCache(10)
+
+    generation = cache.get_generation()
+    cache.invalidate('test')
+    cache.put('test', station.domain_id, station, generation)
+    assert cache.get(station.domain_id) is None
+
+    generation = cache.get_generation()
+    cache.discard(station.domain_id)
+    cache.put('test', station.domain_id, station, generation)
+    assert cache.get(station.domain_id) is None
+
+    cache.put('test', station.domain_id, station, cache.get_generation())
+    assert cache.get(station.domain_id) is station
+
+    class Node:
+        properties = {'domain_id': 'test1', 'agent_type': 'test', 'station_id': '1'}
+
+    accessor = DbAccessor.__new__(DbAccessor)
+    accessor.station_cache = LRUCache(10)
+    transaction = VersionedTransaction(RecordingTransaction(), [], accessor.station_cache.get_generation())
+    accessor.station_cache.invalidate('test')
+    assert accessor.extract_station({'n': Node()}, transaction).domain_id == 'test1'
+    assert accessor.station_cache.get('test1') is None
+
+
+def build_changed_test_model():
+    model = build_test_model()
+    del model.routes['20']
+
+    station = Station('test', '5')
+    station.set_station_name('Lutsk', 'en')
+    model.add_station(station)
+    model.stations['2'].set_station_name('Fastiv-1', 'en')
+
+    add_test_route(model, '10', '68', [('1', '', '08:00'), ('2', '08:40', '08:50'), ('3', '14:00', '')])
+    add_test_route(model, '30', '12', [('4', '', '06:00'), ('5', '09:00', '')])
+    return model
+
+
+def model_diff_test():
+    from routes_aggregator.db_accessor import DbAccessor
+
+    diff = ModelDiff.compare(build_test_model(), build_changed_test_model())
+    assert get_domain_ids(diff.added_stations) == ['test5']
+    assert [station.domain_id for _, station in diff.changed_stations] == ['test2']
+    assert get_domain_ids(diff.removed_routes) == ['test20']
+    assert get_domain_ids(diff.added_routes) == ['test30']
+    assert [route.domain_id for _, route in diff.stops_changed_routes] == ['test10']
+
+    accessor = DbAccessor.__new__(DbAccessor)
+    accessor.batch_size = DbAccessor.DEFAULT_BATCH_SIZE
+    transaction = RecordingTransaction()
+    accessor.apply_model_diff(diff, 'test:1', transaction)
+
+    assert all(parameters['model_version'] == 'test:1' for _, parameters in transaction.statements)
+    assert sorted(transaction.get_parameters(DbAccessor.DELETE_ROUTES, 'domain_ids')) == ['test10', 'test20']
+    assert len(transaction.get_parameters(DbAccessor.DELETE_TRANSITIONS, 'transitions')) == 3
+    assert [properties['domain_id'] for properties in
+            transaction.get_parameters(DbAccessor.UPDATE_STATIONS, 'stations')] == ['test2']
+    assert [properties['domain_id'] for properties in
+            transaction.get_parameters(DbAccessor.CREATE_STATIONS, 'stations')] == ['test5']
+    assert sorted(properties['domain_id'] for properties in
+                  transaction.get_parameters(DbAccessor.CREATE_ROUTES, 'routes')) == ['test10', 'test30']
+    assert len(transaction.get_parameters(DbAccessor.CREATE_ROUTE_CONNECTIONS, 'connections')) == 5
+    assert len(transaction.get_parameters(DbAccessor.CREATE_TRANSITIONS, 'transitions')) == 3
+
+
+class CannedNode:
+
+    def __init__(self, properties):
+        self.properties = properties
+
+
+class CannedResult:
+
+    def __init__(self, data):
+        self.records = data
+
+    def data(self):
+        return self.records
+
+
+class CannedSession:
+
+    def __init__(self, responder, access_mode=None, driver=None, **options):
+        self.responder = responder
+        self.access_mode = access_mode
+        self.driver = driver
+        self.closed = False
+
+    def run(self, statement, parameters=None):
+        if self.driver is not None and self.driver.error is not None:
+            raise self.driver.error
+        return CannedResult(self.responder(statement, parameters or {}))
+
+    def read_transaction(self, transaction_function):
+        return transaction_function(self)
+
+    def write_transaction(self, transaction_function):
+        return transaction_function(self)
+
+    def last_bookmark(self):
+        return None
+
+    def close(self):
+        self.closed = True
+
+
+class CannedDriver:
+
+    def __init__(self, uri, responder):
+        self.uri = uri
+        self.responder = responder
+        self.sessions = []
+        self.error = None
+
+    def session(self, **options):
+        session = CannedSession(self.responder, driver=self, **options)
+        self.sessions.append(session)
+        return session
+
+
+def create_db_accessor(responder, **options):
+    from routes_aggregator import db_accessor
+
+    drivers = []
+
+    def create_driver(uri, **driver_options):
+        drivers.append(CannedDriver(uri, responder))
+        return drivers[-1]
+
+    graph_database = db_accessor.GraphDatabase
+    db_accessor.GraphDatabase = type('GraphDatabase', (), {'driver': staticmethod(create_driver)})
+    try:
+        accessor = db_accessor.DbAccessor(('neo4j', 'neo4j'), logging.getLogger('routes-aggregator'), **options)
+    finally:
+        db_accessor.GraphDatabase = graph_database
+    return accessor, drivers
+
+
+class ModelGraph:
+    """Answers the read statements of DbAccessor from a stored model"""
+
+    def __init__(self, model, model_version):
+        from routes_aggregator.db_accessor import DbAccessor
+
+        self.model = model
+        self.model_version = model_version
+        self.fingerprint = None
+        self.statements = []
+        self.stations = {
+            station.domain_id: dict(DbAccessor.prepare_station_properties(station), model_version=model_version)
+            for station in model.stations.values()
+        }
+        self.routes = {
+            route.domain_id: dict(DbAccessor.prepare_route_properties(route), model_version=model_version)
+            for route in model.routes.values()
+        }
+
+    def __call__(self, statement, parameters):
+        from routes_aggregator.db_accessor import DbAccessor
+
+        self.statements.append((statement, parameters))
+        if statement == DbAccessor.MATCH_ACTIVE_MODEL_VERSIONS:
+            if self.model_version is None:
+                return []
+            return [{'agent_type': self.model.agent_type, 'model_version': self.model_version,
+                     'fingerprint': self.fingerprint}]
+        if statement == DbAccessor.DELETE_MODEL_VERSION:
+            self.model_version = None
+            return []
+        if statement == DbAccessor.MATCH_STATIONS_BY_DOMAIN_IDS:
+            return [{'n': CannedNode(self.stations[domain_id])}
+                    for domain_id in parameters['domain_ids']
+                    if self.stations.get(domain_id, {}).get('model_version') in parameters['versions']]
+        if statement == DbAccessor.MATCH_ROUTES_BY_DOMAIN_IDS:
+            return [{'n': CannedNode(self.routes[domain_id])}
+                    for domain_id in parameters['domain_ids']
+                    if self.routes.get(domain_id, {}).get('model_version') in parameters['versions']]
+        if statement == DbAccessor.MATCH_TRANSITIONS_BY_ROUTES:
+            return [
+                {'route_domain_id': route['domain_id'],
+                 'departure_station_id': transition['from_domain_id'][len(self.model.agent_type):],
+                 'arrival_station_id': transition['to_domain_id'][len(self.model.agent_type):],
+                 'r': CannedNode(transition['properties'])}
+                for route in parameters['routes']
+                for transition in DbAccessor.prepare_transitions(self.model.routes[route['route_id']])
+            ]
+        if statement.startswith('MATCH (s1:Station)-[r1:ROUTE_CONNECTION]->(n:Route), (s2:Station)'):
+            return self.match_single_route_paths(parameters)
+        return []
+
+    def set_model_version(self, model_version):
+        self.model_version = model_version
+        for properties in itertools.chain(self.stations.values(), self.routes.values()):
+            properties['model_version'] = model_version
+
+    def match_single_route_paths(self, parameters):
+        rows = []
+        for route in self.model.routes.values():
+            domain_ids = [
+                Station.get_domain_id(route.agent_type, route_point.station_id)
+                for route_point in route.route_points
+            ]
+            for i, j in itertools.combinations(range(len(domain_ids)), 2):
+                if domain_ids[i] in parameters['station_ids_1'] and domain_ids[j] in parameters['station_ids_2']:
+                    rows.append({
+                        'r1': CannedNode({'station_number': i}),
+                        'n': CannedNode(self.routes[route.domain_id]),
+                        'r2': CannedNode({'station_number': j})
+                    })
+        return rows[:parameters['limit']]
+
+    def get_parameters(self, statement_prefix, parameter_name):
+        return [
+            parameters[parameter_name]
+            for statement, parameters in self.statements if statement.startswith(statement_prefix)
+        ]
+
+
+def db_accessor_batch_read_test():
+    model = build_test_model()
+    add_test_route(model, '30', '12', [('1', '', '09:00'), ('2', '09:40', '09:45'), ('3', '15:00', '')])
+    graph = ModelGraph(model, 'test:1')
+    accessor, _ = create_db_accessor(graph)
+
+    stations = accessor.get_stations(['test1', 'test9', 'test3'])
+    assert stations[1] is None
+    assert [station.get_station_name('en') for station in (stations[0], stations[2])] == ['Kyiv', 'Odesa']
+
+    routes = accessor.get_routes(['test20', 'test99', 'test10'])
+    assert routes[1] is None
+    assert [route.route_number for route in (routes[0], routes[2])] == ['91', '68']
+    assert ModelDiff.get_stops_signature(routes[2]) == ModelDiff.get_stops_signature(model.routes['10'])
+
+    results = accessor.find_paths_many([
+        ('SIMPLE', [['test1'], ['test3']], None, 1),
+        ('SIMPLE', [['test9'], ['test3']], None, 5),
+        ('SIMPLE', [['test2'], ['test3']], None, 5),
+    ])
+    assert [[path.path_items[0].route.route_id for path in paths] for paths in results] == \
+        [['10'], [], ['10', '30']]
+    assert results[2][1].path_items[0].departure_point_idx == 1
+
+    # each pair is matched by its own statement limited to the pair limit
+    assert graph.get_parameters('MATCH (s1:Station)', 'limit') == [1, 5, 5]
+
+
+def batch_loader_test():
+    from routes_aggregator.db_accessor import DbAccessor
+
+    model = build_test_model()
+    station = Station('test', '5')
+    station.set_station_name('Uzhhorod', 'en')
+    model.add_station(station)
+
+    def get_batch_sizes(batch_size):
+        accessor = DbAccessor.__new__(DbAccessor)
+        accessor.batch_size = batch_size
+        transaction = RecordingTransaction()
+        accessor.load_model(model, 'test:1', transaction)
+        assert all(parameters['model_version'] == 'test:1' for _, parameters in transaction.statements)
+        return [
+            [len(parameters[parameter_name]) for run_statement, parameters in transaction.statements
+             if run_statement == statement]
+            for statement, parameter_name in [
+                (DbAccessor.CREATE_STATIONS, 'stations'),
+                (DbAccessor.CREATE_ROUTES, 'routes'),
+                (DbAccessor.CREATE_ROUTE_CONNECTIONS, 'connections'),
+                (DbAccessor.CREATE_TRANSITIONS, 'transitions')
+            ]
+        ]
+
+    # 5 stations, 2 routes, 5 route connections and 3 transitions
+    assert get_batch_sizes(2) == [[2, 2, 1], [2], [2, 2, 1], [2, 1]]
+    assert get_batch_sizes(5) == [[5], [2], [5], [3]]
+    # a zero batch size sends every kind of entities in a single statement
+    assert get_batch_sizes(0) == [[5], [2], [5], [3]]
+
+    accessor = DbAccessor.__new__(DbAccessor)
+    accessor.batch_size = 2
+    transaction = RecordingTransaction()
+    accessor.run_batches(transaction, DbAccessor.CREATE_STATIONS, 'stations', [])
+    assert transaction.statements == []
+
+
+def query_generator_test():
+    from routes_aggregator.db_accessor import MatchByParametersQueryGenerator, \
+        MatchPathsWithSingleRouteQueryGenerator, MatchShortestPathsQueryGenerator, VersionedTransaction
+
+    # values are bound as parameters, so every query shape has a single memoized text
+    generator = MatchByParametersQueryGenerator()
+    query = generator.generate_query('Station', 'starts_with', ['station_name_en', 'station_name_ua'], 2)
+    assert generator.generate_query('Station', 'STARTS_WITH', ('station_name_en', 'station_name_ua'), 2) is query
+    assert '$value_0' in query and '$value_1' in query and 'Kyiv' not in query
+    assert generator.prepare_parameters(["Kyiv", "O'Dea"], 5) == {'value_0': 'Kyiv', 'value_1': "O'Dea", 'limit': 5}
+    assert generator.generate_query('Station', 'strict', ['station_name_en'], 2) != query
+    assert generator.generate_query('Station', 'unknown', ['station_name_en'], 2) == ''
+    assert len(generator.queries) == 2
+
+    paths_generator = MatchPathsWithSingleRouteQueryGenerator()
+    paths_query = paths_generator.generate_query([['test1'], ['test3']])
+    assert paths_generator.generate_query([['test2', 'test4'], ['test1']]) is paths_query
+    assert '$station_ids_1' in paths_query and 'test1' not in paths_query
+    assert paths_generator.generate_query([['test1'], [], ['test3']]) != paths_query
+
+    shortest_paths_generator = MatchShortestPathsQueryGenerator()
+    assert shortest_paths_generator.generate_query(3) is shortest_paths_generator.generate_query(3)
+    assert '*..3' in shortest_paths_generator.generate_query(3).replace(' ', '')
+
+    # the active versions are bound to every statement of a versioned transaction
+    transaction = RecordingTransaction()
+    VersionedTransaction(transaction, ['test:1']).run(query, {'value_0': 'Kyiv'})
+    assert transaction.statements == [(query, {'value_0': 'Kyiv', 'versions': ['test:1']})]
+
+
+def remove_model_test():
+    from routes_aggregator.db_accessor import DbAccessor
+
+    graph = ModelGraph(build_test_model(), 'test:1')
+    accessor, _ = create_db_accessor(graph)
+    assert accessor.get_stations(['test1'])[0] is not None
+
+    reads = []
+
+    def responder(statement, parameters):
+        if statement.startswith('MATCH (n:') and 'DELETE' in statement:
+            # reads issued while the entities are being deleted already miss the model
+            reads.append(accessor.get_stations(['test3'])[0])
+            graph.statements.append((statement, parameters))
+            batches = sum(1 for run_statement, _ in graph.statements if run_statement == statement)
+            return [{'count': 1 if batches == 1 else 0}]
+        return graph(statement, parameters)
+
+    accessor.driver.responder = responder
+    accessor.close_sessions()
+    accessor.remove_model('test')
+
+    delete_statements = [
+        (statement, parameters['value'])
+        for statement, parameters in graph.statements if 'DELETE' in statement and parameters.get('value')
+    ]
+    assert [statement for statement, _ in delete_statements] == [
+        query_pattern.format(property='agent_type')
+        for query_pattern, _ in DbAccessor.DELETE_BATCHES for _ in range(2)
+    ]
+    assert all(value == 'test' for _, value in delete_statements)
+    assert graph.statements.index((DbAccessor.DELETE_MODEL_VERSION, {'agent_type': 'test'})) < \
+        graph.statements.index((delete_statements[0][0], {'value': 'test', 'limit': DbAccessor.DEFAULT_BATCH_SIZE}))
+    assert reads and all(station is None for station in reads)
+    assert accessor.get_stations(['test1']) == [None] and accessor.active_versions == {}
+
+
+def db_accessor_versions_test():
+    from routes_aggregator.db_accessor import DbAccessor
+
+    graph = ModelGraph(build_test_model(), 'test:1')
+    accessor, _ = create_db_accessor(graph, versions_ttl=60)
+    changes = []
+    accessor.add_version_listener(lambda *args: changes.append(args))
+
+    def count_statements(statement):
+        return sum(1 for run_statement, _ in graph.statements if run_statement == statement)
+
+    # the active versions are bound from the cache until they expire
+    accessor.get_stations(['test1'])
+    accessor.get_routes(['test10'])
+    assert count_statements(DbAccessor.MATCH_ACTIVE_MODEL_VERSIONS) == 1
+
+    graph.set_model_version('test:2')
+    assert accessor.get_stations(['test1'])[0] is not None
+    assert changes == [] and count_statements(DbAccessor.MATCH_STATIONS_BY_DOMAIN_IDS) == 1
+
+    # a version swapped by another process invalidates the cached entities
+    accessor.versions_expire_at = 0
+    assert accessor.get_stations(['test1'])[0] is not None
+    assert changes == [('test', 'test:2')] and accessor.active_versions == {'test': 'test:2'}
+    assert count_statements(DbAccessor.MATCH_STATIONS_BY_DOMAIN_IDS) == 2
+
+    # so does a model updated in place
+    graph.fingerprint = 'changed'
+    accessor.versions_expire_at = 0
+    accessor.get_stations(['test1'])
+    assert changes == [('test', 'test:2')] * 2
+    assert count_statements(DbAccessor.MATCH_STATIONS_BY_DOMAIN_IDS) == 3
+
+
+def db_accessor_collector_test():
+    from routes_aggregator.db_accessor import DbAccessor
+
+    statements = []
+    routes_statement = DbAccessor.LOCK_RETIRED_MODEL_VERSION + \
+        DbAccessor.DELETE_BATCHES[2][0].format(property='model_version')
+
+    def responder(statement, parameters):
+        statements.append((statement, parameters))
+        if statement == DbAccessor.MATCH_RETIRED_MODEL_VERSIONS:
+            return [{'agent_type': 'test', 'model_version': 'test:0'}]
+        if statement.startswith(DbAccessor.LOCK_RETIRED_MODEL_VERSION):
+            # a single batch of routes is left to delete
+            routes_batches = sum(1 for run_statement, _ in statements if run_statement == routes_statement)
+            return [{'count': 2 if statement == routes_statement and routes_batches == 1 else 0}]
+        return []
+
+    accessor, drivers = create_db_accessor(responder, retired_versions_grace_period=1)
+    del statements[:]
+    accessor.collect_retired_versions(CannedSession(responder))
+
+    # every batch locks the version node and checks it is still retired
+    delete_statements = [
+        (statement, parameters) for statement, parameters in statements if 'DELETE' in statement
+    ]
+    assert len(delete_statements) == len(DbAccessor.DELETE_BATCHES) + 1
+    assert all(
+        statement.startswith(DbAccessor.LOCK_RETIRED_MODEL_VERSION) and
+        parameters == {'agent_type': 'test', 'grace_period': 1000, 'value': 'test:0',
+                       'limit': DbAccessor.DEFAULT_BATCH_SIZE}
+        for statement, parameters in delete_statements
+    )
+    assert statements[0][0] == DbAccessor.RETIRE_STALE_STAGED_MODEL_VERSIONS
+    assert DbAccessor.RETIRE_STALE_STAGED_MODEL_VERSIONS.index('SET v.lock') < \
+        DbAccessor.RETIRE_STALE_STAGED_MODEL_VERSIONS.index('$stage_lease')
+
+    # the renewal stops once the staged version was retired by a collector
+    accessor.stage_lease = 0.03
+    stopped = threading.Event()
+    renewer = threading.Thread(
+        target=accessor.renew_staged_version,
+        args=({'agent_type': 'test', 'model_version': 'test:1'}, stopped))
+    renewer.start()
+    renewer.join(5)
+    assert not renewer.is_alive()
+    stopped.set()
+
+    # the sessions of the renewal and collector threads are closed when they end
+    collector = threading.Thread(target=accessor.run_collector)
+    collector.start()
+    collector.join()
+    assert len(drivers[0].sessions) > 2 and all(session.closed for session in drivers[0].sessions[1:])
+
+
+def db_accessor_sessions_test():
+    from neo4j.v1 import ServiceUnavailable, READ_ACCESS
+
+    graph = ModelGraph(build_test_model(), 'test:1')
+    accessor, drivers = create_db_accessor(graph, read_uris=['bolt://replica1', 'bolt://replica2'])
+    write_driver, first_driver, second_driver = drivers
+
+    # read sessions are spread over the replicas and reused by their thread
+    def read_stations():
+        for _ in range(2):
+            assert accessor.get_stations(['test1'])[0] is not None
+        accessor.close_sessions()
+
+    for _ in range(3):
+        reader = threading.Thread(target=read_stations)
+        reader.start()
+        reader.join()
+    assert [len(driver.sessions) for driver in drivers[1:]] == [2, 1]
+    assert all(session.closed for driver in drivers for session in driver.sessions if driver is not write_driver)
+
+    # a failed session is closed and replaced by one of the next replica
+    accessor.station_cache.clear()
+    second_driver.error = RuntimeError('broken session')
+    assert accessor.get_stations(['test1']) == [None]
+    assert len(second_driver.sessions) == 2 and second_driver.sessions[-1].closed
+    second_driver.error = None
+    assert accessor.get_stations(['test1'])[0] is not None
+    assert len(first_driver.sessions) == 3 and not first_driver.sessions[-1].closed
+
+    # reads of an unavailable replica fail over to the next one, then to the write driver
+    accessor.station_cache.clear()
+    first_driver.error = ServiceUnavailable('replica down')
+    assert accessor.get_stations(['test1'])[0] is not None
+    assert len(second_driver.sessions) == 3 and not second_driver.sessions[-1].closed
+
+    accessor.station_cache.clear()
+    second_driver.error = ServiceUnavailable('replica down')
+    write_sessions_count = len(write_driver.sessions)
+    assert accessor.get_stations(['test1'])[0] is not None
+    assert len(write_driver.sessions) == write_sessions_count + 1
+    assert write_driver.sessions[-1].access_mode == READ_ACCESS and write_driver.sessions[-1].closed
+
+
+def db_accessor_adoption_test():
+    from routes_aggregator.db_accessor import DbAccessor
+    from routes_aggregator.search_index import StationNameIndex
+
+    # a station graph written before the model versions and the search keys
+    nodes = {
+        i: {'domain_id': station.domain_id, 'agent_type': station.agent_type,
+            'station_id': station.station_id, 'station_name_en': station.get_station_name('en').upper()}
+        for i, station in enumerate(build_test_model().stations.values())
+    }
+    versions = {}
+
+    def search_stations(statement, parameters):
+        rows = {}
+        for part in statement.split(' UNION '):
+            property_name, operator, parameter_name = re.search(r'n\.(\w+) (STARTS WITH|=) \$(\w+)', part).groups()
+            matches = [
+                properties for properties in nodes.values()
+                if properties.get('model_version') in parameters['versions'] and (
+                    properties.get(property_name, '').startswith(parameters[parameter_name])
+                    if operator == 'STARTS WITH' else properties.get(property_name) == parameters[parameter_name])
+            ]
+            for properties in matches[:parameters['limit']]:
+                rows[properties['domain_id']] = {'n': CannedNode(properties)}
+        return list(rows.values())
+
+    def responder(statement, parameters):
+        unversioned = [i for i, properties in nodes.items() if 'model_version' not in properties]
+        if statement == DbAccessor.MATCH_UNVERSIONED_AGENT_TYPES:
+            return [{'agent_type': 'test'}] if unversioned else []
+        if statement == DbAccessor.ADOPT_UNVERSIONED_MODEL:
+            return [{'model_version': versions.setdefault('test', parameters['model_version'])}]
+        if statement == DbAccessor.MATCH_UNVERSIONED_STATIONS:
+            return [{'id': i, 'n': CannedNode(dict(nodes[i]))} for i in unversioned][:parameters['limit']]
+        if statement == DbAccessor.ADOPT_UNVERSIONED_STATIONS:
+            for station in parameters['stations']:
+                nodes[station['id']].update(station['search_keys'], model_version=parameters['model_version'])
+            return []
+        if statement == DbAccessor.MATCH_ACTIVE_MODEL_VERSIONS:
+            return [{'agent_type': agent_type, 'model_version': model_version, 'fingerprint': None}
+                    for agent_type, model_version in versions.items()]
+        if statement.startswith('MATCH (n:Station) WHERE n.search_name_'):
+            return search_stations(statement, parameters)
+        if 'count(n)' in statement:
+            return [{'count': 0}]
+        return []
+
+    accessor, _ = create_db_accessor(responder, batch_size=3)
+    assert accessor.active_versions == versions and len(versions) == 1
+    assert all(properties['search_name_en'] == properties['station_name_en'].lower() for properties in nodes.values())
+
+    assert sorted(get_domain_ids(accessor.find_stations(['Ky', 'ODE'], 'starts_with', 10))) == ['test1', 'test3']
+    assert get_domain_ids(accessor.find_stations(['lviv'], 'strict', 10)) == ['test4']
+
+    # searches go to the database while the station index lacks a model of the accessor
+    index = StationNameIndex(logging.getLogger('routes-aggregator'))
+    assert not index.supports('STRICT', accessor.get_agent_types())
+    index.build_model(build_test_model())
+    assert index.supports('STRICT', accessor.get_agent_types())
+    assert not index.supports('STRICT', accessor.get_agent_types() + ['other'])
+
+
+def model_store_test():
+    from routes_aggregator.db_accessor import DbAccessor
+    from routes_aggregator.exceptions import ModelStoreException
+
+    model = build_test_model()
+    reordered_model = build_test_model()
+    reordered_model.stations = dict(reversed(list(reordered_model.stations.items())))
+    assert get_model_fingerprint(reordered_model) == get_model_fingerprint(model)
+    assert get_model_fingerprint(build_changed_test_model()) != get_model_fingerprint(model)
+
+    class FailingTransaction(RecordingTransaction):
+        def run(self, statement, parameters=None):
+            super().run(statement, parameters)
+            raise IOError('connection lost')
+
+    accessor = DbAccessor.__new__(DbAccessor)
+    accessor.batch_size = DbAccessor.DEFAULT_BATCH_SIZE
+    accessor.active_versions = {'test': 'test:1'}
+    accessor.stage_lease = DbAccessor.DEFAULT_STAGE_LEASE
+    accessor.logger = logging.getLogger('routes-aggregator')
+    accessor.collect_garbage = lambda: None
+    transaction = FailingTransaction()
+
+    def execute_session(executor, default_value=None, access_mode=None):
+        try:
+            return executor(transaction)
+        except IOError:
+            return default_value
+
+    accessor.execute_session = execute_session
+    accessor.execute = lambda executor, default_value=None, access_mode=None: \
+        execute_session(executor, default_value)
+
+    try:
+        accessor.build_model(build_changed_test_model(), model)
+        assert False, 'failed model store succeeded'
+    except ModelStoreException:
+        pass
+
+    # the delta is only taken if the stored fingerprint is the previous model one
+    parameters = transaction.statements[0][1]
+    assert transaction.statements[0][0] == DbAccessor.UPDATE_MODEL_FINGERPRINT
+    assert parameters['previous_fingerprint'] == get_model_fingerprint(model)
+    assert parameters['fingerprint'] == get_model_fingerprint(build_changed_test_model())
+
+
+def csv_export_test():
+    from routes_aggregator.csv_export import CsvModelExporter
+    from routes_aggregator.db_accessor import DbAccessor
+
+    with tempfile.TemporaryDirectory() as export_path:
+        exporter = CsvModelExporter(export_path)
+        model_version = exporter.export_model(build_test_model(), 'test:1')
+        command = exporter.build_import_command()
+
+        def read_rows(file_name):
+            with open(os.path.join(export_path, file_name), newline='', encoding='utf-8') as fileobj:
+                return list(csv.reader(fileobj))
+
+        stations = read_rows('test-stations.csv')
+        assert stations[0][0] == 'domain_id:ID(Station)'
+        assert sorted(row[0] for row in stations[1:]) == ['test1', 'test2', 'test3', 'test4']
+        assert 'model_version:string' in stations[0]
+
+        connections = read_rows('test-route-connections.csv')
+        assert connections[0][:2] == [':START_ID(Station)', ':END_ID(Route)']
+        assert 'station_number:long' in connections[0]
+        assert len(connections) == 6
+
+        transitions = read_rows('test-transitions.csv')
+        assert len(transitions) == 4
+
+        assert read_rows('test-model-version.csv')[1] == \
+            ['test', model_version, get_model_fingerprint(build_test_model())]
+        assert command.startswith('neo4j-admin import ')
+        for file_name in os.listdir(export_path):
+            assert os.path.join(export_path, file_name) in command
+
+    class Relationship:
+        def __init__(self, properties):
+            self.properties = properties
+
+    model = build_timetable_model([('X', [('A', '', '08:00'), ('B', '', '09:00'), ('C', '10:00', '')])])
+    with tempfile.TemporaryDirectory() as export_path:
+        CsvModelExporter(export_path).export_model(model, 'test:1')
+        with open(os.path.join(export_path, 'test-transitions.csv'), newline='', encoding='utf-8') as fileobj:
+            rows = list(csv.reader(fileobj))
+
+    # the importer drops empty strings, so empty times are absent from the relationships
+    header = [column.split(':')[0] for column in rows[0]]
+    data = [
+        {
+            'departure_station_id': row[0][len('test'):],
+            'arrival_station_id': row[1][len('test'):],
+            'r': Relationship({name: value for name, value in zip(header[2:], row[2:]) if value != ''})
+        }
+        for row in rows[1:]
+    ]
+    route = Route('test', 'X')
+    DbAccessor.build_route_points(route, data)
+    assert ModelDiff.get_stops_signature(route) == ModelDiff.get_stops_signature(model.routes['X'])
+
+
+def service_test(config_path):
+    from routes_aggregator.service import Service
+
+    Service(config_path=config_path)
 
     #Service().request_model_update('uz', False)
     #Service().request_model_update('uzs', False)
@@ -38,6 +1325,41 @@ def service_test():
     Service().get_route('uz55657')
     print(r)
 
-language_property_test()
-travel_time_test()
-service_test()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Routes Aggregator API')
+    parser.add_argument('config_path', nargs='?', help='Path to configuration file, enables the service test')
+    args = parser.parse_args()
+
+    language_property_test()
+    travel_time_test()
+    route_time_test()
+    memory_accessor_test()
+    journey_planner_test()
+    station_name_index_test()
+    fuzzy_station_search_test()
+    station_search_keys_test()
+    direct_connection_index_test()
+    raptor_departure_window_test()
+    multiple_day_wait_test()
+    model_format_test()
+    loaded_model_update_test()
+    model_provider_test()
+    path_cache_test()
+    cache_race_test()
+    caching_storage_adapter_test()
+    s3_storage_adapter_test()
+    http_cache_test()
+    model_diff_test()
+    model_store_test()
+    batch_loader_test()
+    query_generator_test()
+    db_accessor_batch_read_test()
+    remove_model_test()
+    db_accessor_versions_test()
+    db_accessor_collector_test()
+    db_accessor_sessions_test()
+    db_accessor_adoption_test()
+    csv_export_test()
+    if args.config_path:
+        service_test(args.config_path)